@@ -1,16 +1,22 @@
 from datetime import datetime, timedelta
+import io
 import traceback
-from config import ALL_CRYPTO_PAIRS
+from config import ALL_CRYPTO_PAIRS, COCO_IMAGE_URL_PREFIX
 from coco_handler import CocoHandler
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session
-from rv_session import RVSession
+from flask import Flask, render_template, stream_template, request, redirect, url_for, flash, jsonify, session, send_file
+from rv_session import CryptoHandlerGuard, RVSession, RVSessions
 from history_handler import HistoryHandler
-from diversity_handler import DiversityHandler, read_image_from_url
+from diversity_handler import read_image_from_url
+from disk_image_cache import shared_disk_image_cache
+from palette_sweep import PaletteSweep
+from diverse_set_pool import DiverseSetPool
+from image_match_batcher import ImageMatchBatcher
 from crypto_handler import CryptoHandler
 from error_handler import handle_errors
 
 from freqtrade_handler import FreqtradeHandler
 import threading
+import uuid
 from multiprocessing import Process
 import signal
 import os
@@ -25,11 +31,28 @@ def run_web_app():
     history_handler = HistoryHandler("./history")
     crypto_handler = CryptoHandler(stake_currency='USDT',
                                    freqtrade_handler=FreqtradeHandler())
-    coco_handler = CocoHandler()
+    coco_handler = CocoHandler.shared()
+    # Keeps diverse image sets ready in the background, so starting a session does not wait for them
+    diverse_set_pool = DiverseSetPool(coco_handler).start()
 
     gpt_handler = GPTHandler()
-    rv_session = RVSession(all_trading_pairs=ALL_CRYPTO_PAIRS,
-                           coco_handler=coco_handler, crypto_handler=crypto_handler, gpt_handler=gpt_handler)
+    # Sends the GPT image matches of concurrent sessions as one prompt
+    image_match_batcher = ImageMatchBatcher(gpt_handler)
+    # The one Freqtrade instance trades for one session at a time; other operators wait for its results
+    crypto_guard = CryptoHandlerGuard()
+    # One RVSession per operator, keyed by the id kept in their Flask session; idle ones are dropped
+    rv_sessions = RVSessions(lambda session_id: RVSession(all_trading_pairs=ALL_CRYPTO_PAIRS,
+                                                          coco_handler=coco_handler, crypto_handler=crypto_handler,
+                                                          gpt_handler=gpt_handler, diverse_set_pool=diverse_set_pool,
+                                                          image_match_batcher=image_match_batcher, session_id=session_id,
+                                                          crypto_guard=crypto_guard),
+                             crypto_guard=crypto_guard)
+
+    def current_rv_session():
+        """The RVSession of the operator making the request, created on their first request."""
+        if 'rv_session_id' not in session:
+            session['rv_session_id'] = uuid.uuid4().hex[:8]
+        return rv_sessions.get(session['rv_session_id'])
 
     @app.route('/')
     def index():
@@ -63,7 +86,7 @@ def run_web_app():
                 session['show_length'] = show_length
 
                 # Start the session
-                rv_session.start_session(n_cryptos=n_cryptos)
+                current_rv_session().start_session(n_cryptos=n_cryptos)
 
                 flash('Session started successfully!', 'success')
                 return redirect(url_for('loading'))
@@ -98,6 +121,7 @@ def run_web_app():
                 return render_template('arv_session.html', instructions=instructions)
 
             # Store user's ARV insights in the RVSession
+            rv_session = current_rv_session()
             rv_session.record_rv_session(user_description)
 
             # Use the RVSession's methods to find the matched crypto
@@ -136,6 +160,7 @@ def run_web_app():
 
     @app.route('/show-results', methods=['GET'])
     def show_results():
+        rv_session = current_rv_session()
         current_time = datetime.now()
         start_time = datetime.strptime(session.get(
             'start_time', '9999-12-31T00:00'), '%Y-%m-%dT%H:%M')
@@ -182,6 +207,8 @@ def run_web_app():
         }
         # Save the session data to history file
         history_handler.save_session_data(results)
+        # The trade is over: another operator's session may start
+        rv_session.release_crypto_handler()
 
         return render_template('results.html', results=results)
 
@@ -194,7 +221,9 @@ def run_web_app():
 
     @app.route('/reset', methods=['POST'])
     def reset_session():
-        rv_session.reset_session()
+        current_rv_session().reset_session()
+        # The operator's next session starts from a fresh RVSession
+        rv_sessions.pop(session.pop('rv_session_id'))
         return redirect(url_for('index'))
 
     @app.errorhandler(Exception)
@@ -213,10 +242,18 @@ def run_web_app():
     def handle_404(e):
         return jsonify(error="Resource not found."), 404
 
+    @app.route('/cached-image')
+    def cached_image():
+        # Serve COCO images from the on-disk cache, downloading them only once
+        url = request.args.get('url', '')
+        if not url.startswith(COCO_IMAGE_URL_PREFIX):
+            return jsonify(error="Only COCO images are served."), 400
+        content = shared_disk_image_cache.get_bytes(url)
+        return send_file(io.BytesIO(content), mimetype='image/jpeg', max_age=86400)
+
     @app.route('/display_images')
     def display_images():
-        handler = CocoHandler()
-        img, captions = handler.get_random_image()
+        img, captions = coco_handler.get_random_image()
 
         images = [{
             'url': img['coco_url'],  # assuming this is a direct link
@@ -232,14 +269,9 @@ def run_web_app():
 
     @app.route('/test_diversity_handler')
     def test_diversity_handler():
-        handler = CocoHandler()
-        img_obj, captions = handler.get_random_image()
+        img_obj, captions = coco_handler.get_random_image()
         raw_image = read_image_from_url(img_obj['coco_url'])
 
-        diversity_handler = DiversityHandler()
-
-        images = []
-
         # Parameters
         pixel_sizes = [5, 10, 15, 50,  75,  100]
         similarity_thresholds = [5, 10, 15, 50, 75, 100]
@@ -249,29 +281,22 @@ def run_web_app():
         total_operations = len(pixel_sizes) * len(similarity_thresholds) * \
             len(apply_clusterings) * len(n_clusters_list)
         print(f"Total operations to be performed: {total_operations}")
-        completed_operations = 0
-
-        for pixel_size in pixel_sizes:
-            for similarity_threshold in similarity_thresholds:
-                for apply_clustering in apply_clusterings:
-                    for n_clusters in n_clusters_list:
 
-                        color_palette = diversity_handler.extract_palette(
-                            img_obj, pixel_size=pixel_size, similarity_threshold=similarity_threshold,
-                            apply_clustering=apply_clustering, n_clusters=n_clusters, raw_image=raw_image
-                        )
-
-                        images.append({
-                            'url': img_obj['coco_url'],
-                            'color_palette': color_palette,
-                            'captions': [f"Pixel Size: {pixel_size}, Similarity Threshold: {similarity_threshold}, Apply Clustering: {apply_clustering}, N Clusters: {n_clusters}"]
-                        })
-
-                        completed_operations += 1
-                        print(
-                            f"Completed: {completed_operations}/{total_operations}")
-
-        return render_template('display_images.html', images=images)
+        def images():
+            sweep = PaletteSweep(raw_image)
+            results = sweep.run(pixel_sizes, similarity_thresholds,
+                                apply_clusterings, n_clusters_list)
+            for completed_operations, (params, color_palette) in enumerate(results, start=1):
+                print(
+                    f"Completed: {completed_operations}/{total_operations}")
+                yield {
+                    'url': img_obj['coco_url'],
+                    'color_palette': color_palette,
+                    'captions': [f"Pixel Size: {params['pixel_size']}, Similarity Threshold: {params['similarity_threshold']}, Apply Clustering: {params['apply_clustering']}, N Clusters: {params['n_clusters']}"]
+                }
+
+        # Stream each image to the browser as soon as its palette is done
+        return stream_template('display_images.html', images=images())
 
     # start web serving
     # use_reloader=False with multiprocessing
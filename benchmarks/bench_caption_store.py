@@ -0,0 +1,91 @@
+"""
+Memory benchmark of the columnar caption store (CocoSnapshot) against pycocotools.
+
+Generates a synthetic captions annotation file at train2017 scale (118287
+images, 5 captions each, COCO-like URLs and file names), then reports for
+pycocotools.COCO and for CocoSnapshot the load time, the Python heap held
+after loading (tracemalloc) and, for the snapshot, its size on disk (memory-
+mapped, paged in on demand and shared between processes).
+
+Usage: python benchmarks/bench_caption_store.py [n_images]
+"""
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from coco_snapshot import CocoSnapshot  # noqa: E402
+
+WORDS = ('a man woman dog cat people sitting standing on in the bench with red blue '
+         'bus train street near table plate of food riding horse beach next to large small').split()
+
+
+def write_annotations(path, n_images, rng):
+    ids = rng.sample(range(1, 600000), n_images)
+    images = [{
+        'license': rng.randint(1, 8),
+        'file_name': f'{i:012d}.jpg',
+        'coco_url': f'http://images.cocodataset.org/train2017/{i:012d}.jpg',
+        'height': rng.randint(200, 640),
+        'width': 640,
+        'date_captured': f'2013-11-{rng.randint(10, 28)} 17:02:52',
+        'flickr_url': f'http://farm{rng.randint(1, 9)}.staticflickr.com/{rng.randint(1000, 9999)}/{i}_{rng.getrandbits(40):x}_z.jpg',
+        'id': i,
+    } for i in ids]
+    annotations = []
+    for img_id in ids:
+        for _ in range(5):
+            caption = ' '.join(rng.choice(WORDS)
+                               for _ in range(rng.randint(8, 14)))
+            annotations.append({'image_id': img_id, 'id': len(
+                annotations) * 3 + 37, 'caption': caption.capitalize() + '.'})
+    rng.shuffle(annotations)
+    with open(path, 'w') as file:
+        json.dump({'info': {}, 'licenses': [], 'images': images,
+                  'annotations': annotations}, file)
+
+
+def measure(load):
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    store = load()
+    elapsed = time.perf_counter() - t0
+    held, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return store, elapsed, held
+
+
+def main(n_images=118287):
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        ann_file = f'{tmp}/captions.json'
+        write_annotations(ann_file, n_images, rng)
+        print(
+            f"{n_images} images, annotation JSON: {os.path.getsize(ann_file) / 2**20:.1f} MB")
+
+        from pycocotools.coco import COCO
+        with contextlib.redirect_stdout(io.StringIO()):
+            coco, coco_time, coco_bytes = measure(lambda: COCO(ann_file))
+        del coco
+
+        CocoSnapshot.build(ann_file, f'{tmp}/snapshot')
+        snapshot, snapshot_time, snapshot_bytes = measure(
+            lambda: CocoSnapshot(f'{tmp}/snapshot'))
+        disk_bytes = sum(entry.stat().st_size for entry in os.scandir(
+            f'{tmp}/snapshot'))
+
+        print(f"{'store':>14} {'load (s)':>9} {'heap (MB)':>10} {'mmap (MB)':>10}")
+        print(
+            f"{'pycocotools':>14} {coco_time:>9.3f} {coco_bytes / 2**20:>10.1f} {0:>10.1f}")
+        print(
+            f"{'CocoSnapshot':>14} {snapshot_time:>9.3f} {snapshot_bytes / 2**20:>10.1f} {disk_bytes / 2**20:>10.1f}")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,59 @@
+"""
+Benchmark of the buffered entropy pool against drawing from a slow source directly.
+
+Uses LocalEntropySource with a per-request delay in place of the quantum RNG and
+draws random image ids the way CocoHandler does, once straight from the source
+(one request per draw) and once through an EntropyPool, reporting the time per
+draw and where the pool's draws came from.
+
+Usage: python benchmarks/bench_entropy_pool.py [n_draws] [delay_ms]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from entropy_pool import EntropyPool, LocalEntropySource  # noqa: E402
+
+
+class _DirectSource(random.Random):
+    """Draws every getrandbits call straight from the source, as an unbuffered RNG would."""
+
+    def __init__(self, source):
+        self.source = source
+        super().__init__()
+
+    def getrandbits(self, k):
+        n_bytes = (k + 7) // 8
+        return int.from_bytes(self.source(n_bytes), 'little') >> (8 * n_bytes - k)
+
+    def random(self):
+        return self.getrandbits(53) * 2.0 ** -53
+
+
+def main(n_draws=200, delay_ms=20):
+    img_ids = list(range(5000))
+    delay = delay_ms / 1000
+
+    direct = _DirectSource(LocalEntropySource(delay=delay, seed=0))
+    t0 = time.perf_counter()
+    for _ in range(n_draws):
+        direct.choice(img_ids)
+    direct_time = time.perf_counter() - t0
+
+    pool = EntropyPool(LocalEntropySource(delay=delay, seed=0))
+    time.sleep(2 * delay)  # Let the first block arrive, as it would while the app starts
+    t0 = time.perf_counter()
+    for _ in range(n_draws):
+        pool.choice(img_ids)
+    pool_time = time.perf_counter() - t0
+    pool.close()
+
+    print(f"direct: {direct_time / n_draws * 1e6:10.1f} us/draw")
+    print(f"pool:   {pool_time / n_draws * 1e6:10.1f} us/draw")
+    print(f"pool stats: {pool.stats()}")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
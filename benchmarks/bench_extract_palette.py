@@ -0,0 +1,77 @@
+"""
+Before/after benchmark for DiversityHandler.extract_palette.
+
+Runs the original KDTree-based implementation and the vectorized one on the
+same synthetic 640x480 images over the pixel_size / similarity_threshold grid
+used by /test_diversity_handler, checks that both return identical palettes
+and prints the timings.
+
+Usage: python benchmarks/bench_extract_palette.py [n_images]
+"""
+import os
+import sys
+import time
+
+import numpy as np
+from scipy.spatial import KDTree
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from diversity_handler import DiversityHandler  # noqa: E402
+
+
+def legacy_extract_palette(handler, image, pixel_size, similarity_threshold):
+    """The pre-vectorization extract_palette (without clustering)."""
+    pixelated_img = handler.pixelate_image(image, pixel_size=pixel_size)
+    potential_unique_colors = set(tuple(v)
+                                  for v in pixelated_img.reshape(-1, 3))
+    kd_tree = KDTree(np.array([[0, 0, 0]]))
+    unique_colors = []
+    for color in potential_unique_colors:
+        if not kd_tree.query_ball_point(color, r=similarity_threshold):
+            unique_colors.append(color)
+            kd_tree = KDTree(np.array(unique_colors))
+
+    color_dominance = {color: 0 for color in unique_colors}
+    kd_tree = KDTree(np.array(unique_colors))
+    for color in pixelated_img.reshape(-1, 3):
+        _, index = kd_tree.query(color)
+        color_dominance[unique_colors[index]] += 1
+
+    total_pixels = pixel_size * pixel_size
+    return [(color, (color_dominance[color] / total_pixels) * 100) for color in unique_colors]
+
+
+def synthetic_image(rng, height=480, width=640):
+    """A smooth random gradient with noise, roughly like a natural photo."""
+    coarse = rng.integers(0, 256, size=(6, 8, 3)).astype(np.float32)
+    import cv2
+    image = cv2.resize(coarse, (width, height), interpolation=cv2.INTER_CUBIC)
+    image += rng.normal(0, 12, size=image.shape)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def main(n_images=3):
+    rng = np.random.default_rng(0)
+    images = [synthetic_image(rng) for _ in range(n_images)]
+    handler = DiversityHandler()
+
+    print(f"{'pixel_size':>10} {'threshold':>9} {'before (s)':>11} {'after (s)':>10} {'speedup':>8}")
+    for pixel_size in [5, 10, 15, 50, 75, 100]:
+        for similarity_threshold in [5, 15, 50]:
+            before = after = 0.0
+            for image in images:
+                t0 = time.perf_counter()
+                expected = legacy_extract_palette(
+                    handler, image, pixel_size, similarity_threshold)
+                t1 = time.perf_counter()
+                actual = handler.extract_palette(
+                    None, pixel_size=pixel_size, similarity_threshold=similarity_threshold, raw_image=image)
+                t2 = time.perf_counter()
+                assert actual == expected, (pixel_size, similarity_threshold)
+                before += t1 - t0
+                after += t2 - t1
+            print(f"{pixel_size:>10} {similarity_threshold:>9} {before:>11.3f} {after:>10.3f} {before / after:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,68 @@
+"""
+Benchmark of ImageMatchBatcher: LLM round-trips per image match under concurrent sessions.
+
+Replaces g4f.ChatCompletion.create with a call into a StubProvider that answers
+single and batched image match prompts after a fixed latency. For each number
+of concurrent sessions, every session asks for its match at the same time,
+once on its own (as without a batcher) and once through the batcher, and the
+round-trips and wall time are reported.
+
+Usage: python benchmarks/bench_image_match_batch.py [max_sessions] [latency]
+"""
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import g4f  # noqa: E402
+from gpt_handler import GPTHandler  # noqa: E402
+from image_match_batcher import ImageMatchBatcher  # noqa: E402
+from stub_providers import StubProvider  # noqa: E402
+
+CAPTION_MAP = {'BTC/USDT': ['A dog runs on a beach.'],
+               'ETH/USDT': ['A plate of food on a table.']}
+
+
+def answer(prompt):
+    """The first crypto of every session of a batched prompt, or of the single prompt."""
+    if 'sessions: ' not in prompt:
+        return '{"data": ["btc/usdt"]}'
+    sessions, _ = json.JSONDecoder().raw_decode(prompt.split('sessions: ', 1)[1])
+    return json.dumps({"data": {session_id: [list(session["image_captions"])[0].lower()]
+                                for session_id, session in sessions.items()}})
+
+
+def main(max_sessions=16, latency=1.0):
+    g4f.ChatCompletion.create = lambda model, provider, messages, stream, **kwargs: provider.create_completion(
+        model, messages, stream, **kwargs)
+    provider = StubProvider('Stub', response=answer, latency=latency)
+    handler = GPTHandler(response_cache=None, race_providers=1, provider=provider)
+
+    def single(i):
+        return handler.get_response(f'match session {i}')
+
+    n_sessions = 1
+    while n_sessions <= max_sessions:
+        batcher = ImageMatchBatcher(handler)
+
+        def batched(i):
+            return batcher.match(f's{i}', f'description {i}', CAPTION_MAP,
+                                 fallback=lambda: single(i))
+
+        for name, run in [('single', single), ('batched', batched)]:
+            calls = provider.calls
+            t0 = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=n_sessions) as executor:
+                list(executor.map(run, range(n_sessions)))
+            elapsed = time.perf_counter() - t0
+            round_trips = provider.calls - calls
+            print(f"{n_sessions:3d} sessions, {name:7s}: {round_trips:3d} round-trips "
+                  f"({round_trips / n_sessions:.2f} per match), {elapsed:.2f} s")
+        n_sessions *= 2
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 16,
+         float(sys.argv[2]) if len(sys.argv) > 2 else 1.0)
@@ -0,0 +1,55 @@
+"""
+Benchmark of GPTHandler provider racing against single-provider requests.
+
+Replaces g4f.ChatCompletion.create with a call into StubProvider instances whose
+latency is redrawn from a heavy-tailed distribution for every request (one in
+ten requests hangs for several seconds), then reports the median and p95
+latency of get_response with race_providers=1 and with racing.
+
+Usage: python benchmarks/bench_provider_race.py [n_requests] [race_providers]
+"""
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import g4f  # noqa: E402
+from gpt_handler import GPTHandler  # noqa: E402
+from stub_providers import StubProvider  # noqa: E402
+
+
+class _JitteryProvider(StubProvider):
+    """StubProvider with a new random latency for every request."""
+
+    def __init__(self, name, rng):
+        super().__init__(name, response='{"data": []}')
+        self.rng = rng
+
+    def create_completion(self, model, messages, stream, **kwargs):
+        self.latency = 3.0 if self.rng.random() < 0.1 else self.rng.lognormvariate(-2.5, 0.5)
+        return super().create_completion(model, messages, stream, **kwargs)
+
+
+def main(n_requests=40, race_providers=3):
+    g4f.ChatCompletion.create = lambda model, provider, messages, stream, **kwargs: provider.create_completion(
+        model, messages, stream, **kwargs)
+    rng = random.Random(0)
+    providers = [_JitteryProvider(f'Stub{i}', rng) for i in range(6)]
+
+    for k in [1, race_providers]:
+        handler = GPTHandler(response_cache=None, race_providers=k,
+                             provider=providers[0], providers=providers)
+        latencies = []
+        for i in range(n_requests):
+            t0 = time.perf_counter()
+            handler.get_response(f'prompt {i}')
+            latencies.append(time.perf_counter() - t0)
+        print(f"race_providers={k}: median {np.median(latencies) * 1000:7.1f} ms, "
+              f"p95 {np.percentile(latencies, 95) * 1000:7.1f} ms")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
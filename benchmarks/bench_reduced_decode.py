@@ -0,0 +1,55 @@
+"""
+Benchmark of the reduced-resolution decode path for palette extraction.
+
+Writes synthetic 640x480 JPEGs to a temporary directory, then extracts their
+palettes with full decoding and with JPEG decoding at 1/2, 1/4 and 1/8 scale,
+reporting decode + extraction time, bytes held per cached image and the mean
+Lab distance of the palette colors to those of the full decode.
+
+Usage: python benchmarks/bench_reduced_decode.py [n_images]
+"""
+import os
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from bench_extract_palette import synthetic_image  # noqa: E402
+from diversity_handler import DiversityHandler  # noqa: E402
+from image_cache import ImageCache  # noqa: E402
+
+
+def main(n_images=50):
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as image_dir:
+        image_objs = []
+        for i in range(n_images):
+            file_name = f'{i:012d}.jpg'
+            cv2.imwrite(f'{image_dir}/{file_name}',
+                        cv2.cvtColor(synthetic_image(rng), cv2.COLOR_RGB2BGR))
+            image_objs.append(
+                {'id': i, 'file_name': file_name, 'height': 480, 'width': 640})
+
+        reference = None
+        print(f"{'reduction':>9} {'time (s)':>9} {'bytes/image':>12} {'mean deltaE':>13}")
+        for reduction in [1, 2, 4, 8]:
+            cache = ImageCache()
+            handler = DiversityHandler(
+                image_cache=cache, decode_reduction=reduction, image_dir=image_dir)
+            t0 = time.perf_counter()
+            palettes = [handler.extract_palette(img) for img in image_objs]
+            elapsed = time.perf_counter() - t0
+            if reference is None:
+                reference = palettes
+            # Lab distance from every palette color to the closest color of the full-decode palette
+            delta_e = [np.sqrt(((DiversityHandler.palettes_to_lab([pal])[0][:, None] -
+                                 DiversityHandler.palettes_to_lab([ref])[0][None]) ** 2).sum(-1)).min(1).mean()
+                       for ref, pal in zip(reference, palettes)]
+            print(f"{reduction:>9} {elapsed:>9.3f} {cache.current_bytes // n_images:>12} {np.mean(delta_e):>13.2f}")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,180 @@
+import queue
+import threading
+from collections import Counter
+
+import numpy as np
+
+from diversity_handler import DiversityHandler
+
+
+class Candidate:
+    """
+    One candidate image of a diverse set, with everything the checks need computed once.
+
+    - img (dict): The COCO image record, with its 'color_palette'.
+    - captions (tuple): The image's captions.
+    - palette (list): The (color, dominance) palette from extract_palette.
+    - lab (np.ndarray): (n_colors, 3) Lab values of the palette colors.
+    """
+    __slots__ = ('img', 'captions', 'palette', 'lab')
+
+    def __init__(self, img, captions, palette, lab):
+        self.img = img
+        self.captions = captions
+        self.palette = palette
+        self.lab = lab
+
+    @property
+    def id(self):
+        return self.img['id']
+
+
+class CandidatePipeline:
+    """
+    Turns drawn image ids into Candidates, computing each image's palette exactly once.
+
+    Candidates are kept by image id for the lifetime of the pipeline, so an image
+    that comes back in a later batch (e.g. released after a rejected batch) is
+    served from memory, and the palette check works on the stored Lab values.
+    extraction_counts records how often each image's palette was extracted;
+    max_extractions() is 1 as long as the single-extraction guarantee holds.
+
+    Parameters:
+    - coco_handler (CocoHandler): Source of image records and captions.
+    - diversity_handler (DiversityHandler): Extracts the palettes.
+    - use_local_images (bool): Read images from disk rather than from their URLs.
+    - parallel (bool): Extract the palettes of a batch on a thread pool.
+    """
+
+    def __init__(self, coco_handler, diversity_handler, use_local_images=True, parallel=False):
+        self.coco_handler = coco_handler
+        self.diversity_handler = diversity_handler
+        self.use_local_images = use_local_images
+        self.parallel = parallel
+        self.extraction_counts = Counter()
+        self._candidates = {}
+
+    def candidates(self, img_ids):
+        """The Candidates of img_ids, in order; only images not seen before are loaded and extracted."""
+        missing = [img_id for img_id in dict.fromkeys(img_ids)
+                   if img_id not in self._candidates]
+        if missing:
+            imgs = self.coco_handler.coco.loadImgs(missing)
+            captions = self.coco_handler.captions_many(missing)
+            palettes = self.diversity_handler.palettes_of_images(
+                imgs, use_local_images=self.use_local_images, parallel=self.parallel)
+            self.extraction_counts.update(missing)
+            # One rgb2lab call for the whole batch, split back per image
+            lab, owners = DiversityHandler.palettes_to_lab(palettes)
+            labs = np.split(lab, np.cumsum(np.bincount(
+                owners, minlength=len(palettes)))[:-1])
+            for img, image_captions, palette, image_lab in zip(imgs, captions, palettes, labs):
+                img['color_palette'] = palette
+                self._candidates[img['id']] = Candidate(
+                    img, image_captions, palette, image_lab)
+        return [self._candidates[img_id] for img_id in img_ids]
+
+    def similar_pairs(self, candidates, similarity_threshold=50, stop_at_first=False):
+        """DiversityHandler.similar_image_pairs over the stored Lab palettes of candidates."""
+        lab = np.concatenate([candidate.lab for candidate in candidates]) if candidates \
+            else np.empty((0, 3))
+        owners = np.repeat(np.arange(len(candidates)),
+                           [len(candidate.lab) for candidate in candidates])
+        return DiversityHandler.similar_lab_pairs(lab, owners, len(candidates), similarity_threshold, stop_at_first)
+
+    def max_extractions(self):
+        """Largest number of palette extractions of any one image (0 before the first batch)."""
+        return max(self.extraction_counts.values(), default=0)
+
+
+class BatchPrefetcher:
+    """
+    Iterates over produce() results, computing up to depth of them ahead on a worker thread.
+
+    Lets the next batches be drawn and color-checked while the consumer waits on
+    GPT for the current one. The hand-over queue is bounded by depth, so the
+    worker stays at most depth batches ahead; close() cancels it after the
+    batch in progress. Iteration ends when produce() returns None, and an
+    exception raised by produce() is re-raised to the consumer. With depth=0
+    produce() runs inline, without a thread.
+    """
+
+    _DONE = object()
+
+    def __init__(self, produce, depth=2):
+        self.produce = produce
+        self.depth = depth
+        self._finished = False
+        self._stop = threading.Event()
+        self._thread = None
+        if depth > 0:
+            self._queue = queue.Queue(maxsize=depth)
+            self._thread = threading.Thread(
+                target=self._run, name='batch-prefetcher', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        try:
+            while not self._stop.is_set():
+                item = self.produce()
+                if item is None:
+                    break
+                if not self._put(item):
+                    return
+        except Exception as e:
+            self._put(_ProducerError(e))
+            return
+        self._put(self._DONE)
+
+    def _put(self, item):
+        """Hand item over, giving up if the prefetcher is closed while the queue is full."""
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._finished:
+            raise StopIteration
+        if self._thread is not None:
+            item = self._queue.get()
+        else:
+            try:
+                item = self.produce()
+            except Exception:
+                # Inline too, iteration ends with the producer's error
+                self._finished = True
+                raise
+        if item is None or item is self._DONE:
+            self._finished = True
+            raise StopIteration
+        if isinstance(item, _ProducerError):
+            self._finished = True
+            raise item.error
+        return item
+
+    def close(self):
+        """Stop producing and wait for the worker to finish the batch in progress."""
+        self._finished = True
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class _ProducerError:
+    __slots__ = ('error',)
+
+    def __init__(self, error):
+        self.error = error
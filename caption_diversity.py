@@ -0,0 +1,85 @@
+import numpy as np
+from scipy.sparse import vstack
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from config import CAPTION_BORDERLINE_SIMILARITY, CAPTION_DUPLICATE_SIMILARITY
+
+
+class CaptionDiversity:
+    """
+    Offline caption diversity check, a local stand-in for the GPT DIVERSITY_CHECK_PROMPT.
+
+    A TF-IDF model (English stop words removed, sublinear term frequencies) is
+    fitted on every caption of a COCO split, and the L2-normalized vectors of
+    all captions are precomputed. A batch is then checked with one cosine-
+    similarity matrix: captions are walked in order and a caption is flagged
+    when its similarity to a caption already kept reaches duplicate_threshold,
+    so of n similar captions n-1 are flagged, as the GPT prompt asks.
+
+    Pairs of kept captions with a similarity between borderline_threshold and
+    duplicate_threshold make the batch borderline: too close to call locally.
+
+    Parameters:
+    - captions (iterable): All captions of the split (e.g. CocoHandler.caption_index values, flattened).
+    - duplicate_threshold (float): Cosine similarity from which two captions are near-duplicates.
+    - borderline_threshold (float): Cosine similarity from which a kept pair is borderline.
+    """
+
+    def __init__(self, captions, duplicate_threshold=CAPTION_DUPLICATE_SIMILARITY,
+                 borderline_threshold=CAPTION_BORDERLINE_SIMILARITY):
+        self.duplicate_threshold = duplicate_threshold
+        self.borderline_threshold = borderline_threshold
+        # Distinct captions, in first-appearance order, and their rows in self.vectors
+        self.rows = {}
+        for caption in captions:
+            self.rows.setdefault(caption, len(self.rows))
+        self.vectorizer = TfidfVectorizer(
+            stop_words='english', sublinear_tf=True, dtype=np.float32)
+        self.vectors = self.vectorizer.fit_transform(list(self.rows))
+
+    @classmethod
+    def from_caption_index(cls, caption_index, **kwargs):
+        """Fit on the captions of {img_id: captions} (CocoHandler.caption_index)."""
+        return cls((caption for captions in caption_index.values() for caption in captions), **kwargs)
+
+    def caption_vectors(self, captions):
+        """Sparse (len(captions), vocabulary) TF-IDF rows; captions outside the split are vectorized on the fly."""
+        unknown = [caption for caption in captions if caption not in self.rows]
+        if not unknown:
+            return self.vectors[[self.rows[caption] for caption in captions]]
+        extra = dict(zip(unknown, self.vectorizer.transform(unknown)))
+        rows = [extra[caption] if caption in extra else self.vectors[self.rows[caption]]
+                for caption in captions]
+        return vstack(rows).tocsr()
+
+    def similarity_matrix(self, captions):
+        """(len(captions), len(captions)) cosine similarities of the captions."""
+        vectors = self.caption_vectors(captions)
+        return (vectors @ vectors.T).toarray()
+
+    def check(self, captions):
+        """
+        Flag the near-duplicate captions of a batch.
+
+        Parameters:
+        - captions (list): The batch, one caption per image.
+
+        Returns:
+        - flagged (list): Captions TO-REMOVE, like the GPT check's 'data' list.
+        - borderline (bool): Whether kept captions include a pair too close to call locally.
+        """
+        similarity = self.similarity_matrix(captions)
+        np.fill_diagonal(similarity, 0)
+        kept, flagged = [], []
+        for i, caption in enumerate(captions):
+            if kept and similarity[i, kept].max() >= self.duplicate_threshold:
+                flagged.append(caption)
+            else:
+                kept.append(i)
+        borderline = bool(
+            (similarity[np.ix_(kept, kept)] >= self.borderline_threshold).any())
+        return flagged, borderline
+
+    def non_diverse_captions(self, captions):
+        """The captions check() flags, without the borderline verdict."""
+        return self.check(captions)[0]
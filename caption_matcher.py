@@ -0,0 +1,169 @@
+import math
+import re
+from collections import Counter
+
+from sklearn.feature_extraction.text import ENGLISH_STOP_WORDS
+
+from config import BM25_B, BM25_K1, SYNONYM_WEIGHT
+
+# Groups of interchangeable words in COCO captions and free-form descriptions (stemmed when the table is built)
+SYNONYM_GROUPS = [
+    ['person', 'man', 'woman', 'people', 'guy', 'lady', 'boy', 'girl', 'child', 'kid', 'player', 'human'],
+    ['car', 'automobile', 'vehicle', 'truck', 'van', 'taxi'],
+    ['bus', 'coach', 'shuttle'],
+    ['train', 'locomotive', 'railway', 'rail', 'subway', 'tram'],
+    ['bike', 'bicycle', 'cycle', 'motorcycle', 'motorbike', 'scooter'],
+    ['plane', 'airplane', 'aircraft', 'jet', 'airliner'],
+    ['boat', 'ship', 'sailboat', 'yacht', 'vessel', 'canoe', 'kayak'],
+    ['dog', 'puppy', 'pup', 'hound'],
+    ['cat', 'kitten', 'kitty'],
+    ['horse', 'pony', 'stallion'],
+    ['cow', 'cattle', 'bull', 'calf'],
+    ['bird', 'pigeon', 'seagull', 'gull', 'duck', 'parrot'],
+    ['ocean', 'sea', 'beach', 'shore', 'coast', 'wave', 'surf'],
+    ['water', 'lake', 'river', 'pond', 'stream'],
+    ['street', 'road', 'avenue', 'highway', 'lane', 'intersection'],
+    ['city', 'town', 'downtown', 'urban'],
+    ['building', 'house', 'tower', 'skyscraper', 'home'],
+    ['field', 'grass', 'meadow', 'lawn', 'pasture'],
+    ['tree', 'forest', 'wood', 'jungle'],
+    ['mountain', 'hill', 'slope', 'peak'],
+    ['snow', 'ski', 'snowy', 'winter', 'ice'],
+    ['sky', 'cloud', 'sunset', 'sun'],
+    ['food', 'meal', 'dish', 'plate', 'dinner', 'lunch', 'breakfast'],
+    ['pizza', 'slice'],
+    ['cake', 'dessert', 'donut', 'pastry'],
+    ['fruit', 'banana', 'apple', 'orange'],
+    ['vegetable', 'broccoli', 'carrot', 'salad'],
+    ['kitchen', 'stove', 'oven', 'refrigerator', 'fridge'],
+    ['room', 'bedroom', 'bathroom', 'interior'],
+    ['bed', 'couch', 'sofa', 'chair', 'bench', 'seat'],
+    ['table', 'desk', 'counter'],
+    ['phone', 'cellphone', 'smartphone', 'mobile'],
+    ['computer', 'laptop', 'keyboard', 'monitor', 'screen'],
+    ['ball', 'frisbee', 'kite'],
+    ['play', 'game', 'sport', 'match'],
+    ['ride', 'riding', 'drive', 'driving'],
+    ['sit', 'sitting', 'seated'],
+    ['stand', 'standing'],
+    ['walk', 'walking', 'stroll', 'hike'],
+    ['run', 'running', 'jog', 'race'],
+    ['eat', 'eating', 'feed', 'graze'],
+    ['fly', 'flying', 'soar'],
+    ['red', 'crimson', 'scarlet'],
+    ['blue', 'navy', 'azure'],
+    ['green', 'emerald'],
+    ['big', 'large', 'huge', 'giant', 'tall'],
+    ['small', 'little', 'tiny'],
+]
+
+_TOKEN_RE = re.compile(r"[a-z]+")
+
+
+def _stem(word):
+    """Strip plural and -ing/-ed endings, so word forms share a stem (a light Porter-style stemmer)."""
+    if len(word) <= 3:
+        return word
+    if word.endswith('ies'):
+        word = word[:-3] + 'y'
+    elif word.endswith(('sses', 'ches', 'shes', 'xes', 'zes')):
+        word = word[:-2]
+    elif word.endswith('uses') and len(word) > 4 and word[-5] not in 'aeiou':
+        # buses -> bus, campuses -> campus (but houses -> house, causes -> cause)
+        word = word[:-2]
+    elif word.endswith('s') and not word.endswith(('ss', 'us', 'is')):
+        word = word[:-1]
+    for suffix in ('ing', 'ed'):
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            word = word[:-len(suffix)]
+            # running -> run, sitting -> sit
+            if len(word) > 3 and word[-1] == word[-2] and word[-1] not in 'lsz':
+                word = word[:-1]
+            break
+    return word
+
+
+def tokenize(text):
+    """Lowercased, stemmed words of text, without English stop words."""
+    return [_stem(word) for word in _TOKEN_RE.findall(text.lower()) if word not in ENGLISH_STOP_WORDS]
+
+
+def _synonym_table(groups):
+    table = {}
+    for group in groups:
+        stems = {_stem(word) for word in group}
+        for stem in stems:
+            table.setdefault(stem, set()).update(stems - {stem})
+    return table
+
+
+class CaptionMatcher:
+    """
+    Offline BM25 ranking of caption lists against a free-form description.
+
+    Document frequencies and the average document length are precomputed over a
+    COCO split, with each image's captions as one document, so even a handful
+    of caption lists are scored with meaningful term weights. Query words are
+    expanded with their SYNONYM_GROUPS synonyms, weighted by synonym_weight.
+
+    Parameters:
+    - caption_index (dict): {img_id: captions} of the split (CocoHandler.caption_index).
+    - k1, b (float): BM25 term-frequency saturation and length normalization.
+    - synonym_weight (float): Weight of synonym terms relative to the description's own words.
+    """
+
+    def __init__(self, caption_index, k1=BM25_K1, b=BM25_B, synonym_weight=SYNONYM_WEIGHT):
+        self.k1 = k1
+        self.b = b
+        self.synonym_weight = synonym_weight
+        self.synonyms = _synonym_table(SYNONYM_GROUPS)
+        self.document_frequency = Counter()
+        total_length = 0
+        for captions in caption_index.values():
+            tokens = tokenize(' '.join(captions))
+            total_length += len(tokens)
+            self.document_frequency.update(set(tokens))
+        self.n_documents = len(caption_index)
+        self.average_length = total_length / self.n_documents if self.n_documents else 1.0
+
+    def idf(self, term):
+        df = self.document_frequency.get(term, 0)
+        return math.log(1 + (self.n_documents - df + 0.5) / (df + 0.5))
+
+    def query_terms(self, description):
+        """{term: weight} of a description: its own words at 1, their synonyms at synonym_weight."""
+        terms = {}
+        for token in tokenize(description):
+            terms[token] = 1.0
+        for token in list(terms):
+            for synonym in self.synonyms.get(token, ()):
+                terms.setdefault(synonym, self.synonym_weight)
+        return terms
+
+    def score(self, terms, captions):
+        """BM25 score of one caption list (as one document) for weighted query terms."""
+        tokens = tokenize(' '.join(captions))
+        frequencies = Counter(tokens)
+        norm = self.k1 * (1 - self.b + self.b * len(tokens) / self.average_length)
+        score = 0.0
+        for term, weight in terms.items():
+            tf = frequencies.get(term)
+            if tf:
+                score += weight * self.idf(term) * tf * (self.k1 + 1) / (tf + norm)
+        return score
+
+    def rank(self, description, caption_lists):
+        """
+        Rank caption lists by how well they match description.
+
+        Parameters:
+        - description (str): The user's description.
+        - caption_lists (dict): {key: list of captions}, e.g. RVSession.get_crypto_caption_map().
+
+        Returns:
+        - list: (key, score) pairs, best match first.
+        """
+        terms = self.query_terms(description)
+        scores = [(key, self.score(terms, captions))
+                  for key, captions in caption_lists.items()]
+        return sorted(scores, key=lambda item: item[1], reverse=True)
@@ -3,11 +3,19 @@ from PIL import Image
 import matplotlib.patches as patches
 import matplotlib.pyplot as plt
 import numpy as np
-from pycocotools.coco import COCO
 import json
-
-import requests
-from diversity_handler import DiversityHandler
+import threading
+
+from config import DIVERSE_SET_CAPTION_CHECK
+from coco_snapshot import CocoSnapshot, snapshot_dir
+from diversity_handler import DiversityHandler, farthest_point_sampling
+from disk_image_cache import shared_disk_image_cache
+from palette_index import PaletteIndex
+from image_sampler import ImageSampler
+from entropy_pool import EntropyPool, rng_byte_source
+from caption_diversity import CaptionDiversity
+from caption_matcher import CaptionMatcher
+from candidate_pipeline import BatchPrefetcher, CandidatePipeline
 from gpt_handler import JSON_OUTPUT_PROMPT, LIST_OUTPUT_PROMPT, GPTHandler, extract_data_from_json_response
 
 # IMPORT QUANTUM RANDOM NUMBERS:
@@ -17,8 +25,9 @@ from gpt_handler import JSON_OUTPUT_PROMPT, LIST_OUTPUT_PROMPT, GPTHandler, extr
 
 # b. In the get_random_images method:
 # This method calls get_random_image in a loop, implying that the randomness in get_random_image is utilized multiple times here.
+# Draws are served from a buffer the quantum RNG fills in the background, see EntropyPool.
 from quantum_random import QuantumRandom
-random = QuantumRandom()
+random = EntropyPool(rng_byte_source(QuantumRandom()))
 
 DIVERSITY_CHECK_PROMPT = """
 Given a set of image captions, your task is to identify any that are too similar or not diverse enough in their descriptions. Diversity here refers to a broad representation of different scenes, objects, and activities. Redundant or overly similar captions can reduce the richness of the dataset and its usefulness for 
@@ -33,6 +42,10 @@ Task: Review the following list of image captions:
 Are all these captions diverse? If not, please identify the captions that are too similar or redundant and output ALL the captions TO-REMOVE (if n captions are similar, provide (n-1) captions TO-REMOVE). The goal is to maximize diversity in the image set. For good output: If diversity condition is satisfied, return {data_placeholder} (THIS IS SUPER IMPORTANT! Do not return `no` or `no captions` or the acceptable diverse list upond good output!). Follow ALL specified output formats!
 """
 
+# CocoHandler instances shared process-wide, by (data_dir, data_type)
+_shared_handlers = {}
+_shared_handlers_lock = threading.Lock()
+
 
 class CocoHandler:
     """
@@ -52,100 +65,297 @@ class CocoHandler:
         self.data_type = data_type
         # Construct the path to the annotation file
         self.ann_file = f'{self.data_dir}/annotations/captions_{self.data_type}.json'
-        # Initialize the COCO API with the annotation file
-        self.coco = COCO(self.ann_file)
+        # Load the annotations from their binary snapshot, built from the JSON file on first use
+        self.coco = CocoSnapshot.load_or_build(
+            self.ann_file, snapshot_dir(self.data_dir, self.data_type))
+        # Captions of every image: {img_id: tuple of captions}, read-only, decoded on first lookup
+        self.caption_index = self.coco.caption_index()
+        # TF-IDF model of all captions for the local diversity check, fitted on first use
+        self._caption_diversity = None
+        self._caption_diversity_lock = threading.Lock()
+        # BM25 statistics of all captions for local image matching, computed on first use
+        self._caption_matcher = None
+        self._caption_matcher_lock = threading.Lock()
+        # Precomputed palettes (built with `python palette_index.py`), None if not built
+        self.palette_index = PaletteIndex.load(self.data_dir, self.data_type)
+        # Palette extraction for every method of the handler
+        self.diversity_handler = DiversityHandler(
+            palette_index=self.palette_index, image_dir=f'{self.data_dir}/images/{self.data_type}')
+
+    @classmethod
+    def shared(cls, data_dir='./coco', data_type='val2017'):
+        """
+        The process-wide CocoHandler of a COCO split, created on first use.
 
-    def get_random_image(self, excluded_images=None):
+        Routes and sessions should use this rather than constructing their own handler.
+        The caption matcher of a new handler is built on a background thread right
+        away, so the first image match of a session does not pay for it.
         """
-        Fetches a random image and its associated captions from the COCO dataset, excluding images from the provided list.
+        with _shared_handlers_lock:
+            key = (data_dir, data_type)
+            if key not in _shared_handlers:
+                handler = cls(data_dir=data_dir, data_type=data_type)
+                threading.Thread(target=handler.caption_matcher,
+                                 name='caption-matcher-warmup', daemon=True).start()
+                _shared_handlers[key] = handler
+            return _shared_handlers[key]
+
+    def captions(self, img_id):
+        """The captions of an image, as a tuple (shared, do not rebuild it per call)."""
+        return self.caption_index[img_id]
+
+    def captions_many(self, img_ids):
+        """The caption tuples of several images, in the order of img_ids."""
+        return [self.caption_index[img_id] for img_id in img_ids]
+
+    def caption_diversity(self):
+        """The CaptionDiversity model of this split's captions, fitted once."""
+        with self._caption_diversity_lock:
+            if self._caption_diversity is None:
+                self._caption_diversity = CaptionDiversity.from_caption_index(
+                    self.caption_index)
+            return self._caption_diversity
+
+    def caption_matcher(self):
+        """The CaptionMatcher of this split's captions, built once."""
+        with self._caption_matcher_lock:
+            if self._caption_matcher is None:
+                self._caption_matcher = CaptionMatcher(self.caption_index)
+            return self._caption_matcher
+
+    def image_sampler(self, excluded_images=None):
+        """
+        A sampler drawing image ids without replacement from the whole split.
 
-        Parameters:
-        - excluded_images (set): A set of image IDs to be excluded from the selection.
+        Creating it costs O(len(excluded_images)); every draw and exclusion is O(1).
+        """
+        sampler = ImageSampler(self.coco.img_columns['id'], random,
+                               position_of=self.coco.img_position)
+        if excluded_images:
+            sampler.exclude_many(excluded_images)
+        return sampler
+
+    def load_image(self, img_id):
+        """
+        Loads an image's details, with its color palette, and its captions.
 
         Returns:
-        - img (dict): A dictionary containing details of the randomly selected image.
-        - captions (list): A list of captions associated with the selected image.
+        - img (dict): A dictionary containing details of the image.
+        - captions (list): A list of captions associated with the image.
         """
-        # Get a list of all image IDs in the dataset
-        img_ids = self.coco.getImgIds()
-        if excluded_images:
-            img_ids = [
-                img_id for img_id in img_ids if img_id not in excluded_images]
-        # Randomly select an image ID
-        selected_img_id = random.choice(img_ids)
-        # Load the image details using the selected image ID
-        img = self.coco.loadImgs(selected_img_id)[0]
-        # Get annotation IDs associated with the selected image
-        ann_ids = self.coco.getAnnIds(imgIds=selected_img_id)
-        # Load the annotations using the annotation IDs
-        anns = self.coco.loadAnns(ann_ids)
-        # Extract captions from the annotations
-        captions = [ann['caption'] for ann in anns]
+        # Load the image details using the image ID
+        img = self.coco.loadImgs(img_id)[0]
+        captions = list(self.captions(img_id))
 
         # Add color palette to the image object
-        diversity_handler = DiversityHandler()
-        color_palette = diversity_handler.extract_palette(img)
+        color_palette = self.diversity_handler.extract_palette(img)
         img['color_palette'] = color_palette
 
         return img, captions
 
-    def get_random_images(self, batch_size, excluded_images=None):
+    def get_random_image(self, excluded_images=None, sampler=None):
+        """
+        Fetches a random image and its associated captions from the COCO dataset, excluding images from the provided list.
+
+        Parameters:
+        - excluded_images (set): A set of image IDs to be excluded from the selection.
+        - sampler (ImageSampler): Draw from this sampler's pool instead (the image is removed from it).
+
+        Returns:
+        - img (dict): A dictionary containing details of the randomly selected image.
+        - captions (list): A list of captions associated with the selected image.
+        """
+        if sampler is None:
+            sampler = self.image_sampler(excluded_images)
+        return self.load_image(sampler.draw())
+
+    def get_random_images(self, batch_size, excluded_images=None, sampler=None):
         """
         Fetches a batch of random images ensuring they are unique.
 
         Parameters:
         - batch_size (int): Number of images to retrieve.
         - excluded_images (set): A set of image IDs to be excluded from the selection.
+        - sampler (ImageSampler): Draw from this sampler's pool instead (the images are removed from it).
 
         Returns:
         - list: List of unique image objects.
         """
-
+        if sampler is None:
+            sampler = self.image_sampler(excluded_images)
+        # Draws are distinct, so only the images actually returned get loaded
         selected_images = []
         selected_captions = []
+        for img_id in sampler.draw_many(batch_size):
+            image, captions = self.load_image(img_id)
+            selected_images.append(image)
+            selected_captions.append(captions)
 
-        while len(selected_images) < batch_size:
-            image, caption = self.get_random_image(
-                excluded_images=excluded_images)
+        return selected_images, selected_captions
 
-            if image not in selected_images:
-                selected_images.append(image)
-                selected_captions.append(caption)
+    def get_farthest_point_image_set(self, n, n_colors=3, pool_size=200):
+        """
+        Selects n images with mutually distant color palettes in a single pass.
 
-        return selected_images, selected_captions
+        Images are picked by farthest-point sampling over Lab palette vectors (the
+        n_colors most dominant colors of each palette): every pick maximizes the
+        distance to the closest image already picked. The first image is drawn
+        with the quantum random source, so the selection stays random.
+
+        Parameters:
+        - n (int): Number of images to select.
+        - n_colors (int): Number of dominant colors per palette vector.
+        - pool_size (int): Without a palette index, palettes are extracted for a random pool of this many images.
+
+        Returns:
+        - list: Selected image objects, with their 'color_palette'.
+        """
+        if self.palette_index is not None:
+            img_ids = self.palette_index.ids
+            vectors = self.palette_index.palette_vectors(n_colors)
+            kd_tree = self.palette_index.vector_tree(n_colors)
+            first = self.palette_index.row(random.choice(img_ids.tolist()))
+        else:
+            pool, _ = self.get_random_images(pool_size)
+            img_ids = [img['id'] for img in pool]
+            vectors = DiversityHandler.palette_vectors_of(
+                [img['color_palette'] for img in pool], n_colors=n_colors)
+            kd_tree = None
+            first = img_ids.index(random.choice(img_ids))
+
+        rows = farthest_point_sampling(vectors, n, first, kd_tree=kd_tree)
+        if self.palette_index is not None:
+            selected_images = self.coco.loadImgs(
+                [int(img_ids[row]) for row in rows])
+            for img in selected_images:
+                img['color_palette'] = self.diversity_handler.extract_palette(img)
+        else:
+            # The pool images already carry their palettes
+            selected_images = [pool[row] for row in rows]
+
+        if len(selected_images) < n:
+            raise Exception(
+                "Not enough distinct images to select a diverse set.")
+
+        return selected_images
+
+    def non_diverse_captions(self, captions, caption_check='gpt', gpt_handler=None, debug=False):
+        """
+        The captions of a batch to remove for the batch to be diverse.
+
+        Parameters:
+        - captions (list): One caption per image of the batch.
+        - caption_check (str): 'gpt' asks GPT with DIVERSITY_CHECK_PROMPT; 'local' uses the
+          offline CaptionDiversity check only; 'prefilter' runs the local check first and
+          asks GPT about the remaining captions only when the local check finds the batch borderline.
+        - gpt_handler (GPTHandler): Handler for the GPT requests, created if not given.
 
-    def get_diverse_image_set(self, n, max_attempts=50, buffer_multiplier=2, batch_size=10, use_local_images=True, debug=True, use_gpt=True, use_color=True, verbose=False):
-        diversity_handler = DiversityHandler()
+        Returns:
+        - list: The captions flagged as non-diverse.
+        """
+        if caption_check not in ('gpt', 'local', 'prefilter'):
+            raise ValueError(f"Unknown caption_check: {caption_check}")
+
+        flagged = []
+        if caption_check != 'gpt':
+            flagged, borderline = self.caption_diversity().check(captions)
+            if debug:
+                print(
+                    f"Local caption check flagged {len(flagged)} captions (borderline: {borderline}).")
+            if caption_check == 'local' or not borderline:
+                return flagged
+            captions = [caption for caption in captions if caption not in flagged]
+
+        full_prompt = ''.join([DIVERSITY_CHECK_PROMPT.format(captions=json.dumps(
+            captions), data_placeholder='{"data": []}'), LIST_OUTPUT_PROMPT, JSON_OUTPUT_PROMPT])
+        response_raw = (gpt_handler or GPTHandler()).get_response(full_prompt)
+        response_data = extract_data_from_json_response(response_raw)
+
+        if debug:
+            # Logging GPT raw response
+            print("GPT Response:", response_raw)
+
+        return flagged + list(response_data or [])
+
+    def get_diverse_image_set(self, n, max_attempts=50, buffer_multiplier=2, batch_size=10, use_local_images=True, debug=True, use_gpt=True, use_color=True, verbose=False, parallel_palettes=False, selection='rejection', caption_check=DIVERSE_SET_CAPTION_CHECK, prefetch_batches=2):
+        """
+        Selects n images with diverse color palettes and captions.
+
+        selection='rejection' samples random batches and checks them with the palette
+        and caption checks; selection='farthest_point' picks the images in one
+        pass with get_farthest_point_image_set (palettes only). farthest_point
+        uses only n: the batch, image source, caption and color check arguments
+        are ignored.
+        caption_check picks the caption check of each batch: 'gpt', 'local' or
+        'prefilter', see non_diverse_captions, or None for no caption check. It
+        defaults to DIVERSE_SET_CAPTION_CHECK, as for the sets of DiverseSetPool.
+        use_gpt=False keeps GPT out of it: 'gpt' is then skipped and 'prefilter'
+        runs as 'local', while 'local' is unaffected. Up to prefetch_batches batches are
+        drawn and color-checked ahead on a worker thread (0 runs everything inline).
+        """
+        if selection == 'farthest_point':
+            return self.get_farthest_point_image_set(n)
+        if selection != 'rejection':
+            raise ValueError(f"Unknown selection: {selection}")
+
+        if not use_gpt:
+            caption_check = {'gpt': None, 'prefilter': 'local'}.get(
+                caption_check, caption_check)
         gpt_handler = GPTHandler()
 
         selected_images = []
         selected_captions = []
-        excluded_images = set()  # Keep track of images to be excluded
+        non_diverse_captions = []
+        # Selected and caption-flagged images are drawn out of the pool for good, the
+        # rest of each batch is released back into it
+        sampler = self.image_sampler()
+        # Palettes, Lab values and captions of every drawn image, computed once and
+        # reused when a released image is drawn again
+        pipeline = CandidatePipeline(self, self.diversity_handler, use_local_images=use_local_images,
+                                     parallel=parallel_palettes)
+
+        def color_checked_batch():
+            """Draw the next batch and drop one image of each pair with similar palettes."""
+            batch = pipeline.candidates(sampler.draw_many(batch_size))
+            if not batch:
+                return None
+            batch_images = [candidate.img for candidate in batch]
+            batch_captions = [candidate.captions[0] for candidate in batch]
+
+            if use_color:
+                similar_pairs = pipeline.similar_pairs(batch)
+                if similar_pairs:
+                    # Swap out one image of each too-similar pair instead of discarding the whole batch
+                    dropped = set()
+                    for i, j in similar_pairs:
+                        if i not in dropped:
+                            dropped.add(j)
+                    for idx in dropped:
+                        sampler.release(batch_images[idx]['id'])
+                    batch_images = [img for idx, img in enumerate(
+                        batch_images) if idx not in dropped]
+                    batch_captions = [caption for idx, caption in enumerate(
+                        batch_captions) if idx not in dropped]
+                    if debug:
+                        print(
+                            f"Dropped {len(dropped)} images with similar color palettes.")
+            return batch_images, batch_captions
 
         attempts = 0
 
-        while len(selected_images) < n and attempts < max_attempts:
-            batch_images, batch_captions = self.get_random_images(
-                batch_size, excluded_images=excluded_images)
-            batch_captions = [captions[0] for captions in batch_captions]
-
-            if use_color and (not diversity_handler.is_diverse_colors(batch_images, use_local_images=use_local_images)):
-                attempts += 1
-                continue
-
-            if use_gpt:
-                full_prompt = ''.join([DIVERSITY_CHECK_PROMPT.format(captions=json.dumps(
-                    batch_captions), data_placeholder='{"data": []}'), LIST_OUTPUT_PROMPT, JSON_OUTPUT_PROMPT])
-                response_raw = gpt_handler.get_response(full_prompt)
-                response_data = extract_data_from_json_response(response_raw)
-
-                if debug:
-                    # Logging GPT raw response
-                    print("GPT Response:", response_raw)
+        # The next prefetch_batches batches are drawn and color-checked on a worker
+        # thread while the caption check of the current one waits on GPT
+        with BatchPrefetcher(color_checked_batch, depth=prefetch_batches) as batches:
+            for batch_images, batch_captions in batches:
+                response_data = self.non_diverse_captions(
+                    batch_captions, caption_check=caption_check, gpt_handler=gpt_handler, debug=debug) \
+                    if caption_check is not None else []
 
                 if not response_data:
-                    selected_images.extend(
-                        batch_images[:n-len(selected_images)])
+                    n_selected = n - len(selected_images)
+                    selected_images.extend(batch_images[:n_selected])
+                    for img in batch_images[n_selected:]:
+                        sampler.release(img['id'])
                     if debug:
                         print("All captions in the batch were found diverse.")
                 else:
@@ -157,22 +367,28 @@ class CocoHandler:
                                 print(
                                     f"Image {batch_images[idx]['id']} is selected.")
                         else:
-                            # Add the image to the excluded set
-                            excluded_images.add(batch_images[idx]['id'])
+                            # Leave the image out of the pool
                             if debug:
                                 print(
-                                    f"Caption '{caption}' flagged as non-diverse by GPT.")
+                                    f"Caption '{caption}' flagged as non-diverse.")
 
                         if len(selected_images) == n:
+                            for img in batch_images[idx + 1:]:
+                                sampler.release(img['id'])
                             break
 
                 attempts += 1
+                if len(selected_images) >= n or attempts >= max_attempts:
+                    break
+
+        if debug:
+            print(
+                f"Extracted {len(pipeline.extraction_counts)} palettes, at most {pipeline.max_extractions()} per image.")
 
         # Validation to ensure non-diverse captions flagged by GPT aren't in the final selection
-        for image in selected_images:
-            ann_ids = self.coco.getAnnIds(imgIds=image['id'])
-            anns = self.coco.loadAnns(ann_ids)
-            image_captions = [ann['caption'] for ann in anns]
+        selected_captions = self.captions_many(
+            [image['id'] for image in selected_images])
+        for image, image_captions in zip(selected_images, selected_captions):
             for cap in image_captions:
                 # Assert that none of the flagged captions are in the final selection
                 assert cap not in non_diverse_captions, f"Caption '{cap}' was flagged as non-diverse but still present in the final selection."
@@ -191,8 +407,8 @@ def display_image_with_colors(image_details, captions):
     print(f"image_details: {image_details}\n captions: {captions}")
 
     # Load the image from the provided URL
-    response = requests.get(image_details['coco_url'])
-    image = Image.open(io.BytesIO(response.content))
+    content = shared_disk_image_cache.get_bytes(image_details['coco_url'])
+    image = Image.open(io.BytesIO(content))
     image = np.array(image)
 
     # Create a new figure
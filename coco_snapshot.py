@@ -0,0 +1,355 @@
+import json
+import os
+from collections.abc import Mapping
+
+import numpy as np
+
+
+def snapshot_dir(data_dir, data_type):
+    return f'{data_dir}/snapshots/{data_type}'
+
+
+# Bumped whenever the on-disk layout changes, so old snapshots get rebuilt
+SNAPSHOT_VERSION = 3
+
+
+class _StringPool:
+    """Interns strings while a snapshot is built; each distinct string is stored once."""
+
+    def __init__(self):
+        self.codes = {}
+
+    def code(self, string):
+        return self.codes.setdefault(string, len(self.codes))
+
+    def arrays(self):
+        encoded = [string.encode('utf-8') for string in self.codes]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(data) for data in encoded], out=offsets[1:])
+        blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        return blob, offsets
+
+
+def _int_column(values):
+    column = np.array(values, dtype=np.int64)
+    if len(column) and np.iinfo(np.int32).min <= column.min() and column.max() <= np.iinfo(np.int32).max:
+        return column.astype(np.int32)
+    return column
+
+
+def _field_values(records, field, table):
+    values = []
+    for row, record in enumerate(records):
+        if field not in record:
+            raise ValueError(
+                f"{table} record {row} (id {record.get('id')}) has no '{field}' field")
+        values.append(record[field])
+    return values
+
+
+def _columns(records, fields, pool, table):
+    """
+    Columns of a list of JSON records: {name: array} plus {field: kind}.
+
+    Integers become the narrowest of int32/int64, other numbers float64. Strings are
+    split after their last '/' into a prefix and a remainder, both interned in
+    pool, so URLs share their host/directory prefix and a coco_url shares its
+    remainder with the file_name. Any other field (nulls, booleans, lists, mixed
+    types) is stored as interned JSON text, so its values load back with their types.
+
+    Raises:
+    - ValueError: If a record of table lacks one of fields.
+    """
+    columns, kinds = {}, {}
+    for field in fields:
+        values = _field_values(records, field, table)
+        if all(isinstance(value, int) and not isinstance(value, bool) for value in values):
+            columns[field], kinds[field] = _int_column(values), 'int'
+        elif all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in values):
+            columns[field], kinds[field] = np.array(
+                values, dtype=np.float64), 'float'
+        elif not all(isinstance(value, str) for value in values):
+            columns[f'{field}.json'] = np.array(
+                [pool.code(json.dumps(value)) for value in values], dtype=np.int32)
+            kinds[field] = 'json'
+        else:
+            splits = [value.rpartition('/') for value in values]
+            columns[f'{field}.prefix'] = np.array(
+                [pool.code(head + sep) for head, sep, _ in splits], dtype=np.int32)
+            columns[f'{field}.rest'] = np.array(
+                [pool.code(tail) for _, _, tail in splits], dtype=np.int32)
+            kinds[field] = 'str'
+    return columns, kinds
+
+
+class CocoSnapshot:
+    """
+    Binary, memory-mapped snapshot of a COCO captions annotation file.
+
+    The image and annotation tables are stored column by column as .npy files,
+    together with the id indexes pycocotools rebuilds on every start:
+    - numeric fields as contiguous int32/int64/float64 arrays
+    - string fields (captions, URLs, file names) as codes into one pool of
+      interned strings, kept as a UTF-8 blob with offsets
+    - any other field (nulls, booleans, lists, mixed types) as codes of its
+      JSON text in the same pool
+    - image and annotation ids sorted, with the rows they map to
+    - annotation rows grouped by image, with per-image offsets
+
+    Loading maps the files instead of parsing JSON, and records are only turned
+    into dicts when they are asked for. The getImgIds/loadImgs/getAnnIds/loadAnns
+    methods mirror the pycocotools COCO ones the rest of the code uses.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(f'{path}/meta.json', 'r') as file:
+            self.meta = json.load(file)
+        self.img_kinds = self.meta['img_fields']
+        self.ann_kinds = self.meta['ann_fields']
+        self.img_columns = self._load_columns('img', self.img_kinds)
+        self.ann_columns = self._load_columns('ann', self.ann_kinds)
+        self.strings_blob = self._load('strings_blob')
+        self.strings_offsets = self._load('strings_offsets')
+        self.img_ids_sorted = self._load('img_ids_sorted')
+        self.img_rows_sorted = self._load('img_rows_sorted')
+        self.ann_ids_sorted = self._load('ann_ids_sorted')
+        self.ann_rows_sorted = self._load('ann_rows_sorted')
+        self.ann_rows_by_img = self._load('ann_rows_by_img')
+        self.img_ann_offsets = self._load('img_ann_offsets')
+        self._img_positions = None
+
+    def _load_columns(self, table, kinds):
+        columns = {}
+        for field, kind in kinds.items():
+            names = {'str': [f'{field}.prefix', f'{field}.rest'],
+                     'json': [f'{field}.json']}.get(kind, [field])
+            for name in names:
+                columns[name] = self._load(f'{table}_{name}')
+        return columns
+
+    def _load(self, name):
+        return np.load(f'{self.path}/{name}.npy', mmap_mode='r')
+
+    @staticmethod
+    def _lookup(ids_sorted, rows_sorted, ids):
+        positions = np.searchsorted(ids_sorted, ids)
+        positions = np.minimum(positions, len(ids_sorted) - 1)
+        found = ids_sorted[positions] == ids
+        if not np.all(found):
+            raise KeyError(np.asarray(ids)[~found].tolist())
+        return rows_sorted[positions]
+
+    def img_rows(self, ids):
+        """Rows of the image table for image ids."""
+        return self._lookup(self.img_ids_sorted, self.img_rows_sorted, np.asarray(ids, dtype=np.int64))
+
+    def ann_rows(self, ids):
+        """Rows of the annotation table for annotation ids."""
+        return self._lookup(self.ann_ids_sorted, self.ann_rows_sorted, np.asarray(ids, dtype=np.int64))
+
+    def img_position(self, img_id):
+        """Index of img_id in getImgIds() (file order), or None if there is no such image. O(1)."""
+        if self._img_positions is None:
+            # Dense id -> row table, built on first use (ids are small non-negative integers)
+            ids = np.asarray(self.img_columns['id'])
+            positions = np.full(int(ids.max(initial=-1)) + 1, -1, dtype=np.int32)
+            positions[ids] = np.arange(len(ids), dtype=np.int32)
+            self._img_positions = positions
+        if not 0 <= img_id < len(self._img_positions) or self._img_positions[img_id] < 0:
+            return None
+        return int(self._img_positions[img_id])
+
+    def string(self, code):
+        """The interned string with the given code."""
+        start, end = self.strings_offsets[code], self.strings_offsets[code + 1]
+        return self.strings_blob[start:end].tobytes().decode('utf-8')
+
+    def _record(self, columns, kinds, row):
+        record = {}
+        for field, kind in kinds.items():
+            if kind == 'str':
+                record[field] = self.string(columns[f'{field}.prefix'][row]) + \
+                    self.string(columns[f'{field}.rest'][row])
+            elif kind == 'json':
+                record[field] = json.loads(
+                    self.string(columns[f'{field}.json'][row]))
+            else:
+                record[field] = columns[field][row].item()
+        return record
+
+    def caption_index(self, field='caption'):
+        """
+        {image id: tuple of its annotations' field values}, in file order per image.
+
+        A CaptionIndex: the values are decoded from the memory-mapped columns
+        when they are asked for, not copied into a dict up front.
+        """
+        return CaptionIndex(self, field)
+
+    def getImgIds(self, imgIds=[]):
+        """All image ids in file order, or the distinct ids of imgIds."""
+        if _is_array_like(imgIds) and len(imgIds) == 0:
+            return self.img_columns['id'].tolist()
+        return list(set(imgIds if _is_array_like(imgIds) else [imgIds]))
+
+    def loadImgs(self, ids=[]):
+        ids = ids if _is_array_like(ids) else [ids]
+        return [self._record(self.img_columns, self.img_kinds, row) for row in self.img_rows(ids).tolist()]
+
+    def getAnnIds(self, imgIds=[]):
+        """Annotation ids of the given images (in file order per image), or all of them."""
+        imgIds = imgIds if _is_array_like(imgIds) else [imgIds]
+        if len(imgIds) == 0:
+            return self.ann_columns['id'].tolist()
+        known = [img_id for img_id in imgIds if img_id in self]
+        rows = []
+        for img_row in self.img_rows(known).tolist() if known else []:
+            start, end = self.img_ann_offsets[img_row], self.img_ann_offsets[img_row + 1]
+            rows.extend(self.ann_rows_by_img[start:end].tolist())
+        return self.ann_columns['id'][rows].tolist()
+
+    def loadAnns(self, ids=[]):
+        ids = ids if _is_array_like(ids) else [ids]
+        return [self._record(self.ann_columns, self.ann_kinds, row) for row in self.ann_rows(ids).tolist()]
+
+    def __contains__(self, img_id):
+        position = np.searchsorted(self.img_ids_sorted, img_id)
+        return position < len(self.img_ids_sorted) and self.img_ids_sorted[position] == img_id
+
+    @classmethod
+    def build(cls, ann_file, path):
+        """Parse ann_file once and write its snapshot to path."""
+        with open(ann_file, 'r') as file:
+            dataset = json.load(file)
+        images, annotations = dataset['images'], dataset['annotations']
+
+        img_fields = list(images[0].keys()) if images else ['id']
+        ann_fields = list(annotations[0].keys()) if annotations else [
+            'id', 'image_id']
+        pool = _StringPool()
+        img_columns, img_kinds = _columns(images, img_fields, pool, 'image')
+        ann_columns, ann_kinds = _columns(
+            annotations, ann_fields, pool, 'annotation')
+        strings_blob, strings_offsets = pool.arrays()
+
+        img_rows_sorted = np.argsort(img_columns['id'], kind='stable')
+        ann_rows_sorted = np.argsort(ann_columns['id'], kind='stable')
+
+        # Group annotation rows by image, keeping file order within an image
+        img_row_of_ann = img_rows_sorted[np.searchsorted(
+            img_columns['id'][img_rows_sorted], ann_columns['image_id'])]
+        ann_rows_by_img = np.argsort(img_row_of_ann, kind='stable')
+        img_ann_offsets = np.zeros(len(images) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(img_row_of_ann, minlength=len(images)),
+                  out=img_ann_offsets[1:])
+
+        os.makedirs(path, exist_ok=True)
+        # meta.json is written last, so a half-written snapshot is never loaded
+        if os.path.exists(f'{path}/meta.json'):
+            os.remove(f'{path}/meta.json')
+        for name, column in img_columns.items():
+            np.save(f'{path}/img_{name}.npy', column)
+        for name, column in ann_columns.items():
+            np.save(f'{path}/ann_{name}.npy', column)
+        np.save(f'{path}/strings_blob.npy', strings_blob)
+        np.save(f'{path}/strings_offsets.npy', strings_offsets)
+        np.save(f'{path}/img_ids_sorted.npy',
+                img_columns['id'][img_rows_sorted])
+        np.save(f'{path}/img_rows_sorted.npy', img_rows_sorted)
+        np.save(f'{path}/ann_ids_sorted.npy',
+                ann_columns['id'][ann_rows_sorted])
+        np.save(f'{path}/ann_rows_sorted.npy', ann_rows_sorted)
+        np.save(f'{path}/ann_rows_by_img.npy', ann_rows_by_img)
+        np.save(f'{path}/img_ann_offsets.npy', img_ann_offsets)
+        with open(f'{path}/meta.json', 'w') as file:
+            json.dump({'version': SNAPSHOT_VERSION, 'img_fields': img_kinds, 'ann_fields': ann_kinds,
+                       'source': _source_signature(ann_file)}, file)
+        return cls(path)
+
+    @classmethod
+    def load_or_build(cls, ann_file, path):
+        """Load the snapshot at path, (re)building it if it is missing or older than ann_file."""
+        try:
+            with open(f'{path}/meta.json', 'r') as file:
+                meta = json.load(file)
+            if meta.get('version') == SNAPSHOT_VERSION and meta.get('source') == _source_signature(ann_file):
+                return cls(path)
+        except FileNotFoundError:
+            pass
+        return cls.build(ann_file, path)
+
+
+class CaptionIndex(Mapping):
+    """
+    Read-only {image id: tuple of captions} view of a CocoSnapshot, decoded lazily.
+
+    An image's captions are decoded from the annotation columns the first time
+    they are looked up and then cached, so only the images a process actually
+    uses take memory. values() and items() stream every image without adding
+    it to the cache, for one-off passes over the whole split (e.g. fitting a
+    model on all captions).
+    """
+
+    def __init__(self, snapshot, field='caption'):
+        self.snapshot = snapshot
+        self.field = field
+        self._prefixes = snapshot.ann_columns[f'{field}.prefix']
+        self._rests = snapshot.ann_columns[f'{field}.rest']
+        # image id -> captions of the images looked up so far
+        self._cache = {}
+
+    def _decode(self, img_row):
+        start, end = self.snapshot.img_ann_offsets[img_row:img_row + 2]
+        rows = self.snapshot.ann_rows_by_img[start:end]
+        string = self.snapshot.string
+        return tuple(string(prefix) + string(rest)
+                     for prefix, rest in zip(self._prefixes[rows].tolist(), self._rests[rows].tolist()))
+
+    def __getitem__(self, img_id):
+        captions = self._cache.get(img_id)
+        if captions is None:
+            if img_id not in self.snapshot:
+                raise KeyError(img_id)
+            captions = self._cache.setdefault(
+                img_id, self._decode(int(self.snapshot.img_rows([img_id])[0])))
+        return captions
+
+    def __contains__(self, img_id):
+        return img_id in self.snapshot
+
+    def __iter__(self):
+        return iter(self.snapshot.img_columns['id'].tolist())
+
+    def __len__(self):
+        return len(self.snapshot.img_ids_sorted)
+
+    def items(self):
+        """(image id, captions) of every image in file order, without caching them."""
+        # One pass over the columns, reading the string pool as one block
+        blob = self.snapshot.strings_blob.tobytes()
+        offsets = self.snapshot.strings_offsets.tolist()
+        rows = np.asarray(self.snapshot.ann_rows_by_img)
+        prefixes = self._prefixes[rows].tolist()
+        rests = self._rests[rows].tolist()
+        bounds = self.snapshot.img_ann_offsets.tolist()
+        for row, img_id in enumerate(self.snapshot.img_columns['id'].tolist()):
+            captions = self._cache.get(img_id)
+            if captions is None:
+                captions = tuple(
+                    (blob[offsets[prefix]:offsets[prefix + 1]] + blob[offsets[rest]:offsets[rest + 1]]).decode('utf-8')
+                    for prefix, rest in zip(prefixes[bounds[row]:bounds[row + 1]], rests[bounds[row]:bounds[row + 1]]))
+            yield img_id, captions
+
+    def values(self):
+        """The captions of every image in file order, without caching them."""
+        return (captions for _, captions in self.items())
+
+
+def _source_signature(ann_file):
+    stat = os.stat(ann_file)
+    return [stat.st_size, stat.st_mtime]
+
+
+def _is_array_like(obj):
+    return hasattr(obj, '__iter__') and hasattr(obj, '__len__')
@@ -6,3 +6,83 @@ ALL_CRYPTO_PAIRS = ['BTC/USDT', 'ETH/USDT', 'BNB/USDT', 'NEO/USDT', 'LTC/USDT',
                     'CAKE/USDT', 'ACM/USDT', 'BADGER/USDT', 'FIS/USDT', 'OM/USDT', 'POND/USDT', 'DEGO/USDT', 'ALICE/USDT', 'LINA/USDT', 'PERP/USDT', 'SUPER/USDT', 'CFX/USDT', 'TKO/USDT', 'PUNDIX/USDT', 'TLM/USDT', 'BAR/USDT', 'FORTH/USDT', 'BAKE/USDT', 'BURGER/USDT', 'SLP/USDT', 'SHIB/USDT', 'ICP/USDT', 'AR/USDT', 'POLS/USDT', 'MDX/USDT', 'MASK/USDT', 'LPT/USDT', 'XVG/USDT', 'ATA/USDT', 'GTC/USDT', 'ERN/USDT', 'KLAY/USDT', 'PHA/USDT', 'BOND/USDT', 'MLN/USDT', 'DEXE/USDT', 'C98/USDT', 'CLV/USDT', 'QNT/USDT', 'FLOW/USDT', 'TVK/USDT', 'MINA/USDT', 'RAY/USDT', 'FARM/USDT', 'ALPACA/USDT', 'QUICK/USDT', 'MBOX/USDT', 'FOR/USDT', 'REQ/USDT', 'GHST/USDT', 'WAXP/USDT', 'GNO/USDT', 'XEC/USDT', 'ELF/USDT', 'DYDX/USDT', 'IDEX/USDT', 'VIDT/USDT', 'USDP/USDT', 'GALA/USDT', 'ILV/USDT', 'YGG/USDT', 'SYS/USDT', 'DF/USDT', 'FIDA/USDT', 'FRONT/USDT', 'CVP/USDT', 'AGLD/USDT', 'RAD/USDT', 'BETA/USDT', 'RARE/USDT', 'LAZIO/USDT', 'CHESS/USDT', 'ADX/USDT', 'AUCTION/USDT', 'DAR/USDT', 'BNX/USDT', 'MOVR/USDT', 'CITY/USDT', 'ENS/USDT', 'KP3R/USDT', 'QI/USDT', 'PORTO/USDT', 'POWR/USDT', 'VGX/USDT', 'JASMY/USDT', 'AMP/USDT', 'PLA/USDT', 'PYR/USDT', 'RNDR/USDT', 'ALCX/USDT', 'SANTOS/USDT', 'MC/USDT', 'BICO/USDT', 'FLUX/USDT', 'FXS/USDT', 'VOXEL/USDT', 'HIGH/USDT', 'CVX/USDT', 'PEOPLE/USDT', 'OOKI/USDT', 'SPELL/USDT', 'JOE/USDT', 'ACH/USDT', 'IMX/USDT', 'GLMR/USDT', 'LOKA/USDT', 'SCRT/USDT', 'API3/USDT', 'BTTC/USDT', 'ACA/USDT', 'XNO/USDT', 'WOO/USDT', 'ALPINE/USDT', 'T/USDT', 'ASTR/USDT', 'GMT/USDT', 'KDA/USDT', 'APE/USDT', 'BSW/USDT', 'BIFI/USDT', 'MULTI/USDT', 'STEEM/USDT', 'MOB/USDT', 'NEXO/USDT', 'REI/USDT', 'GAL/USDT', 'LDO/USDT', 'EPX/USDT', 'OP/USDT', 'LEVER/USDT', 'STG/USDT', 'LUNC/USDT', 'GMX/USDT', 'POLYX/USDT', 'APT/USDT', 'OSMO/USDT', 'HFT/USDT', 'PHB/USDT', 'HOOK/USDT', 'MAGIC/USDT', 'HIFI/USDT', 'RPL/USDT', 'PROS/USDT', 'AGIX/USDT', 'GNS/USDT', 'SYN/USDT', 'VIB/USDT', 'SSV/USDT', 'LQTY/USDT', 'AMB/USDT', 'BETH/USDT', 'USTC/USDT', 'GAS/USDT', 'GLM/USDT', 'PROM/USDT', 'QKC/USDT', 'UFT/USDT', 'ID/USDT', 'ARB/USDT', 'LOOM/USDT', 'OAX/USDT', 'RDNT/USDT', 'WBTC/USDT', 'EDU/USDT', 'SUI/USDT', 'AERGO/USDT', 'PEPE/USDT', 'FLOKI/USDT', 'AST/USDT', 'SNT/USDT', 'COMBO/USDT', 'MAV/USDT', 'PENDLE/USDT', 'ARKM/USDT', 'WBETH/USDT', 'WLD/USDT', 'FDUSD/USDT', 'SEI/USDT', 'CYBER/USDT']
 
 # Settings related to the Flask app, database connections, etc. can also be added here
+
+# Memory budget (in bytes) of the decoded-image cache shared by all DiversityHandlers
+IMAGE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# Scale (1, 2, 4 or 8) at which JPEGs are decoded for palette extraction; 1 decodes at full resolution.
+# At 1/2 the palette colors move by a mean deltaE of about 5, a tenth of the deltaE 50 from which two
+# palettes count as similar, while a cached image takes a quarter of the memory
+PALETTE_DECODE_REDUCTION = 2
+
+# Remote image fetching: per-request timeout (seconds), retries and concurrent downloads
+IMAGE_FETCH_TIMEOUT = 10
+IMAGE_FETCH_RETRIES = 3
+IMAGE_FETCH_MAX_WORKERS = 8
+
+# On-disk cache of downloaded COCO images: location and size cap (in bytes)
+IMAGE_DISK_CACHE_DIR = './image_cache'
+IMAGE_DISK_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+# Only images under this prefix are served through the app's cached-image route
+COCO_IMAGE_URL_PREFIX = 'http://images.cocodataset.org/'
+
+# Entropy pool in front of the quantum RNG: bytes fetched per request, refill threshold (in bytes),
+# and seconds a draw waits for the source before falling back to os.urandom (None to always wait)
+ENTROPY_POOL_BLOCK_BYTES = 4096
+ENTROPY_POOL_LOW_WATER_BYTES = 1024
+ENTROPY_POOL_FALLBACK_TIMEOUT = 0.5
+
+# Local caption diversity check: TF-IDF cosine similarity from which two captions count as
+# near-duplicates, and from which a pair of kept captions is borderline (sent to GPT when pre-filtering)
+CAPTION_DUPLICATE_SIMILARITY = 0.5
+CAPTION_BORDERLINE_SIMILARITY = 0.3
+
+# Caption check of diverse image sets, whether generated inline or by the pool: 'local' keeps
+# it offline, 'prefilter' sends borderline batches to GPT and 'gpt' sends every batch
+DIVERSE_SET_CAPTION_CHECK = 'local'
+# Background pool of ready diverse image sets: set sizes (n_cryptos) kept ready, sets per size,
+# and seconds before retrying after a failed generation
+DIVERSE_SET_POOL_SIZES = [2, 3, 4, 5]
+DIVERSE_SET_POOL_CAPACITY = 2
+DIVERSE_SET_POOL_RETRY_DELAY = 30
+
+# Persistent GPT response cache: SQLite file, entry lifetime (seconds, None to keep forever)
+# and size cap of the stored responses (in bytes)
+GPT_CACHE_PATH = './gpt_cache/responses.sqlite3'
+GPT_CACHE_TTL = 7 * 24 * 3600
+GPT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Number of g4f providers each GPT prompt is sent to at once (the first parseable answer wins); 1 disables racing
+GPT_RACE_PROVIDERS = 3
+
+# g4f provider health: deadline of each call (seconds), calls in the rolling stats window,
+# consecutive failures that open a provider's circuit breaker and how long (seconds) it stays open
+GPT_CALL_TIMEOUT = 60
+GPT_HEALTH_WINDOW = 50
+GPT_BREAKER_FAILURES = 3
+GPT_BREAKER_COOLDOWN = 120
+
+# Threads running g4f requests, shared by every GPTHandler; requests hung in g4f hold a thread
+# until the provider gives up, so this caps how many of them can pile up
+GPT_REQUEST_THREADS = 16
+
+# Latency leaderboard written by GPTHandler.test_providers
+GPT_LEADERBOARD_PATH = './gpt_cache/provider_leaderboard.json'
+
+# Local image matching: BM25 parameters, weight of synonym terms, and the relative gap between
+# the two best local scores below which GPT is asked to decide
+BM25_K1 = 1.5
+BM25_B = 0.75
+SYNONYM_WEIGHT = 0.5
+IMAGE_MATCH_GPT_MARGIN = 0.15
+
+# Image match coalescing: seconds GPT image matches of concurrent sessions are gathered for,
+# and the most sessions sent in one prompt
+IMAGE_MATCH_BATCH_WINDOW = 0.25
+IMAGE_MATCH_BATCH_SIZE = 8
+
+# Per-operator RV sessions kept by the web app: most sessions in memory, and seconds without a
+# request after which an operator's session is dropped
+RV_SESSIONS_MAX = 256
+RV_SESSION_IDLE_TIMEOUT = 24 * 3600
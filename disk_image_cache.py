@@ -0,0 +1,167 @@
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import cv2
+
+from config import IMAGE_DISK_CACHE_DIR, IMAGE_DISK_CACHE_MAX_BYTES
+from image_fetcher import REDUCED_DECODE_FLAGS, decode_image, shared_image_fetcher
+
+
+class DiskImageCache:
+    """
+    Content-addressed on-disk cache of downloaded images, keyed by the SHA-256 of the URL.
+
+    Files are written atomically (temporary file + rename), so a crash never leaves
+    a truncated image behind. Reads refresh a file's mtime, and once the cache
+    exceeds max_bytes the least recently used files are deleted. The recency
+    order is kept in memory (seeded from the mtimes when the cache is opened),
+    so eviction does not rescan the directory. For palette work
+    a JPEG thumbnail decoded at 1/reduction scale can be stored next to the original.
+    """
+
+    def __init__(self, cache_dir=IMAGE_DISK_CACHE_DIR, max_bytes=IMAGE_DISK_CACHE_MAX_BYTES, fetcher=shared_image_fetcher):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.fetcher = fetcher
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # file name -> size of the cached files, least recently used first
+        self._files = OrderedDict()
+        if os.path.isdir(cache_dir):
+            entries = sorted((entry for entry in os.scandir(cache_dir)
+                              if entry.is_file() and not entry.name.startswith('.tmp')),
+                             key=lambda entry: entry.stat().st_mtime)
+            for entry in entries:
+                self._files[entry.name] = entry.stat().st_size
+        self.current_bytes = sum(self._files.values())
+
+    def path(self, url, reduction=1):
+        """Path of the cached file of url (or of its 1/reduction thumbnail)."""
+        digest = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        suffix = '' if reduction == 1 else f'.thumb{reduction}'
+        return os.path.join(self.cache_dir, f'{digest}{suffix}.jpg')
+
+    def _read(self, path):
+        try:
+            with open(path, 'rb') as file:
+                content = file.read()
+        except FileNotFoundError:
+            return None
+        name = os.path.basename(path)
+        with self._lock:
+            # Mark as recently used for eviction
+            if name in self._files:
+                self._files.move_to_end(name)
+        try:
+            # ... and on disk, for the order the next process starts with
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return content
+
+    def _write(self, path, content):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(content)
+            name = os.path.basename(path)
+            with self._lock:
+                os.replace(tmp_path, path)
+                # Another thread may have stored the same URL meanwhile
+                replaced = self._files.pop(name, 0)
+                self._files[name] = len(content)
+                self.current_bytes += len(content) - replaced
+                if self.current_bytes > self.max_bytes:
+                    self._evict()
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _evict(self):
+        """Delete least recently used files until the cache is within max_bytes. Holds the lock."""
+        while self.current_bytes > self.max_bytes and self._files:
+            name, size = self._files.popitem(last=False)
+            self.current_bytes -= size
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                continue
+            self.evictions += 1
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get_bytes(self, url):
+        """The encoded image at url, downloaded only if it is not cached."""
+        return self.get_many_bytes([url])[0]
+
+    def get_many_bytes(self, urls):
+        """Encoded images of urls, downloading the uncached ones concurrently."""
+        contents = [self._read(self.path(url)) for url in urls]
+        missing = [i for i, content in enumerate(contents) if content is None]
+        for content in contents:
+            self._count(hit=content is not None)
+        if missing:
+            downloaded = self.fetcher.fetch_many([urls[i] for i in missing])
+            for i, content in zip(missing, downloaded):
+                self._write(self.path(urls[i]), content)
+                contents[i] = content
+        return contents
+
+    def get_image(self, url, reduction=1):
+        """The image at url as an RGB array, decoded at 1/reduction scale."""
+        return self.get_images([url], reduction)[0]
+
+    def get_images(self, urls, reduction=1):
+        """
+        RGB arrays of the images at urls, decoded at 1/reduction scale.
+
+        With reduction > 1 a compressed thumbnail is cached alongside the original,
+        so later reads decode the small file only.
+        """
+        if reduction == 1:
+            return [decode_image(content) for content in self.get_many_bytes(urls)]
+
+        images = [None] * len(urls)
+        missing = []
+        for i, url in enumerate(urls):
+            content = self._read(self.path(url, reduction))
+            if content is None:
+                missing.append(i)
+            else:
+                self._count(hit=True)
+                images[i] = decode_image(content)
+        if missing:
+            originals = self.get_many_bytes([urls[i] for i in missing])
+            for i, content in zip(missing, originals):
+                images[i] = decode_image(content, REDUCED_DECODE_FLAGS[reduction])
+                _, thumbnail = cv2.imencode(
+                    '.jpg', cv2.cvtColor(images[i], cv2.COLOR_RGB2BGR), [cv2.IMWRITE_JPEG_QUALITY, 90])
+                self._write(self.path(urls[i], reduction), thumbnail.tobytes())
+        return images
+
+    def stats(self):
+        """Counters and disk use of the cache."""
+        with self._lock:
+            return {
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+# On-disk image cache shared by all remote image reads in the process
+shared_disk_image_cache = DiskImageCache()
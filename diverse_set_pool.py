@@ -0,0 +1,170 @@
+import json
+import os
+import tempfile
+import threading
+from collections import deque
+
+from config import (DIVERSE_SET_POOL_CAPACITY, DIVERSE_SET_POOL_RETRY_DELAY,
+                    DIVERSE_SET_POOL_SIZES)
+
+
+def diverse_set_pool_path(data_dir, data_type):
+    return f'{data_dir}/diverse_sets/{data_type}.json'
+
+
+class DiverseSetPool:
+    """
+    Bounded pool of ready diverse image sets, filled by a background thread.
+
+    For each set size in sizes, up to capacity sets made by
+    CocoHandler.get_diverse_image_set are kept ready, so a session can start
+    without waiting for the palette and caption checks. The producer refills
+    the size with the fewest ready sets first, and when generating a set fails
+    (e.g. max_attempts runs out) it retries after retry_delay seconds.
+
+    The pool is saved to path (written atomically) whenever it changes and
+    loaded back on start, so ready sets survive restarts. A taken set is never
+    handed out again.
+
+    Parameters:
+    - coco_handler (CocoHandler): Handler generating the sets.
+    - sizes (list): Set sizes (n_cryptos values) to keep ready.
+    - capacity (int): Ready sets kept per size.
+    - path (str): JSON file the pool is saved to, defaults to one per COCO split.
+    - generate_kwargs (dict): Extra keyword arguments for get_diverse_image_set. Its caption
+      check defaults to DIVERSE_SET_CAPTION_CHECK, the same as an inline generation.
+    """
+
+    def __init__(self, coco_handler, sizes=DIVERSE_SET_POOL_SIZES, capacity=DIVERSE_SET_POOL_CAPACITY, path=None,
+                 generate_kwargs=None, retry_delay=DIVERSE_SET_POOL_RETRY_DELAY):
+        self.coco_handler = coco_handler
+        self.sizes = list(sizes)
+        self.capacity = capacity
+        self.path = path or diverse_set_pool_path(
+            coco_handler.data_dir, coco_handler.data_type)
+        self.generate_kwargs = dict({'debug': False}, **(generate_kwargs or {}))
+        self.retry_delay = retry_delay
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+        self._sets = {size: deque() for size in self.sizes}
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread = None
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as file:
+                saved = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return
+        for size, image_sets in saved.items():
+            if int(size) in self._sets:
+                for image_set in image_sets[:self.capacity]:
+                    self._sets[int(size)].append(
+                        [_restore_palette(img) for img in image_set])
+
+    def _save(self):
+        """Write the pool to path; called with the lock held."""
+        directory = os.path.dirname(self.path) or '.'
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as file:
+                json.dump({str(size): list(image_sets)
+                          for size, image_sets in self._sets.items()}, file)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def start(self):
+        """Start the producer thread (once)."""
+        with self._condition:
+            if self._thread is None:
+                self._stopped = False
+                self._thread = threading.Thread(
+                    target=self._produce, name='diverse-set-pool', daemon=True)
+                self._thread.start()
+        return self
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+
+    def _next_size(self):
+        """The size with the fewest ready sets, or None if the pool is full."""
+        size = min(self.sizes, key=lambda size: len(self._sets[size]))
+        return size if len(self._sets[size]) < self.capacity else None
+
+    def _produce(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: self._stopped or self._next_size() is not None)
+                if self._stopped:
+                    return
+                size = self._next_size()
+            try:
+                image_set = self.coco_handler.get_diverse_image_set(
+                    n=size, **self.generate_kwargs)
+            except Exception as e:
+                print(f"Diverse set pool: generating a set of {size} failed: {e}")
+                with self._condition:
+                    self.failures += 1
+                    self._condition.wait(timeout=self.retry_delay)
+                continue
+            with self._condition:
+                self._sets[size].append(image_set)
+                self._save()
+                self._condition.notify_all()
+
+    def take(self, n, timeout=0):
+        """
+        Remove and return a ready set of n images, or None.
+
+        Parameters:
+        - n (int): Number of images of the set.
+        - timeout (float): Seconds to wait for the producer when no set of n is ready (None waits indefinitely).
+
+        Returns:
+        - list: Image objects with their 'color_palette', as get_diverse_image_set returns them, or None
+          if n is not a pooled size or no set became ready in time.
+        """
+        with self._condition:
+            if n not in self._sets:
+                self.misses += 1
+                return None
+            if not self._sets[n] and timeout != 0 and self._thread is not None:
+                self._condition.wait_for(
+                    lambda: self._stopped or self._sets[n], timeout=timeout)
+            if not self._sets[n]:
+                self.misses += 1
+                return None
+            self.hits += 1
+            image_set = self._sets[n].popleft()
+            self._save()
+            # Wake the producer to replace the set
+            self._condition.notify_all()
+            return image_set
+
+    def stats(self):
+        """Ready sets per size and take counters."""
+        with self._condition:
+            return {
+                "ready": {size: len(image_sets) for size, image_sets in self._sets.items()},
+                "capacity": self.capacity,
+                "hits": self.hits,
+                "misses": self.misses,
+                "failures": self.failures,
+            }
+
+
+def _restore_palette(img):
+    """Turn the palette colors of an image loaded from JSON back into tuples."""
+    if img.get('color_palette') is not None:
+        img['color_palette'] = [(tuple(color), dominance)
+                                for color, dominance in img['color_palette']]
+    return img
@@ -1,28 +1,214 @@
+import heapq
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 from skimage.segmentation import slic
 from skimage.color import rgb2lab, deltaE_cie76
 from scipy.spatial import KDTree
-import requests
 import numpy as np
 import cv2
 from sklearn.cluster import KMeans
 
+from config import PALETTE_DECODE_REDUCTION
+from image_cache import shared_image_cache
+from disk_image_cache import shared_disk_image_cache
+from image_fetcher import REDUCED_DECODE_FLAGS
+
 
-def read_image_from_file_name(file_name):
-    path = f"./coco/images/val2017/{file_name}"
-    image = cv2.imread(path)
+def read_image_from_file_name(file_name, image_dir="./coco/images/val2017", reduction=1):
+    path = f"{image_dir}/{file_name}"
+    image = cv2.imread(path, REDUCED_DECODE_FLAGS[reduction])
     return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
 
 
-def read_image_from_url(url):
-    response = requests.get(url)
-    image_array = np.asarray(bytearray(response.content), dtype=np.uint8)
-    image = cv2.imdecode(image_array, cv2.IMREAD_COLOR)
-    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+def read_image_from_url(url, reduction=1):
+    return shared_disk_image_cache.get_image(url, reduction)
+
+
+def _nearest_upscale_repeats(pixel_size, size):
+    """
+    How many times each of pixel_size source pixels is repeated when
+    cv2.INTER_NEAREST upscales them to size pixels (same rounding as OpenCV).
+    """
+    scale = 1.0 / (size / pixel_size)
+    source = np.minimum(
+        np.floor(np.arange(size) * scale).astype(np.int64), pixel_size - 1)
+    return np.bincount(source, minlength=pixel_size)
+
+
+def _unique_colors(image, weights=None):
+    """
+    Distinct colors of an RGB image together with their pixel counts.
+
+    weights optionally gives the number of pixels each pixel of image stands for
+    (pixels with weight 0 are ignored). Colors come back in the iteration order
+    of ``set(tuple(v) for v in pixels)``, which the palette filter depends on.
+    """
+    pixels = image.reshape(-1, 3)
+    if weights is None:
+        weights = np.ones(len(pixels), dtype=np.int64)
+    else:
+        weights = weights.reshape(-1)
+        pixels = pixels[weights > 0]
+        weights = weights[weights > 0]
+    keys = (pixels[:, 0].astype(np.int32) << 16) | (
+        pixels[:, 1].astype(np.int32) << 8) | pixels[:, 2]
+    _, first_index, inverse = np.unique(
+        keys, return_index=True, return_inverse=True)
+    counts = np.bincount(inverse.reshape(-1), weights=weights).astype(np.int64)
+    # Inserting distinct colors in order of first appearance builds the same
+    # hash table as inserting every pixel, duplicates being no-ops
+    by_appearance = np.argsort(first_index)
+    colors = pixels[first_index[by_appearance]]
+    counts = counts[by_appearance]
+    tuples = list(map(tuple, colors.tolist()))
+    position = {color: i for i, color in enumerate(tuples)}
+    order = [position[color] for color in set(tuples)]
+    return colors[order].astype(np.int64), counts[order]
+
+
+def _squared_distances(a, b):
+    """Pairwise squared Euclidean distances between the rows of a and b."""
+    a = a.astype(np.float64)
+    b = b.astype(np.float64)
+    d2 = (a * a).sum(axis=1)[:, None] - 2 * a @ b.T + (b * b).sum(axis=1)[None, :]
+    # Integer colors keep every term exact, so rounding only removes fp noise
+    return np.rint(d2)
+
+
+def _greedy_filter_colors(candidates, similarity_threshold, block_size=256):
+    """
+    Keep each candidate color that is farther than similarity_threshold from
+    every color kept before it.
+
+    Candidates are screened a block at a time against the accepted colors; only
+    the survivors of a block are resolved against each other sequentially. As in
+    the original KDTree version, black blocks candidates until the first color
+    is accepted.
+    """
+    r2 = similarity_threshold ** 2
+    outside_black = np.flatnonzero((candidates ** 2).sum(axis=1) > r2)
+    if outside_black.size == 0:
+        return candidates[:0]
+
+    accepted = [outside_black[0]]
+    for start in range(accepted[0] + 1, len(candidates), block_size):
+        block = candidates[start:start + block_size]
+        alive = np.flatnonzero(
+            (_squared_distances(block, candidates[accepted]) > r2).all(axis=1))
+        if alive.size == 0:
+            continue
+        clear = _squared_distances(block[alive], block[alive]) > r2
+        keep = np.ones(alive.size, dtype=bool)
+        for i in range(alive.size):
+            if keep[i]:
+                accepted.append(start + alive[i])
+                keep[i + 1:] &= clear[i, i + 1:]
+    return candidates[accepted]
+
+
+def _nearest_centers(colors, centers, block_size=4096):
+    """
+    Index of the nearest center for every color.
+
+    Distances are computed in batches; the rare colors that are equidistant
+    from several centers are resolved with a single KDTree so ties break the
+    same way the per-pixel KDTree queries did.
+    """
+    nearest = []
+    for start in range(0, len(colors), block_size):
+        d2 = _squared_distances(colors[start:start + block_size], centers)
+        index = d2.argmin(axis=1)
+        tied = np.flatnonzero(
+            (d2 == d2[np.arange(len(d2)), index][:, None]).sum(axis=1) > 1)
+        if tied.size:
+            _, index[tied] = KDTree(centers).query(
+                colors[start + tied].astype(np.float64))
+        nearest.append(index)
+    return np.concatenate(nearest)
+
+
+def palette_vectors(lab, dominance, lengths, n_colors=3):
+    """
+    Fixed-length vectors describing palettes, for nearest-neighbour search.
+
+    Each vector concatenates the Lab values of the n_colors most dominant colors
+    of a palette, most dominant first; palettes with fewer colors repeat their
+    most dominant one.
+
+    Parameters:
+    - lab (np.ndarray): (n_palettes, width, 3) Lab colors, padded past each palette's length.
+    - dominance (np.ndarray): (n_palettes, width) dominance of each color.
+    - lengths (np.ndarray): Number of colors of each palette.
+    """
+    lab = np.asarray(lab, dtype=np.float64)
+    dominance = np.where(np.arange(lab.shape[1])[None, :] < np.asarray(lengths)[:, None],
+                         dominance, -np.inf)
+    order = np.argsort(-dominance, axis=1, kind='stable')[:, :n_colors]
+    if order.shape[1] < n_colors:
+        order = np.pad(order, ((0, 0), (0, n_colors - order.shape[1])), mode='edge')
+    # Slots past a palette's length fall back to its most dominant color
+    order = np.where(np.arange(n_colors)[None, :] < np.asarray(lengths)[:, None],
+                     order, order[:, :1])
+    return np.take_along_axis(lab, order[:, :, None], axis=1).reshape(len(lab), -1)
+
+
+def farthest_point_sampling(vectors, n, first, kd_tree=None):
+    """
+    Greedily pick n rows of vectors, each time the one farthest from all rows picked so far.
+
+    Starts from row first. Distances to the picked set are kept in a lazy max-heap,
+    and after each pick a KDTree ball query updates only the rows that can still
+    change: those closer to the new pick than the current best distance.
+
+    Parameters:
+    - vectors (np.ndarray): (n_rows, dim) points to pick from.
+    - n (int): Number of rows to pick.
+    - first (int): Row to start from.
+    - kd_tree (KDTree): Prebuilt KDTree over vectors, built here if not given.
+
+    Returns:
+    - list: Indices of the picked rows, in pick order.
+    """
+    n = min(n, len(vectors))
+    if kd_tree is None:
+        kd_tree = KDTree(vectors)
+    min_dist = np.full(len(vectors), np.inf)
+    heap = []
+    picked = [first]
+    radius = np.inf
+    while len(picked) < n:
+        point = vectors[picked[-1]]
+        if np.isinf(radius):
+            rows = np.arange(len(vectors))
+        else:
+            rows = np.asarray(kd_tree.query_ball_point(point, r=radius), dtype=np.int64)
+        if rows.size:
+            dist = np.sqrt(((vectors[rows] - point) ** 2).sum(axis=1))
+            closer = dist < min_dist[rows]
+            min_dist[rows[closer]] = dist[closer]
+            for row, value in zip(rows[closer].tolist(), dist[closer].tolist()):
+                heapq.heappush(heap, (-value, row))
+        min_dist[picked[-1]] = 0.0
+        # Pop stale entries until the top reflects a current distance
+        while heap and (-heap[0][0] != min_dist[heap[0][1]] or min_dist[heap[0][1]] == 0.0):
+            heapq.heappop(heap)
+        if not heap:
+            break
+        radius, row = -heap[0][0], heap[0][1]
+        picked.append(row)
+    return picked
 
 
 class DiversityHandler:
-    def __init__(self):
-        self.image_cache = {}
+    def __init__(self, palette_index=None, image_cache=None, decode_reduction=PALETTE_DECODE_REDUCTION, image_dir="./coco/images/val2017"):
+        self.image_dir = image_dir
+        # Decoded images, shared process-wide unless a dedicated ImageCache is given
+        self.image_cache = image_cache if image_cache is not None else shared_image_cache
+        # Optional PaletteIndex of precomputed palettes, consulted before extracting
+        self.palette_index = palette_index
+        # JPEGs are decoded at 1/decode_reduction scale for palette extraction (1, 2, 4 or 8)
+        self.decode_reduction = decode_reduction
 
     def pixelate_image(self, image, pixel_size):
         """Pixelate the image."""
@@ -32,52 +218,111 @@ class DiversityHandler:
         return cv2.resize(
             image_small, (width, height), interpolation=cv2.INTER_NEAREST)
 
+    def _cache_keys(self, image_obj, use_local_images=True):
+        # Reduced images are cached under their own keys
+        suffix = '' if self.decode_reduction == 1 else f'@1/{self.decode_reduction}'
+        file_key = image_obj.get('file_name') and image_obj['file_name'] + suffix
+        url_key = image_obj.get('coco_url') and image_obj['coco_url'] + suffix
+        return (file_key, url_key) if use_local_images else (url_key, file_key)
+
+    def load_image(self, image_obj, use_local_images=True):
+        """
+        Decode an image for palette extraction, at 1/decode_reduction scale.
+
+        Reduced images are cached under their own keys, so the shared cache holds
+        small thumbnails rather than full-resolution images.
+        """
+        keys = self._cache_keys(image_obj, use_local_images)
+        if use_local_images:
+            return self.image_cache.get_or_load(
+                keys,
+                lambda: read_image_from_file_name(
+                    image_obj['file_name'], image_dir=self.image_dir, reduction=self.decode_reduction))
+        return self.image_cache.get_or_load(
+            keys,
+            lambda: read_image_from_url(image_obj['coco_url'], reduction=self.decode_reduction))
+
+    def prefetch_remote_images(self, image_objs):
+        """Load the images of a batch that are not in memory yet, downloading uncached ones concurrently."""
+        missing = [img for img in image_objs
+                   if not any(key in self.image_cache for key in self._cache_keys(img, use_local_images=False))]
+        images = shared_disk_image_cache.get_images(
+            [img['coco_url'] for img in missing], self.decode_reduction)
+        for img, image in zip(missing, images):
+            self.image_cache.put(self._cache_keys(
+                img, use_local_images=False), image)
+
     def extract_palette(self, image_obj, use_local_images=True, pixel_size=5, similarity_threshold=50, raw_image=None, apply_clustering=False, n_clusters=5):
+        if raw_image is None and self.palette_index is not None and self.palette_index.matches(pixel_size, similarity_threshold, apply_clustering, self.decode_reduction):
+            palette = self.palette_index.palette(image_obj['id'])
+            if palette is not None:
+                return palette
+
         if raw_image is not None:
             image = raw_image
-        elif use_local_images:
-            if image_obj['file_name'] in self.image_cache:
-                image = self.image_cache[image_obj['file_name']]
-            else:
-                image = read_image_from_file_name(image_obj['file_name'])
-                self.image_cache[image_obj['file_name']] = image
+            height, width, _ = image.shape
         else:
-            if image_obj['coco_url'] in self.image_cache:
-                image = self.image_cache[image_obj['coco_url']]
-            else:
-                image = read_image_from_url(image_obj['coco_url'])
-                self.image_cache[image_obj['coco_url']] = image
-
-        pixelated_img = self.pixelate_image(image, pixel_size=pixel_size)
-
-        # Convert image pixels to a set of unique colors
-        potential_unique_colors = set(tuple(v)
-                                      for v in pixelated_img.reshape(-1, 3))
-
-        # Filter these colors using KDTree
-        kd_tree = KDTree(np.array([[0, 0, 0]]))  # dummy initialization
-        unique_colors = []
-        for color in potential_unique_colors:
-            if not kd_tree.query_ball_point(color, r=similarity_threshold):
-                unique_colors.append(color)
-                kd_tree = KDTree(np.array(unique_colors))
+            image = self.load_image(image_obj, use_local_images=use_local_images)
+            height, width, _ = image.shape
+            # Count pixels at the original resolution, whatever scale was decoded
+            height = image_obj.get('height', height * self.decode_reduction)
+            width = image_obj.get('width', width * self.decode_reduction)
 
+        candidates, counts = self.palette_candidates(
+            image, pixel_size, height=height, width=width)
+        unique_colors = self.filter_colors(candidates, similarity_threshold)
         if apply_clustering:
-            # Adjust n_clusters based on the number of unique colors found
-            n_clusters = min(n_clusters, len(unique_colors))
+            unique_colors = self.cluster_colors(unique_colors, n_clusters)
+        return self.color_dominance(candidates, counts, unique_colors, pixel_size)
+
+    @staticmethod
+    def palette_candidates(image, pixel_size, height=None, width=None):
+        """
+        Distinct colors of the pixelated image and the number of pixels of each.
+
+        Depends only on the image and pixel_size. height and width give the
+        resolution the pixels are counted at (the image's own by default).
+        """
+        if height is None or width is None:
+            height, width, _ = image.shape
+
+        # Shrink to pixel_size x pixel_size; instead of scaling back up, weight
+        # each pixel by the block it would cover in the pixelated full-size image
+        image_small = cv2.resize(
+            image, (pixel_size, pixel_size), interpolation=cv2.INTER_LINEAR)
+        weights = np.outer(_nearest_upscale_repeats(pixel_size, height),
+                           _nearest_upscale_repeats(pixel_size, width))
 
-            kmeans = KMeans(n_clusters=n_clusters)
-            kmeans.fit(np.array(unique_colors))
-            cluster_centers = kmeans.cluster_centers_
-            unique_colors = [tuple(map(int, center))
-                             for center in cluster_centers]
+        # Deduplicate colors, keeping them in the order a set of pixel tuples
+        # would iterate them so the greedy filter below sees the same sequence
+        return _unique_colors(image_small, weights)
 
+    @staticmethod
+    def filter_colors(candidates, similarity_threshold):
+        """Greedily drop candidate colors within similarity_threshold of an accepted one."""
+        return [tuple(map(int, color))
+                for color in _greedy_filter_colors(candidates, similarity_threshold)]
+
+    @staticmethod
+    def cluster_colors(unique_colors, n_clusters):
+        """Reduce the colors to at most n_clusters KMeans cluster centers."""
+        # Adjust n_clusters based on the number of unique colors found
+        n_clusters = min(n_clusters, len(unique_colors))
+
+        kmeans = KMeans(n_clusters=n_clusters)
+        kmeans.fit(np.array(unique_colors))
+        cluster_centers = kmeans.cluster_centers_
+        return [tuple(map(int, center)) for center in cluster_centers]
+
+    @staticmethod
+    def color_dominance(candidates, counts, unique_colors, pixel_size):
+        """Pair every palette color with its share of the pixels assigned to it."""
+        # Assign every distinct color (weighted by its pixel count) to its
+        # nearest palette color in one batched computation
+        nearest = _nearest_centers(candidates, np.array(unique_colors))
         color_dominance = {color: 0 for color in unique_colors}
-        kd_tree = KDTree(np.array(unique_colors))
-        for color in pixelated_img.reshape(-1, 3):
-            _, index = kd_tree.query(color)
-            closest_color_tuple = unique_colors[index]
-            color_dominance[closest_color_tuple] += 1
+        for index, count in zip(nearest.tolist(), counts.tolist()):
+            color_dominance[unique_colors[index]] += count
 
         total_pixels = pixel_size * pixel_size
         for color, count in color_dominance.items():
@@ -85,12 +330,32 @@ class DiversityHandler:
 
         return [(color, color_dominance[color]) for color in unique_colors]
 
-    def palettes_of_images(self, image_objs, use_local_images=True):
-        return [self.extract_palette(img, use_local_images) for img in image_objs]
+    def palettes_of_images(self, image_objs, use_local_images=True, parallel=False, max_workers=None):
+        """
+        Extract the palettes of a batch of images, in input order.
+
+        With parallel=True the batch is spread over a thread pool sized from the
+        CPU count. Threads share the decoded-image cache directly, and decoding
+        and the NumPy/OpenCV work release the GIL, so nothing has to be pickled.
+        """
+        if not use_local_images:
+            self.prefetch_remote_images(image_objs)
 
-    def is_diverse_colors(self, image_objs, use_local_images=True, similarity_threshold=50):
+        if not parallel or len(image_objs) < 2:
+            return [self.extract_palette(img, use_local_images) for img in image_objs]
+
+        max_workers = min(max_workers or os.cpu_count() or 1, len(image_objs))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(
+                lambda img: self.extract_palette(img, use_local_images), image_objs))
+
+    def is_diverse_colors(self, image_objs, use_local_images=True, similarity_threshold=50, batched=True, parallel=False):
         palette_list = self.palettes_of_images(
-            image_objs, use_local_images=use_local_images)
+            image_objs, use_local_images=use_local_images, parallel=parallel)
+
+        if batched:
+            return not self.similar_image_pairs(
+                palette_list, similarity_threshold=similarity_threshold, stop_at_first=True)
 
         for i in range(len(palette_list)):
             for j in range(i+1, len(palette_list)):
@@ -100,6 +365,72 @@ class DiversityHandler:
                             return False
         return True
 
+    @staticmethod
+    def palettes_to_lab(palette_list):
+        """
+        Convert the colors of several palettes to Lab with a single rgb2lab call.
+
+        Returns:
+        - lab (np.ndarray): (n_colors, 3) Lab values of all palette colors, concatenated.
+        - owners (np.ndarray): Index into palette_list of the palette each row belongs to.
+        """
+        colors = [color for palette in palette_list for color, _ in palette]
+        owners = np.repeat(np.arange(len(palette_list)),
+                           [len(palette) for palette in palette_list])
+        if not colors:
+            return np.empty((0, 3)), owners
+        lab = rgb2lab(np.uint8(np.asarray([colors])))[0]
+        return lab, owners
+
+    @staticmethod
+    def palette_vectors_of(palette_list, n_colors=3):
+        """Fixed-length Lab palette vectors of extract_palette palettes, see palette_vectors."""
+        lab, owners = DiversityHandler.palettes_to_lab(palette_list)
+        lengths = np.array([len(palette) for palette in palette_list])
+        width = max(lengths.max(initial=0), 1)
+        slots = np.arange(len(owners)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        lab_padded = np.zeros((len(palette_list), width, 3))
+        dominance_padded = np.zeros((len(palette_list), width))
+        lab_padded[owners, slots] = lab
+        dominance_padded[owners, slots] = [
+            value for palette in palette_list for _, value in palette]
+        return palette_vectors(lab_padded, dominance_padded, lengths, n_colors=n_colors)
+
+    def similar_image_pairs(self, palette_list, similarity_threshold=50, stop_at_first=False):
+        """
+        Find the pairs of palettes that share a color closer than similarity_threshold (deltaE CIE76).
+
+        The palettes are converted to Lab once and compared one block at a time: the
+        colors of palette i against the colors of every later palette, by broadcasting.
+
+        Parameters:
+        - palette_list (list): Palettes as returned by extract_palette.
+        - similarity_threshold (float): Minimum deltaE for two colors to count as distinct.
+        - stop_at_first (bool): Return as soon as one block contains a similar pair.
+
+        Returns:
+        - list: Sorted (i, j) index pairs (i < j) of palettes that are too similar.
+        """
+        lab, owners = self.palettes_to_lab(palette_list)
+        return self.similar_lab_pairs(lab, owners, len(palette_list), similarity_threshold, stop_at_first)
+
+    @staticmethod
+    def similar_lab_pairs(lab, owners, n_palettes, similarity_threshold=50, stop_at_first=False):
+        """similar_image_pairs on palettes already converted with palettes_to_lab."""
+        pairs = []
+        for i in range(n_palettes):
+            rows = owners == i
+            later = owners > i
+            if not rows.any() or not later.any():
+                continue
+            delta_e = np.sqrt(
+                ((lab[rows][:, None, :] - lab[later][None, :, :]) ** 2).sum(axis=-1))
+            close = (delta_e < similarity_threshold).any(axis=0)
+            pairs.extend((i, int(j)) for j in np.unique(owners[later][close]))
+            if stop_at_first and pairs:
+                break
+        return pairs
+
     @staticmethod
     def color_similarity_lab(color1, color2):
         """Computes the similarity between two RGB colors using Lab color space."""
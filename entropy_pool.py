@@ -0,0 +1,172 @@
+import os
+import random as pyrandom
+import threading
+import time
+
+from config import ENTROPY_POOL_BLOCK_BYTES, ENTROPY_POOL_FALLBACK_TIMEOUT, ENTROPY_POOL_LOW_WATER_BYTES
+
+
+def _overrides(rng, name):
+    """Whether rng has its own method name, rather than the Mersenne Twister one of random.Random."""
+    method = getattr(type(rng), name, None)
+    return method is not None and method is not getattr(pyrandom.Random, name, None)
+
+
+def rng_byte_source(rng):
+    """
+    Byte source reading from a random generator such as QuantumRandom.
+
+    Uses rng.getrandbits when the generator implements it, and otherwise draws
+    32-bit integers from rng.random() (or rng.choice, without random()). A
+    random.Random subclass that overrides only random() inherits the Mersenne
+    Twister getrandbits, which would bypass the generator, so it is not used.
+    """
+    if _overrides(rng, 'getrandbits'):
+        return lambda n_bytes: rng.getrandbits(8 * n_bytes).to_bytes(n_bytes, 'little')
+
+    if _overrides(rng, 'random'):
+        def word():
+            return int(rng.random() * (1 << 32))
+    else:
+        def word():
+            return rng.choice(range(1 << 32))
+
+    def source(n_bytes):
+        words = [word() for _ in range((n_bytes + 3) // 4)]
+        return b''.join(word.to_bytes(4, 'little') for word in words)[:n_bytes]
+    return source
+
+
+class LocalEntropySource:
+    """
+    Local stand-in for a remote entropy source, for tests and benchmarks.
+
+    Returns pseudo-random bytes (reproducible with seed) after sleeping delay
+    seconds per request, to mimic the latency of a remote RNG.
+    """
+
+    def __init__(self, delay=0.0, seed=None):
+        self.delay = delay
+        self.requests = 0
+        self._random = pyrandom.Random(seed)
+        self._lock = threading.Lock()
+
+    def __call__(self, n_bytes):
+        if self.delay:
+            time.sleep(self.delay)
+        with self._lock:
+            self.requests += 1
+            return self._random.randbytes(n_bytes)
+
+
+class EntropyPool(pyrandom.Random):
+    """
+    Random generator serving draws from a local buffer of bytes fetched from a slow source.
+
+    A background thread fetches block_size bytes at a time from source and
+    refills the buffer whenever it drops below low_water bytes, so choice,
+    sample, shuffle, etc. (all of random.Random's methods) normally read bytes
+    already in memory. When the buffer runs dry, a draw waits up to
+    fallback_timeout seconds for the refill and then takes its bytes from
+    os.urandom instead; with fallback_timeout=None it always waits.
+
+    Every read of random bits is counted by where its bytes came from, see stats().
+
+    Parameters:
+    - source (callable): Returns n random bytes for source(n) (see rng_byte_source, LocalEntropySource).
+    - block_size (int): Bytes fetched from source per request.
+    - low_water (int): Buffer size (in bytes) below which a refill is started.
+    - fallback_timeout (float): Seconds to wait for the source before using os.urandom, None to never fall back.
+    """
+
+    def __init__(self, source, block_size=ENTROPY_POOL_BLOCK_BYTES, low_water=ENTROPY_POOL_LOW_WATER_BYTES,
+                 fallback_timeout=ENTROPY_POOL_FALLBACK_TIMEOUT):
+        self.source = source
+        self.block_size = block_size
+        self.low_water = low_water
+        self.fallback_timeout = fallback_timeout
+        self.counts = {'buffer': 0, 'blocking': 0, 'fallback': 0}
+        self.source_errors = 0
+        self._buffer = bytearray()
+        # Bytes a blocked draw is waiting for, so the refill covers it
+        self._wanted = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        super().__init__()
+        self._thread = threading.Thread(
+            target=self._refill_loop, name='entropy-pool', daemon=True)
+        self._thread.start()
+
+    def _refill_loop(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._closed or len(
+                    self._buffer) < max(self.low_water, self._wanted))
+                if self._closed:
+                    return
+            try:
+                block = self.source(self.block_size)
+            except Exception:
+                # Draws fall back to os.urandom while the source is down; retry shortly
+                with self._condition:
+                    self.source_errors += 1
+                    self._condition.wait(timeout=1.0)
+                continue
+            with self._condition:
+                self._buffer.extend(block)
+                self._condition.notify_all()
+
+    def _take(self, n_bytes):
+        with self._condition:
+            if len(self._buffer) >= n_bytes:
+                self.counts['buffer'] += 1
+            else:
+                ready = False
+                if not self._closed:
+                    self._wanted = n_bytes
+                    self._condition.notify_all()
+                    ready = self._condition.wait_for(
+                        lambda: len(self._buffer) >= n_bytes, timeout=self.fallback_timeout)
+                    self._wanted = 0
+                if not ready:
+                    self.counts['fallback'] += 1
+                    return os.urandom(n_bytes)
+                self.counts['blocking'] += 1
+            data = bytes(self._buffer[:n_bytes])
+            del self._buffer[:n_bytes]
+            if len(self._buffer) < self.low_water:
+                self._condition.notify_all()
+            return data
+
+    def getrandbits(self, k):
+        if k < 0:
+            raise ValueError("number of bits must be non-negative")
+        if k == 0:
+            return 0
+        n_bytes = (k + 7) // 8
+        return int.from_bytes(self._take(n_bytes), 'little') >> (8 * n_bytes - k)
+
+    def random(self):
+        return self.getrandbits(53) * 2.0 ** -53
+
+    def seed(self, *args, **kwargs):
+        """Ignored: the pool draws from its source, it has no seed."""
+
+    def getstate(self):
+        raise NotImplementedError("an entropy pool has no reproducible state")
+
+    def setstate(self, state):
+        raise NotImplementedError("an entropy pool has no reproducible state")
+
+    def close(self):
+        """Stop the refill thread; later draws use whatever is buffered, then the fallback."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def stats(self):
+        """Draw counts by where their bytes came from, and the bytes currently buffered."""
+        with self._condition:
+            draws = sum(self.counts.values())
+            return dict(self.counts, draws=draws, buffered_bytes=len(self._buffer), source_errors=self.source_errors,
+                        buffer_rate=self.counts['buffer'] / draws if draws else 0.0)
@@ -1,52 +1,51 @@
-import re
+import os
 import json
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import g4f
 import requests
 
-JSON_OUTPUT_PROMPT = """Please respond in the following exact format: { \"data\": \"YOUR RESPONSE HERE\" }. Do not change the structure, capitalization, or formatting. DO NOT include any for-human-user text or comments, you are communicating with a computer software program via specified format ONLY! If using in with other formatting like lists, dicts,obj, literals, strings, etc. always set it as the value to the "data" key!"""
+from config import GPT_CALL_TIMEOUT, GPT_LEADERBOARD_PATH, GPT_RACE_PROVIDERS, GPT_REQUEST_THREADS
+from gpt_response_cache import shared_gpt_response_cache
+from provider_health import NoProviderAvailable, provider_name, shared_provider_health
+# The prompts and the response parser live in stream_parser, which does not need g4f
+from stream_parser import (JSON_OUTPUT_PROMPT, LIST_OUTPUT_PROMPT, DataObjectParser,  # noqa: F401
+                           ParsedResponse, extract_data_from_json_response)
 
-LIST_OUTPUT_PROMPT = "Provide your response as a comma-separated list. Include the list brackets `[]` surrounding your list! (ex. [`'a`', 2]). Strictly follow the format. "
 
+class RaceCancelled(Exception):
+    """Raised in a racing request whose race was already won."""
 
-def extract_data_from_json_response(response_text):
-    # Use regex to extract the { "data": ... } pattern from the response
-    match = re.search(r'{\s*"data"\s*:\s*(.+?)}', response_text)
 
-    if not match:
-        raise ValueError(f"'data' object not found in: {response_text}")
-
-    try:
-        # Extract the matched JSON object and parse it
-        data_json_str = match.group(0)
-        data_json = json.loads(data_json_str)
-
-        # Extract the 'data' key's value
-        data_val = data_json['data']
-
-        # If it's a string representation of a list or object, clean and parse
-        if isinstance(data_val, str) and (data_val.startswith('[') and data_val.endswith(']') or
-                                          data_val.startswith('{') and data_val.endswith('}')):
-            # Replace single quotes with double quotes
-            data_val = data_val.replace("'", '"')
-            # Remove backticks
-            data_val = data_val.replace("`", "")
-            return json.loads(data_val)
-
-        return data_val
-
-    except (json.JSONDecodeError, KeyError) as e:
-        raise ValueError(
-            f"Error parsing extracted data: {data_json_str}. Error: {e}")
-
-    return None
+# Thread pool of the g4f requests of every GPTHandler in the process
+shared_request_executor = ThreadPoolExecutor(
+    max_workers=GPT_REQUEST_THREADS, thread_name_prefix='gpt-request')
 
 
 class GPTHandler:
 
-    def __init__(self, model=g4f.models.gpt_4, provider=g4f.Provider.Bing):
+    def __init__(self, model=g4f.models.gpt_4, provider=g4f.Provider.Bing, response_cache=shared_gpt_response_cache,
+                 race_providers=GPT_RACE_PROVIDERS, providers=None, health=shared_provider_health,
+                 call_timeout=GPT_CALL_TIMEOUT):
+        """
+        Parameters:
+        - model: g4f model to ask.
+        - provider: g4f provider used when not racing (while its circuit breaker is closed).
+        - response_cache (GPTResponseCache): Persistent cache of parseable responses, None to always ask.
+        - race_providers (int): Send each prompt to this many of the best healthy providers at once
+          and keep the first parseable answer; 1 asks one provider.
+        - providers (list): Providers to race or fall back to, defaults to working_gpt4_providers.
+        - health (ProviderHealth): Live latency, error rates and circuit breakers of the providers.
+        - call_timeout (float): Deadline (seconds) of each call; a provider that misses it counts as failed.
+        """
         self.model = model
         self.provider = provider
-        self.working_gpt4_providers = [
+        self.response_cache = response_cache
+        self.race_providers = race_providers
+        self.health = health
+        self.call_timeout = call_timeout
+        self.working_gpt4_providers = providers if providers is not None else [
             g4f.Provider.Aivvm,
             g4f.Provider.DeepAi,
             g4f.Provider.Bing,
@@ -56,10 +55,117 @@ class GPTHandler:
         ]
 
     def get_response(self, prompt):
+        """
+        The response of the model to prompt, served from the response cache when it was asked before.
+        """
+        racing = self.race_providers > 1
+        # Raced answers may come from any provider, so they share one cache entry
+        cache_provider = 'race' if racing else self.provider
+        if self.response_cache is not None:
+            cached = self.response_cache.get(self.model, cache_provider, prompt)
+            if cached is not None:
+                return cached
+
+        start = time.perf_counter()
+        response = self._race(prompt, self._providers_for_call())
+        if self.response_cache is not None:
+            self.response_cache.put(self.model, cache_provider, prompt, response,
+                                    latency=time.perf_counter() - start)
+        return response
 
+    def _providers_for_call(self):
+        """
+        The providers to send the next prompt to, ordered by live health stats.
+
+        Without racing this is self.provider alone, unless its circuit breaker is
+        open; then it is the best available of working_gpt4_providers.
+        """
+        if self.race_providers > 1:
+            return self.health.select(self.working_gpt4_providers, self.race_providers)
+        try:
+            return self.health.select([self.provider], 1)
+        except NoProviderAvailable:
+            return self.health.select(self.working_gpt4_providers, 1)
+
+    def _race(self, prompt, providers):
+        """
+        Send prompt to all providers at once and return the first parseable response.
+
+        The first response extract_data_from_json_response can parse wins and the
+        other requests are cancelled: they stop reading their stream at the next
+        chunk. Providers that have not answered within call_timeout are abandoned
+        and count as failed. If no provider gives a parseable answer, the last
+        response (or error) is returned (or raised).
+
+        Cancellation and the deadline are only checked between chunks, so a
+        request whose stream never yields keeps its thread blocked in g4f until
+        the provider gives up. The requests run on shared_request_executor, so
+        such hung requests cannot grow past GPT_REQUEST_THREADS threads. While
+        they hold all of them new requests queue. A request still queued at the
+        deadline (or when the race is decided) is dropped without counting
+        against its provider, and its half-open trial reservation is released.
+        """
+        cancelled = threading.Event()
+        start = time.perf_counter()
+        deadline = start + self.call_timeout
+        started = {shared_request_executor.submit(self._timed_request, prompt, provider, cancelled, deadline): provider
+                   for provider in providers}
+        pending = set(started)
+        last_response, last_error = None, None
+        try:
+            while pending:
+                done, pending = wait(pending, timeout=max(deadline - time.perf_counter(), 0),
+                                     return_when=FIRST_COMPLETED)
+                if not done:
+                    last_error = TimeoutError(
+                        f"No answer within {self.call_timeout} s from {[provider_name(started[future]) for future in pending]}")
+                    for future in pending:
+                        # Requests that never left the queue say nothing about their provider
+                        if future.cancel():
+                            self.health.release(started[future])
+                        else:
+                            self.health.record_failure(started[future], last_error)
+                    pending = set()
+                    break
+                for future in done:
+                    provider = started[future]
+                    try:
+                        response, latency = future.result()
+                    except Exception as e:
+                        self.health.record_failure(provider, e)
+                        last_error = e
+                        continue
+                    try:
+                        extract_data_from_json_response(response)
+                    except ValueError as e:
+                        self.health.record_failure(provider, e)
+                        last_response = response
+                        continue
+                    self.health.record_success(provider, latency)
+                    # The losers took at least this long
+                    for loser in pending:
+                        self.health.record_lower_bound(
+                            started[loser], time.perf_counter() - start)
+                    return response
+        finally:
+            cancelled.set()
+            for future in pending:
+                if future.cancel():
+                    self.health.release(started[future])
+        if last_response is not None:
+            return last_response
+        raise last_error
+
+    def _timed_request(self, prompt, provider, cancelled, deadline=None):
+        start = time.perf_counter()
+        response = self._request(
+            prompt, provider=provider, cancelled=cancelled, deadline=deadline)
+        return response, time.perf_counter() - start
+
+    def _request(self, prompt, provider=None, cancelled=None, deadline=None):
         response_stream = g4f.ChatCompletion.create(
             model=self.model,
-            provider=self.provider,
+            provider=provider or self.provider,
             messages=[{"role": "user", "content": prompt}],
             stream=True,
             # for Bing (WORKS WITH BLANK COOKIES)
@@ -67,26 +173,48 @@ class GPTHandler:
             auth=True
         )
 
-        # Collecting messages
-        messages = []
+        # Parsing messages as they arrive, until the { "data": ... } object is complete
+        parser = DataObjectParser()
         for message in response_stream:
+            if cancelled is not None and cancelled.is_set():
+                # Another provider won the race
+                if hasattr(response_stream, 'close'):
+                    response_stream.close()
+                raise RaceCancelled()
+            if deadline is not None and time.perf_counter() > deadline:
+                if hasattr(response_stream, 'close'):
+                    response_stream.close()
+                raise TimeoutError("Response stream past its deadline")
             # Removing leading newlines
-            messages.append(message.lstrip("\n"))
+            if parser.feed(message.lstrip("\n")):
+                # Skip the chatter after the object
+                if hasattr(response_stream, 'close'):
+                    response_stream.close()
+                break
 
-        # Joining the messages to get a full response
-        return ''.join(messages)
+        # Up to the end of the object, with its parsed data, or the full response
+        return ParsedResponse(parser.text, parser.data) if parser.done else parser.text
 
-    def test_providers(self, providers):
+    def test_providers(self, providers=None, rounds=3, leaderboard_path=GPT_LEADERBOARD_PATH):
         """
-        Test a list of providers to check which ones respond correctly to a long prompt.
+        Benchmark providers concurrently on a long prompt and write a latency leaderboard.
+
+        Every provider gets `rounds` requests, all sent at once to
+        shared_request_executor, each with the call_timeout deadline. Requests
+        still queued at the deadline are dropped without an outcome; the others
+        feed the live provider health, and the leaderboard (latency percentiles,
+        error rate and breaker state of each provider, best first) is written to
+        leaderboard_path as JSON.
 
         Parameters:
-        - providers (list): A list of provider constants to test.
+        - providers (list): Providers to test, defaults to working_gpt4_providers.
+        - rounds (int): Requests per provider.
+        - leaderboard_path (str): JSON file to write the leaderboard to, None to skip writing.
 
         Returns:
-        - list: A list of working providers sorted by their output message length.
+        - list: The providers that answered correctly at least once, best first.
         """
-        working_providers = []
+        providers = self.working_gpt4_providers if providers is None else providers
 
         # A long and detailed prompt to test maximum input length and detailed task.
         # Assuming 2048 is the maximum input length for most providers.
@@ -96,26 +224,47 @@ class GPTHandler:
         to modern-day RSA and Elliptic Curve Cryptography, provide a detailed analysis on how quantum computers might pose 
         a threat to current cryptographic standards and detail potential post-quantum cryptographic solutions. 
         Your response should be exhaustive and detailed, covering every aspect of the question in depth.
-        """
+        """ + JSON_OUTPUT_PROMPT
+
+        def run(provider):
+            response, latency = self._timed_request(
+                prompt, provider, None, deadline)
+            extract_data_from_json_response(response)
+            return latency
 
-        for provider in providers:
+        deadline = time.perf_counter() + self.call_timeout
+        futures = {shared_request_executor.submit(run, provider): provider
+                   for provider in providers for _ in range(rounds)}
+        done, late = wait(futures, timeout=self.call_timeout)
+        answered = set()
+        for future, provider in futures.items():
+            if future in late and future.cancel():
+                # Never left the queue: says nothing about the provider
+                continue
             try:
-                response = self.get_response(prompt, provider)
-                response_data = extract_data_from_json_response(response)
-
-                # Check if the provider's response contains the expected output.
-                if response_data:
-                    working_providers.append(
-                        (provider, len(response_data)))
-                    print(
-                        f"Provider {provider} responded with message length: {len(response_data)}")
+                if future in late:
+                    # Still running; it stops at its next chunk, past the deadline
+                    raise TimeoutError(f"No answer within {self.call_timeout} s")
+                self.health.record_success(provider, future.result())
+                answered.add(provider)
             except Exception as e:
-                print(f"Error testing provider {provider}: {e}")
+                self.health.record_failure(provider, e)
+                print(f"Error testing provider {provider_name(provider)}: {e}")
 
-        # Sort the working providers by the length of their output message.
-        working_providers.sort(key=lambda x: x[1], reverse=True)
+        leaderboard = self.health.leaderboard(providers)
+        for rank, row in enumerate(leaderboard, 1):
+            p50 = '-' if row['p50'] is None else f"{row['p50']:.2f}s"
+            print(f"{rank}. {row['provider']}: p50 {p50}, error rate {row['error_rate']:.0%}, {row['state']}")
+        if leaderboard_path is not None:
+            directory = os.path.dirname(leaderboard_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(leaderboard_path, 'w') as file:
+                json.dump({'tested_at': time.time(), 'providers': leaderboard}, file, indent=2)
 
-        return [provider[0] for provider in working_providers]
+        names = [row['provider'] for row in leaderboard]
+        return sorted((provider for provider in providers if provider in answered),
+                      key=lambda provider: names.index(provider_name(provider)))
 
 
 # # # Example Usage
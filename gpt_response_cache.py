@@ -0,0 +1,147 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from config import GPT_CACHE_MAX_BYTES, GPT_CACHE_PATH, GPT_CACHE_TTL
+
+
+def normalize_prompt(prompt):
+    """Collapse all whitespace runs to single spaces, so reformatted prompts share an entry."""
+    return ' '.join(prompt.split())
+
+
+def _name(obj):
+    return getattr(obj, '__name__', None) or getattr(obj, 'name', None) or str(obj)
+
+
+class GPTResponseCache:
+    """
+    Persistent cache of GPT responses in an SQLite database.
+
+    Entries are keyed by the SHA-256 of model, provider and the normalized
+    prompt. Only responses extract_data_from_json_response can parse are
+    stored, so a malformed answer is asked again rather than replayed. Entries
+    expire ttl seconds after they were stored, and once the responses exceed
+    max_bytes the least recently used ones are deleted. Each entry keeps the
+    latency of the request that produced it, so hits report the time they saved.
+
+    The database is opened on first use and shared by all threads.
+    """
+
+    def __init__(self, path=GPT_CACHE_PATH, ttl=GPT_CACHE_TTL, max_bytes=GPT_CACHE_MAX_BYTES):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.rejected = 0
+        self.evictions = 0
+        self.saved_seconds = 0.0
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def _db(self):
+        """The database connection, created with its table on first use; called with the lock held."""
+        if self._connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._connection = sqlite3.connect(
+                self.path, check_same_thread=False, isolation_level=None)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                'key TEXT PRIMARY KEY, model TEXT, provider TEXT, response TEXT, '
+                'size INTEGER, latency REAL, created REAL, last_used REAL)')
+            self._connection.execute(
+                'CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)')
+        return self._connection
+
+    @staticmethod
+    def key(model, provider, prompt):
+        text = '\0'.join([_name(model), _name(provider), normalize_prompt(prompt)])
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def get(self, model, provider, prompt):
+        """The cached response to prompt, or None. Counts a hit or a miss."""
+        key = self.key(model, provider, prompt)
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            row = db.execute('SELECT response, latency, created FROM responses WHERE key = ?',
+                             (key,)).fetchone()
+            if row is not None and self.ttl is not None and now - row[2] > self.ttl:
+                db.execute('DELETE FROM responses WHERE key = ?', (key,))
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            db.execute('UPDATE responses SET last_used = ? WHERE key = ?', (now, key))
+            self.hits += 1
+            self.saved_seconds += row[1]
+            return row[0]
+
+    def put(self, model, provider, prompt, response, latency=0.0):
+        """
+        Store response if it parses, evicting least recently used entries to stay in budget.
+
+        Returns:
+        - bool: Whether the response was stored.
+        """
+        # Imported here: gpt_handler imports this module
+        from gpt_handler import extract_data_from_json_response
+        try:
+            extract_data_from_json_response(response)
+        except ValueError:
+            with self._lock:
+                self.rejected += 1
+            return False
+
+        size = len(response.encode('utf-8'))
+        if size > self.max_bytes:
+            return False
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                       (self.key(model, provider, prompt), _name(model), _name(provider), response,
+                        size, latency, now, now))
+            total = db.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+            if total > self.max_bytes:
+                for key, entry_size in db.execute(
+                        'SELECT key, size FROM responses ORDER BY last_used').fetchall():
+                    if total <= self.max_bytes:
+                        break
+                    db.execute('DELETE FROM responses WHERE key = ?', (key,))
+                    total -= entry_size
+                    self.evictions += 1
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._db().execute('DELETE FROM responses')
+
+    def stats(self):
+        """Counters, hit rate and seconds of GPT latency saved by hits."""
+        with self._lock:
+            entries, total = self._db().execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses').fetchone()
+            lookups = self.hits + self.misses
+            return {
+                "entries": entries,
+                "bytes": total,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "rejected": self.rejected,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "saved_seconds": self.saved_seconds,
+            }
+
+
+# GPT response cache shared by every GPTHandler in the process
+shared_gpt_response_cache = GPTResponseCache()
@@ -0,0 +1,108 @@
+import threading
+from collections import OrderedDict
+
+from config import IMAGE_CACHE_MAX_BYTES
+
+
+class ImageCache:
+    """
+    Thread-safe LRU cache of decoded images bounded by a memory budget in bytes.
+
+    An image can be stored under several keys (e.g. its `file_name` and its
+    `coco_url`); all of them resolve to one entry, which is counted once against
+    the budget and evicted as a whole. Cached arrays are made read-only since
+    they are shared between callers.
+    """
+
+    def __init__(self, max_bytes=IMAGE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # primary key -> (image, all keys of the entry), least recently used first
+        self._entries = OrderedDict()
+        # any key -> primary key
+        self._aliases = {}
+        self._lock = threading.Lock()
+
+    def get(self, keys):
+        """Return the image stored under any of keys, or None. Counts a hit or a miss."""
+        with self._lock:
+            for key in keys:
+                primary = self._aliases.get(key)
+                if primary is not None:
+                    self._entries.move_to_end(primary)
+                    self.hits += 1
+                    return self._entries[primary][0]
+            self.misses += 1
+            return None
+
+    def __contains__(self, key):
+        """Whether key is cached, without touching the LRU order or the counters."""
+        with self._lock:
+            return key in self._aliases
+
+    def put(self, keys, image):
+        """Store image under all keys, evicting least recently used images to stay in budget."""
+        keys = tuple(key for key in keys if key is not None)
+        if not keys or image.nbytes > self.max_bytes:
+            return
+        image.flags.writeable = False
+        with self._lock:
+            for key in keys:
+                if key in self._aliases:
+                    self._remove(self._aliases[key])
+            primary = keys[0]
+            self._entries[primary] = (image, keys)
+            for key in keys:
+                self._aliases[key] = primary
+            self.current_bytes += image.nbytes
+            while self.current_bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def get_or_load(self, keys, loader):
+        """
+        Return the cached image for keys, calling loader() and caching its result on a miss.
+
+        The loader runs outside the lock, so concurrent misses decode in parallel.
+        """
+        image = self.get(keys)
+        if image is None:
+            image = loader()
+            self.put(keys, image)
+        return image
+
+    def _remove(self, primary):
+        image, keys = self._entries.pop(primary)
+        for key in keys:
+            del self._aliases[key]
+        self.current_bytes -= image.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._aliases.clear()
+            self.current_bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """Counters and memory use of the cache."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+# Decoded-image cache shared by every DiversityHandler in the process
+shared_image_cache = ImageCache()
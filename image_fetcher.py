@@ -0,0 +1,70 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from config import IMAGE_FETCH_MAX_WORKERS, IMAGE_FETCH_RETRIES, IMAGE_FETCH_TIMEOUT
+
+# cv2 flags decoding a JPEG directly at 1/reduction of its size
+REDUCED_DECODE_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+def decode_image(content, flags=cv2.IMREAD_COLOR):
+    """Decode encoded image bytes to an RGB array."""
+    image_array = np.frombuffer(content, dtype=np.uint8)
+    image = cv2.imdecode(image_array, flags)
+    if image is None:
+        raise ValueError("Could not decode image data.")
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+class ImageFetcher:
+    """
+    Downloads images over a pooled keep-alive HTTP session.
+
+    Connections are reused across requests, every request has a timeout, and
+    connection errors and 429/5xx responses are retried with exponential backoff.
+    fetch_many downloads a whole batch on a bounded thread pool.
+    """
+
+    def __init__(self, timeout=IMAGE_FETCH_TIMEOUT, retries=IMAGE_FETCH_RETRIES, max_workers=IMAGE_FETCH_MAX_WORKERS, backoff_factor=0.3):
+        self.timeout = timeout
+        self.max_workers = max_workers
+        retry = Retry(total=retries, backoff_factor=backoff_factor,
+                      status_forcelist=(429, 500, 502, 503, 504), allowed_methods=('GET',))
+        adapter = HTTPAdapter(pool_connections=max_workers,
+                              pool_maxsize=max_workers, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def fetch(self, url):
+        """Return the body of url, raising for HTTP errors once retries are exhausted."""
+        response = self.session.get(url, timeout=self.timeout)
+        response.raise_for_status()
+        return response.content
+
+    def fetch_many(self, urls):
+        """Download all urls concurrently; bodies come back in the order of urls."""
+        return list(self._executor.map(self.fetch, urls))
+
+    def fetch_image(self, url, flags=cv2.IMREAD_COLOR):
+        """Download and decode one image to an RGB array."""
+        return decode_image(self.fetch(url), flags)
+
+    def fetch_images(self, urls, flags=cv2.IMREAD_COLOR):
+        """Download and decode a batch of images concurrently, in the order of urls."""
+        return list(self._executor.map(lambda url: self.fetch_image(url, flags), urls))
+
+
+# HTTP session and download pool shared by all remote image reads in the process
+shared_image_fetcher = ImageFetcher()
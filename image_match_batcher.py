@@ -0,0 +1,183 @@
+import json
+import threading
+
+from config import IMAGE_MATCH_BATCH_SIZE, IMAGE_MATCH_BATCH_WINDOW
+from stream_parser import JSON_OUTPUT_PROMPT, extract_data_from_json_response
+
+BATCH_IMAGE_MATCH_PROMPT = """
+Several users have each given a detailed description of an image. Each session below has a 'user_description', a vivid account that could encompass visual aspects, feelings, symbols, and other multi-sensory perceptions, and its own 'image_captions', succinct descriptions of the primary objects and activities in various images, keyed by SYMBOL.
+
+For every session separately, match its 'user_description' against its own 'image_captions' only. Envision the scenes depicted by the captions, filling in the gaps with potential details the description might be referencing, score each caption from 0% (no match) to 100% (perfect match), and keep the 'n_matches' best-matching SYMBOLS, best first.
+
+sessions: {sessions}
+
+Please provide an object keyed by session id, mapping EVERY session id to the list of its best-matching SYMBOLS (ex. {{"a1b2c3d4": ["BTC/USDT"], "e5f6a7b8": ["ETH/USDT"]}}). DO NOT provide me the captions themselves!
+
+"""
+
+
+class _Job:
+    """One session's image match waiting for its batch."""
+    __slots__ = ('session_id', 'user_description', 'caption_map', 'n_matches', 'answer', 'done')
+
+    def __init__(self, session_id, user_description, caption_map, n_matches):
+        self.session_id = session_id
+        self.user_description = user_description
+        self.caption_map = caption_map
+        self.n_matches = n_matches
+        # The matched crypto from the batch answer; None sends the session on its own
+        self.answer = None
+        self.done = threading.Event()
+
+
+def _matched_crypto(answer, caption_map):
+    """The crypto a batch answer names for one session, if it is one of the session's cryptos."""
+    if isinstance(answer, list):
+        answer = answer[0] if answer else None
+    if not isinstance(answer, str):
+        return None
+    # gpt output is always lowercased
+    crypto = answer.upper()
+    return crypto if crypto in caption_map else None
+
+
+class ImageMatchBatcher:
+    """
+    Coalesces the GPT image matches of concurrent sessions into one prompt.
+
+    A worker thread sends the matches waiting for GPT (up to max_batch of
+    them) as one prompt keyed by session id, so concurrent sessions share a
+    single LLM round-trip instead of each making its own against the
+    provider rate limits. The answer is split back out to the waiting
+    sessions. While other GPT calls of the batcher are in flight, matches
+    are gathered for up to window seconds before they are sent. An idle
+    batcher sends a match at once, so a lone operator does not wait.
+
+    A session is matched on its own, through its fallback, when:
+    - it had no company when it was sent
+    - the answer has no valid crypto for it
+    - its batch failed or did not parse
+
+    Parameters:
+    - gpt_handler (GPTHandler): Handler the batched prompts are sent to.
+    - window (float): Seconds matches are gathered for while other calls are in flight.
+    - max_batch (int): Most sessions in one prompt.
+    """
+
+    def __init__(self, gpt_handler, window=IMAGE_MATCH_BATCH_WINDOW, max_batch=IMAGE_MATCH_BATCH_SIZE):
+        self.gpt_handler = gpt_handler
+        self.window = window
+        self.max_batch = max_batch
+        self.matches = 0
+        self.batches = 0
+        self.round_trips = 0
+        self.fallbacks = 0
+        self._pending = []
+        # Batched prompts and single calls sent (or about to be) and not answered yet
+        self._in_flight = 0
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def match(self, session_id, user_description, caption_map, n_matches=1, fallback=None):
+        """
+        The crypto GPT matches to user_description, asked together with concurrent sessions.
+
+        Parameters:
+        - session_id (str): Key of the session in the batched prompt, unique per operator.
+        - user_description (str): The user's description.
+        - caption_map (dict): {crypto: caption list} of the session's images.
+        - n_matches (int): Number of matches GPT ranks.
+        - fallback (callable): Asks GPT for this session alone, when the batch does not answer for it.
+
+        Returns:
+        - str: The matched crypto (uppercased).
+        """
+        job = _Job(session_id, user_description, caption_map, n_matches)
+        with self._condition:
+            self.matches += 1
+            self._pending.append(job)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._gather, name='image-match-batcher', daemon=True)
+                self._thread.start()
+            self._condition.notify_all()
+        job.done.wait()
+        if job.answer is not None:
+            return job.answer
+
+        # The single call was counted in flight when the job was handed back
+        try:
+            if fallback is None:
+                raise ValueError(f"No batched image match for session {session_id}")
+            with self._condition:
+                self.fallbacks += 1
+                self.round_trips += 1
+            return fallback()
+        finally:
+            with self._condition:
+                self._in_flight -= 1
+                self._condition.notify_all()
+
+    def _gather(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._pending)
+                if self._in_flight:
+                    # Under load: wait for company, up to window seconds
+                    self._condition.wait_for(
+                        lambda: len(self._pending) >= self.max_batch, timeout=self.window)
+                batch = self._pending[:self.max_batch]
+                self._pending = self._pending[self.max_batch:]
+                self._in_flight += 1
+            if len(batch) == 1:
+                # Sent on its own through its fallback
+                batch[0].done.set()
+                continue
+            # Ask on its own thread, so the next batch gathers while this one waits on GPT
+            threading.Thread(target=self._ask, args=(batch,),
+                             name='image-match-batch', daemon=True).start()
+
+    def _ask(self, batch):
+        """Send batch as one prompt and hand each session its answer (or None, for its fallback)."""
+        try:
+            jobs = {}
+            for job in batch:
+                # The same session twice in a batch is matched on its own the second time
+                jobs.setdefault(job.session_id, job)
+            sessions = {session_id: {"user_description": job.user_description,
+                                     "image_captions": job.caption_map,
+                                     "n_matches": job.n_matches}
+                        for session_id, job in jobs.items()}
+            prompt = ''.join([BATCH_IMAGE_MATCH_PROMPT.format(
+                sessions=json.dumps(sessions)), JSON_OUTPUT_PROMPT])
+            with self._condition:
+                self.batches += 1
+                self.round_trips += 1
+            try:
+                answers = extract_data_from_json_response(
+                    self.gpt_handler.get_response(prompt))
+            except Exception as e:
+                print(f"Batched image match of {len(jobs)} sessions failed: {e}")
+                answers = {}
+            if not isinstance(answers, dict):
+                answers = {}
+            for session_id, job in jobs.items():
+                job.answer = _matched_crypto(answers.get(session_id), job.caption_map)
+        finally:
+            with self._condition:
+                # The batch is answered; the sessions left without an answer make their own calls
+                self._in_flight += sum(job.answer is None for job in batch) - 1
+                self._condition.notify_all()
+            for job in batch:
+                job.done.set()
+
+    def stats(self):
+        """Matches served, batched prompts, LLM round-trips and sessions matched on their own."""
+        with self._condition:
+            return {
+                "matches": self.matches,
+                "batches": self.batches,
+                "round_trips": self.round_trips,
+                "fallbacks": self.fallbacks,
+                "round_trips_per_match": self.round_trips / self.matches if self.matches else 0.0,
+            }
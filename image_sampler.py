@@ -0,0 +1,88 @@
+import threading
+
+
+class ImageSampler:
+    """
+    Draws image ids uniformly at random without replacement, in O(1) per draw.
+
+    The candidate pool is a sparse Fisher-Yates shuffle over img_ids: a drawn or
+    excluded id is swapped to the end of the pool, and only swapped positions are
+    recorded, so creating a sampler costs nothing and memory grows with the number
+    of draws rather than with the dataset. img_ids is never copied, so it can be a
+    memory-mapped id column. All methods are thread-safe.
+
+    Parameters:
+    - img_ids (sequence): All candidate image ids.
+    - rng: Random source with a `choice(sequence)` method (e.g. QuantumRandom).
+    - position_of (callable): Maps an id to its index in img_ids, or None if absent.
+      Defaults to a dict built from img_ids.
+    """
+
+    def __init__(self, img_ids, rng, position_of=None):
+        self.img_ids = img_ids
+        self.rng = rng
+        self.size = len(img_ids)
+        if position_of is None:
+            positions = {img_id: i for i, img_id in enumerate(img_ids)}
+            position_of = positions.get
+        self._initial_position = position_of
+        # position -> id and id -> position, for entries moved by a swap
+        self._moved_ids = {}
+        self._moved_positions = {}
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, img_id):
+        with self._lock:
+            position = self._position(img_id)
+            return position is not None and position < self.size
+
+    def _id_at(self, position):
+        img_id = self._moved_ids.get(position)
+        return int(self.img_ids[position]) if img_id is None else img_id
+
+    def _position(self, img_id):
+        position = self._moved_positions.get(img_id)
+        return self._initial_position(img_id) if position is None else position
+
+    def _swap(self, i, j):
+        id_i, id_j = self._id_at(i), self._id_at(j)
+        self._moved_ids[i], self._moved_positions[id_j] = id_j, i
+        self._moved_ids[j], self._moved_positions[id_i] = id_i, j
+
+    def draw(self):
+        """Remove and return a random id from the pool."""
+        with self._lock:
+            if self.size == 0:
+                raise IndexError("No images left to sample.")
+            position = self.rng.choice(range(self.size))
+            self.size -= 1
+            self._swap(position, self.size)
+            return self._id_at(self.size)
+
+    def draw_many(self, k):
+        """Remove and return up to k distinct random ids."""
+        with self._lock:
+            return [self.draw() for _ in range(min(k, self.size))]
+
+    def exclude(self, img_id):
+        """Remove img_id from the pool, if it is in it."""
+        with self._lock:
+            position = self._position(img_id)
+            if position is not None and position < self.size:
+                self.size -= 1
+                self._swap(position, self.size)
+
+    def exclude_many(self, img_ids):
+        for img_id in img_ids:
+            self.exclude(img_id)
+
+    def release(self, img_id):
+        """Put a drawn or excluded id back into the pool."""
+        with self._lock:
+            position = self._position(img_id)
+            if position is not None and position >= self.size:
+                self._swap(position, self.size)
+                self.size += 1
@@ -0,0 +1,193 @@
+import argparse
+import json
+import os
+from functools import lru_cache
+from multiprocessing import Pool
+
+import numpy as np
+from scipy.spatial import KDTree
+from skimage.color import rgb2lab
+
+from config import PALETTE_DECODE_REDUCTION
+from coco_snapshot import CocoSnapshot, snapshot_dir
+from diversity_handler import DiversityHandler, palette_vectors
+from image_cache import ImageCache
+
+# Palette parameters the index is built with (the extract_palette defaults)
+DEFAULT_PALETTE_PARAMS = {'pixel_size': 5, 'similarity_threshold': 50}
+
+
+def palette_index_dir(data_dir, data_type):
+    return f'{data_dir}/palettes/{data_type}'
+
+
+class PaletteIndex:
+    """
+    Precomputed color palettes for every image of a COCO split.
+
+    The palettes are stored as fixed-width arrays (one row per image, padded to
+    pixel_size**2 colors) in .npy files that are memory-mapped on load:
+    - ids.npy: sorted image ids, the id-to-row index
+    - lengths.npy: number of palette colors of each row
+    - rgb.npy: (n_images, width, 3) uint8 palette colors
+    - lab.npy: (n_images, width, 3) float32 Lab values of the palette colors
+    - dominance.npy: (n_images, width) float64 dominance of each color
+    - meta.json: parameters the palettes were extracted with, including the
+      decode_reduction the images were decoded at
+    """
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        with open(f'{index_dir}/meta.json', 'r') as file:
+            self.meta = json.load(file)
+        self.ids = np.load(f'{index_dir}/ids.npy', mmap_mode='r')
+        self.lengths = np.load(f'{index_dir}/lengths.npy', mmap_mode='r')
+        self.rgb = np.load(f'{index_dir}/rgb.npy', mmap_mode='r')
+        self.lab = np.load(f'{index_dir}/lab.npy', mmap_mode='r')
+        self.dominance = np.load(f'{index_dir}/dominance.npy', mmap_mode='r')
+        # Palette vectors and their KDTrees, by number of colors
+        self._vectors = {}
+        self._vector_trees = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, img_id):
+        return self.row(img_id) is not None
+
+    def row(self, img_id):
+        """Row of img_id in the index arrays, or None if the image is not covered."""
+        row = int(np.searchsorted(self.ids, img_id))
+        if row < len(self.ids) and self.ids[row] == img_id:
+            return row
+        return None
+
+    def matches(self, pixel_size, similarity_threshold, apply_clustering=False, decode_reduction=1):
+        """Whether palettes extracted with these parameters can be served from the index."""
+        # Indexes written before decode_reduction was recorded decoded at full resolution
+        return (not apply_clustering and pixel_size == self.meta['pixel_size']
+                and similarity_threshold == self.meta['similarity_threshold']
+                and decode_reduction == self.meta.get('decode_reduction', 1))
+
+    def palette(self, img_id):
+        """The (color, dominance) palette of img_id, as extract_palette returns it, or None."""
+        row = self.row(img_id)
+        if row is None:
+            return None
+        length = self.lengths[row]
+        colors = self.rgb[row, :length].tolist()
+        dominance = self.dominance[row, :length].tolist()
+        return [(tuple(color), value) for color, value in zip(colors, dominance)]
+
+    def lab_colors(self, img_id):
+        """(n_colors, 3) Lab values of the palette of img_id, or None."""
+        row = self.row(img_id)
+        if row is None:
+            return None
+        return np.asarray(self.lab[row, :self.lengths[row]])
+
+    def palette_vectors(self, n_colors=3):
+        """(n_images, 3 * n_colors) palette vectors of all rows, see diversity_handler.palette_vectors."""
+        if n_colors not in self._vectors:
+            self._vectors[n_colors] = palette_vectors(
+                self.lab, self.dominance, self.lengths, n_colors=n_colors)
+        return self._vectors[n_colors]
+
+    def vector_tree(self, n_colors=3):
+        """KDTree over palette_vectors(n_colors), built on first use."""
+        if n_colors not in self._vector_trees:
+            self._vector_trees[n_colors] = KDTree(
+                self.palette_vectors(n_colors))
+        return self._vector_trees[n_colors]
+
+    @classmethod
+    def load(cls, data_dir='./coco', data_type='val2017'):
+        """The index of a COCO split, or None if it has not been built."""
+        return _load_palette_index(palette_index_dir(data_dir, data_type))
+
+    @classmethod
+    def build(cls, data_dir='./coco', data_type='val2017', processes=None, verbose=True,
+              decode_reduction=PALETTE_DECODE_REDUCTION):
+        """
+        Extract the palette of every image of a COCO split in parallel and write the index.
+
+        Parameters:
+        - data_dir (str): Path to the directory containing the COCO data.
+        - data_type (str): COCO split to index (e.g., 'val2017', 'train2017').
+        - processes (int): Worker processes, defaults to the CPU count.
+        - decode_reduction (int): Scale the JPEGs are decoded at (1, 2, 4 or 8), as in live extraction.
+
+        Returns:
+        - PaletteIndex: The freshly written index.
+        """
+        coco = CocoSnapshot.load_or_build(
+            f'{data_dir}/annotations/captions_{data_type}.json', snapshot_dir(data_dir, data_type))
+        imgs = sorted(coco.loadImgs(coco.getImgIds()),
+                      key=lambda img: img['id'])
+        image_dir = f'{data_dir}/images/{data_type}'
+        width = DEFAULT_PALETTE_PARAMS['pixel_size'] ** 2
+
+        ids = np.array([img['id'] for img in imgs], dtype=np.int64)
+        lengths = np.zeros(len(imgs), dtype=np.int16)
+        rgb = np.zeros((len(imgs), width, 3), dtype=np.uint8)
+        dominance = np.zeros((len(imgs), width), dtype=np.float64)
+
+        jobs = [(image_dir, img, decode_reduction) for img in imgs]
+        with Pool(processes) as pool:
+            for row, palette in enumerate(pool.imap(_extract_palette_job, jobs, chunksize=16)):
+                lengths[row] = len(palette)
+                for col, (color, value) in enumerate(palette):
+                    rgb[row, col] = color
+                    dominance[row, col] = value
+                if verbose and (row + 1) % 500 == 0:
+                    print(f"Indexed palettes: {row + 1}/{len(imgs)}")
+
+        lab = rgb2lab(rgb).astype(np.float32)
+
+        index_dir = palette_index_dir(data_dir, data_type)
+        os.makedirs(index_dir, exist_ok=True)
+        # meta.json is written last, so a half-written index is never loaded
+        if os.path.exists(f'{index_dir}/meta.json'):
+            os.remove(f'{index_dir}/meta.json')
+        np.save(f'{index_dir}/ids.npy', ids)
+        np.save(f'{index_dir}/lengths.npy', lengths)
+        np.save(f'{index_dir}/rgb.npy', rgb)
+        np.save(f'{index_dir}/lab.npy', lab)
+        np.save(f'{index_dir}/dominance.npy', dominance)
+        with open(f'{index_dir}/meta.json', 'w') as file:
+            json.dump(dict(DEFAULT_PALETTE_PARAMS, data_type=data_type,
+                      decode_reduction=decode_reduction, n_images=len(imgs)), file)
+
+        _load_palette_index.cache_clear()
+        return cls(index_dir)
+
+
+@lru_cache(maxsize=None)
+def _load_palette_index(index_dir):
+    if not os.path.exists(f'{index_dir}/meta.json'):
+        return None
+    return PaletteIndex(index_dir)
+
+
+def _extract_palette_job(job):
+    image_dir, image_obj, decode_reduction = job
+    # The same decode path as live extraction, without caching the images of a one-off pass
+    handler = DiversityHandler(image_cache=ImageCache(max_bytes=0),
+                               decode_reduction=decode_reduction, image_dir=image_dir)
+    return handler.extract_palette(image_obj, **DEFAULT_PALETTE_PARAMS)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Precompute the color palettes of a COCO split.")
+    parser.add_argument('--data_dir', default='./coco')
+    parser.add_argument('--data_type', default='val2017')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--decode_reduction', type=int, default=PALETTE_DECODE_REDUCTION)
+    args = parser.parse_args()
+
+    index = PaletteIndex.build(
+        data_dir=args.data_dir, data_type=args.data_type, processes=args.processes,
+        decode_reduction=args.decode_reduction)
+    print(
+        f"Wrote {len(index)} palettes to {palette_index_dir(args.data_dir, args.data_type)}")
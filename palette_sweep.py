@@ -0,0 +1,95 @@
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from itertools import product
+
+from diversity_handler import DiversityHandler
+
+
+class PaletteSweep:
+    """
+    Runs extract_palette over a grid of parameters for one image, sharing work down the grid.
+
+    The stages of palette extraction depend on a growing prefix of the parameters:
+    - pixelation and color deduplication only on pixel_size
+    - threshold filtering on (pixel_size, similarity_threshold)
+    - clustering on the number of clusters actually used, which is
+      min(n_clusters, number of filtered colors); without clustering
+      n_clusters is ignored altogether
+
+    Each stage is computed once per distinct key and memoized, so e.g. the
+    432 combinations of /test_diversity_handler pixelate the image only 6 times.
+    Combinations run on a thread pool and are yielded as they complete.
+    """
+
+    def __init__(self, image, max_workers=None):
+        self.image = image
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self._memo = {}
+        self._lock = threading.Lock()
+
+    def _memoized(self, key, compute):
+        """Return compute() for key, computing it once even when requested concurrently."""
+        with self._lock:
+            future = self._memo.get(key)
+            owner = future is None
+            if owner:
+                future = self._memo[key] = Future()
+        if owner:
+            try:
+                future.set_result(compute())
+            except Exception as e:
+                future.set_exception(e)
+        return future.result()
+
+    def candidates(self, pixel_size):
+        return self._memoized(('candidates', pixel_size), lambda: DiversityHandler.palette_candidates(
+            self.image, pixel_size))
+
+    def filtered_colors(self, pixel_size, similarity_threshold):
+        return self._memoized(('filtered', pixel_size, similarity_threshold), lambda: DiversityHandler.filter_colors(
+            self.candidates(pixel_size)[0], similarity_threshold))
+
+    def palette(self, pixel_size, similarity_threshold, apply_clustering, n_clusters):
+        """The palette extract_palette returns for these parameters."""
+        unique_colors = self.filtered_colors(pixel_size, similarity_threshold)
+        if apply_clustering:
+            key = ('palette', pixel_size, similarity_threshold,
+                   min(n_clusters, len(unique_colors)))
+        else:
+            key = ('palette', pixel_size, similarity_threshold, None)
+
+        def compute():
+            candidates, counts = self.candidates(pixel_size)
+            colors = unique_colors
+            if apply_clustering:
+                colors = DiversityHandler.cluster_colors(colors, n_clusters)
+            return DiversityHandler.color_dominance(candidates, counts, colors, pixel_size)
+
+        return self._memoized(key, compute)
+
+    def run(self, pixel_sizes, similarity_thresholds, apply_clusterings, n_clusters_list):
+        """
+        Yield (params, palette) for every combination of the parameter lists, in completion order.
+
+        params is a dict with the pixel_size, similarity_threshold, apply_clustering
+        and n_clusters of the combination.
+        """
+        grid = list(product(pixel_sizes, similarity_thresholds,
+                    apply_clusterings, n_clusters_list))
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self.palette, *params): params
+                       for params in grid}
+            try:
+                for future in as_completed(futures):
+                    pixel_size, similarity_threshold, apply_clustering, n_clusters = futures[future]
+                    yield {
+                        'pixel_size': pixel_size,
+                        'similarity_threshold': similarity_threshold,
+                        'apply_clustering': apply_clustering,
+                        'n_clusters': n_clusters,
+                    }, future.result()
+            finally:
+                # The client may stop reading the stream midway
+                for future in futures:
+                    future.cancel()
@@ -0,0 +1,165 @@
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+from config import GPT_BREAKER_COOLDOWN, GPT_BREAKER_FAILURES, GPT_HEALTH_WINDOW
+
+
+class NoProviderAvailable(Exception):
+    """Raised when the circuit breakers of all providers are open."""
+
+
+def provider_name(provider):
+    return getattr(provider, '__name__', None) or str(provider)
+
+
+class _Provider:
+    """Rolling measurements and circuit breaker state of one provider."""
+
+    def __init__(self, window):
+        # Latencies (seconds) of recent answers, and recent outcomes (True = success)
+        self.latencies = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)
+        # Seconds recent lost races had run when they were cancelled (the provider took at least that long)
+        self.lower_bounds = deque(maxlen=window)
+        self.consecutive_failures = 0
+        # 'closed' (in use), 'open' (skipped until opened_at + cooldown) or 'half_open' (one trial call)
+        self.state = 'closed'
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.last_error = None
+
+
+class ProviderHealth:
+    """
+    Live health of g4f providers: rolling latency percentiles, error rates and circuit breakers.
+
+    Every call outcome is recorded per provider over a window of the last
+    `window` calls. After `failures` consecutive failures a provider's breaker
+    opens and the provider is skipped for `cooldown` seconds; it is then
+    half-open and gets a single trial call, which closes the breaker on success
+    or reopens it on failure.
+
+    select() orders providers by these live stats: by error rate, then by
+    median latency, with providers not measured yet first, so each gets measured.
+    The lower bounds of lost races only raise the latency a provider is ranked
+    by; they are kept out of the latency percentiles of stats().
+    """
+
+    def __init__(self, window=GPT_HEALTH_WINDOW, failures=GPT_BREAKER_FAILURES, cooldown=GPT_BREAKER_COOLDOWN):
+        self.window = window
+        self.failures = failures
+        self.cooldown = cooldown
+        self._providers = {}
+        self._lock = threading.Lock()
+
+    def _get(self, provider):
+        if provider not in self._providers:
+            self._providers[provider] = _Provider(self.window)
+        return self._providers[provider]
+
+    def record_success(self, provider, latency):
+        with self._lock:
+            health = self._get(provider)
+            health.latencies.append(latency)
+            health.outcomes.append(True)
+            health.consecutive_failures = 0
+            health.state = 'closed'
+            health.trial_in_flight = False
+
+    def record_lower_bound(self, provider, elapsed):
+        """provider had not answered after elapsed seconds (it lost a race); not counted as an outcome."""
+        with self._lock:
+            health = self._get(provider)
+            health.lower_bounds.append(elapsed)
+            health.trial_in_flight = False
+
+    def release(self, provider):
+        """A call selected for provider was dropped before it ran: free its trial reservation, record nothing."""
+        with self._lock:
+            self._get(provider).trial_in_flight = False
+
+    def record_failure(self, provider, error=None):
+        with self._lock:
+            health = self._get(provider)
+            health.outcomes.append(False)
+            health.consecutive_failures += 1
+            health.last_error = repr(error) if error is not None else None
+            health.trial_in_flight = False
+            if health.state == 'half_open' or health.consecutive_failures >= self.failures:
+                health.state = 'open'
+                health.opened_at = time.monotonic()
+
+    def _available(self, health, now):
+        """Whether a call may go to the provider; moves open breakers past their cooldown to half-open."""
+        if health.state == 'open' and now - health.opened_at >= self.cooldown:
+            health.state = 'half_open'
+        if health.state == 'half_open':
+            return not health.trial_in_flight
+        return health.state == 'closed'
+
+    @staticmethod
+    def _rank(health):
+        error_rate = health.outcomes.count(False) / len(health.outcomes) if health.outcomes else 0.0
+        latency = float(np.median(health.latencies)) if health.latencies else 0.0
+        if health.lower_bounds:
+            # A provider that keeps losing races is at least as slow as it was when it lost
+            latency = max(latency, float(np.median(health.lower_bounds)))
+        return error_rate, latency
+
+    def select(self, providers, k):
+        """
+        Up to k providers whose breaker lets a call through, best first.
+
+        Half-open providers that are selected get their trial call reserved.
+
+        Raises:
+        - NoProviderAvailable: If the breakers of all providers are open.
+        """
+        now = time.monotonic()
+        with self._lock:
+            available = [provider for provider in providers
+                         if self._available(self._get(provider), now)]
+            if not available:
+                raise NoProviderAvailable(
+                    f"Circuit breakers open for all of {[provider_name(provider) for provider in providers]}")
+            selected = sorted(available, key=lambda provider: self._rank(
+                self._providers[provider]))[:k]
+            for provider in selected:
+                if self._providers[provider].state == 'half_open':
+                    self._providers[provider].trial_in_flight = True
+            return selected
+
+    def stats(self, provider):
+        """Latency percentiles (seconds), error rate and breaker state of provider."""
+        with self._lock:
+            health = self._get(provider)
+            latencies = np.array(health.latencies)
+            p50, p90, p99 = np.percentile(latencies, [50, 90, 99]).tolist() if len(latencies) \
+                else (None, None, None)
+            return {
+                "provider": provider_name(provider),
+                "calls": len(health.outcomes),
+                "error_rate": health.outcomes.count(False) / len(health.outcomes) if health.outcomes else 0.0,
+                "p50": p50,
+                "p90": p90,
+                "p99": p99,
+                "lost_races": len(health.lower_bounds),
+                "state": health.state,
+                "consecutive_failures": health.consecutive_failures,
+                "last_error": health.last_error,
+            }
+
+    def leaderboard(self, providers=None):
+        """stats() of providers (default: all seen so far), best first."""
+        with self._lock:
+            providers = list(self._providers) if providers is None else list(providers)
+        rows = [self.stats(provider) for provider in providers]
+        return sorted(rows, key=lambda row: (row['state'] == 'open', row['error_rate'],
+                                             float('inf') if row['p50'] is None else row['p50']))
+
+
+# Provider health shared by every GPTHandler in the process
+shared_provider_health = ProviderHealth()
@@ -1,9 +1,60 @@
 import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
 from coco_handler import CocoHandler
 from crypto_handler import CryptoHandler
+from diverse_set_pool import DiverseSetPool
+from image_match_batcher import ImageMatchBatcher
+from config import IMAGE_MATCH_GPT_MARGIN, RV_SESSION_IDLE_TIMEOUT, RV_SESSIONS_MAX
 from gpt_handler import GPTHandler, JSON_OUTPUT_PROMPT, LIST_OUTPUT_PROMPT, extract_data_from_json_response
 
 
+class SessionBusy(Exception):
+    """Raised when a session starts while another one is trading through the CryptoHandler."""
+
+
+class CryptoHandlerGuard:
+    """
+    Hands the process's CryptoHandler to one RVSession at a time.
+
+    There is a single Freqtrade instance behind the CryptoHandler: the pairs it
+    watches and the buy and sell orders can only belong to one session. A
+    session acquires the guard when it starts and releases it once its results
+    are in (or it is reset), and other sessions are refused in the meantime
+    rather than overwriting its pairs and trading against its selection.
+    """
+
+    def __init__(self):
+        self._owner = None
+        self._lock = threading.Lock()
+
+    @property
+    def owner(self):
+        """session_id of the session trading, or None."""
+        return self._owner
+
+    def acquire(self, session_id):
+        """
+        Make session_id the trading session.
+
+        Raises:
+        - SessionBusy: If another session is trading.
+        """
+        with self._lock:
+            if self._owner not in (None, session_id):
+                raise SessionBusy(
+                    "Another operator's session is trading, try again once its results are in.")
+            self._owner = session_id
+
+    def release(self, session_id):
+        """End the trading of session_id; does nothing if it is not the trading session."""
+        with self._lock:
+            if self._owner == session_id:
+                self._owner = None
+
+
 class RVSession:
     """
     1. The user initiates an ARV session by selecting a 'start time' slightly in the future, and an 'end time' beyond that.
@@ -17,11 +68,20 @@ class RVSession:
     It's vital to note that the associated image for the top-performing crypto is ONLY known at the 'end time'. Before this point, it remains undisclosed.
     """
 
-    def __init__(self, all_trading_pairs: list[str], coco_handler: CocoHandler, crypto_handler: CryptoHandler, gpt_handler: GPTHandler):
+    def __init__(self, all_trading_pairs: list[str], coco_handler: CocoHandler, crypto_handler: CryptoHandler, gpt_handler: GPTHandler, diverse_set_pool: DiverseSetPool = None,
+                 image_match_batcher: ImageMatchBatcher = None, session_id: str = None, crypto_guard: CryptoHandlerGuard = None):
         self.all_trading_pairs = all_trading_pairs
         self.coco_handler = coco_handler
+        # Ready diverse image sets; sessions fall back to generating one when the pool has none
+        self.diverse_set_pool = diverse_set_pool
         self.crypto_handler = crypto_handler
         self.gpt_handler = gpt_handler
+        # Shares GPT image matches with concurrent sessions; None asks GPT for this session alone
+        self.image_match_batcher = image_match_batcher
+        # Key of this session in batched image match prompts, unique per operator
+        self.session_id = session_id or uuid.uuid4().hex[:8]
+        # Lets one session at a time trade through crypto_handler when it is shared; None does not check
+        self.crypto_guard = crypto_guard
         self.buy_time = None
         self.sell_time = None
         self.user_description = None
@@ -36,25 +96,40 @@ class RVSession:
         """
         Initiates the ARV session by associating random images from the COCO dataset
         with different cryptocurrencies.
+
+        Raises:
+        - SessionBusy: If another session holds the crypto_guard.
         """
+        if self.crypto_guard is not None:
+            self.crypto_guard.acquire(self.session_id)
+        try:
+            self._start_session(n_cryptos)
+        except BaseException:
+            self.release_crypto_handler()
+            raise
+
+    def _start_session(self, n_cryptos):
         self.n_cryptos = n_cryptos
         # Sample n_cryptos from the crypto_list
         self.sampled_cryptos = random.sample(self.all_trading_pairs, n_cryptos)
 
-        # Fetch n_cryptos diverse images and their captions
-        diverse_image_set = self.coco_handler.get_diverse_image_set(
-            n=self.n_cryptos)
+        # Fetch n_cryptos diverse images, from the warm pool when one is ready
+        diverse_image_set = None
+        if self.diverse_set_pool is not None:
+            diverse_image_set = self.diverse_set_pool.take(self.n_cryptos)
+        if diverse_image_set is None:
+            diverse_image_set = self.coco_handler.get_diverse_image_set(
+                n=self.n_cryptos)
 
         # Create a dictionary that maps each cryptocurrency to its associated image object
         self.crypto_image_map = {}
-        for crypto, img in zip(self.sampled_cryptos, diverse_image_set):
-            ann_ids = self.coco_handler.coco.getAnnIds(imgIds=img['id'])
-            anns = self.coco_handler.coco.loadAnns(ann_ids)
-            captions = [ann['caption'] for ann in anns]
+        caption_lists = self.coco_handler.captions_many(
+            [img['id'] for img in diverse_image_set])
+        for crypto, img, captions in zip(self.sampled_cryptos, diverse_image_set, caption_lists):
             self.crypto_image_map[crypto] = {
                 "url": img['coco_url'],
-                "caption_list": captions,
-                "dominant_colors": img["dominant_colors"]
+                "caption_list": list(captions),
+                "dominant_colors": img["color_palette"]
             }
 
         # communicate to cryptohandler (wraps freqtradehandler) to start communicating (and receiving data) with strategy
@@ -64,6 +139,12 @@ class RVSession:
         # clear files for communicating to cryptohandler (wraps freqtradehandler)
 
         self.crypto_handler.reset_session()
+        self.release_crypto_handler()
+
+    def release_crypto_handler(self):
+        """Let other sessions trade, once this session's results are in."""
+        if self.crypto_guard is not None:
+            self.crypto_guard.release(self.session_id)
 
     def get_crypto_caption_map(self):
         """
@@ -84,12 +165,59 @@ class RVSession:
     def record_rv_session(self, description):
         self.user_description = description
 
-    def image_match(self, n_matches=1, debug=True):
+    def image_match(self, n_matches=1, debug=True, gpt_margin=IMAGE_MATCH_GPT_MARGIN):
+        """
+        Match the user's description to the caption lists of the session's images.
+
+        The caption lists are ranked locally with BM25 (CaptionMatcher). GPT is
+        asked only when the match is ambiguous: when the two best scores are
+        within gpt_margin of the best one (relative) or nothing matched at all.
+        With an image_match_batcher, the GPT match is asked together with those of
+        concurrent sessions. If GPT fails or names no crypto of the session, the
+        local best match is used.
+
+        Returns:
+        - str: The matched crypto symbol.
+        """
         if debug:
             print("User Description:", self.user_description)
             print("Crypto Image Map:", self.crypto_image_map)
             print("Number of Matches:", n_matches)
 
+        ranking = self.coco_handler.caption_matcher().rank(
+            self.user_description, self.get_crypto_caption_map())
+        if debug:
+            print("Local ranking:", ranking)
+
+        best_score = ranking[0][1]
+        second_score = ranking[1][1] if len(ranking) > 1 else 0.0
+        ambiguous = best_score <= 0 or (
+            best_score - second_score) / best_score < gpt_margin
+        self.matched_crypto = ranking[0][0]
+
+        if ambiguous:
+            try:
+                if self.image_match_batcher is not None:
+                    gpt_match = self.image_match_batcher.match(
+                        self.session_id, self.user_description, self.get_crypto_caption_map(), n_matches,
+                        fallback=lambda: self._gpt_image_match(n_matches, debug))
+                else:
+                    gpt_match = self._gpt_image_match(n_matches, debug)
+                if gpt_match in self.crypto_image_map:
+                    self.matched_crypto = gpt_match
+                elif debug:
+                    print(f"GPT matched unknown crypto {gpt_match}, using the local match.")
+            except Exception as e:
+                if debug:
+                    print(f"GPT image match failed ({e}), using the local match.")
+
+        if debug:
+            print("Matched Crypto:", self.matched_crypto)
+
+        return self.matched_crypto
+
+    def _gpt_image_match(self, n_matches=1, debug=True):
+        """The crypto GPT matches to the user's description (one LLM round-trip)."""
         IMAGE_MATCH_PROMPT = """
         Given a user's detailed description of an image, your task is to match this description against a list of image captions. The user's description, labeled 'user_description', is a vivid account that could encompass visual aspects, feelings, symbols, and other multi-sensory perceptions. In contrast, the 'image_captions' list contains succinct descriptions of the primary objects and activities in various images without delving into specific details. 
 
@@ -126,15 +254,8 @@ class RVSession:
         if debug:
             print("Extracted matched_captions:", matched_captions)
 
-        self.matched_crypto = matched_captions[0]  # top prediction
-
-        # uppercase, gpt output is always lowercased
-        self.matched_crypto = self.matched_crypto.upper()
-
-        if debug:
-            print("Matched Crypto:", self.matched_crypto)
-
-        return self.matched_crypto
+        # top prediction, uppercased: gpt output is always lowercased
+        return matched_captions[0].upper()
 
     def buy_matched_crypto(self):
         symbol = self.matched_crypto
@@ -149,3 +270,65 @@ class RVSession:
     def get_associated_image(self, crypto_symbol):
         # Fetch the image associated with the given crypto_symbol from our mapping
         return self.crypto_image_map.get(crypto_symbol)
+
+
+class RVSessions:
+    """
+    The RVSessions of the web app's operators, by session id, bounded in number and idle time.
+
+    A session is created on its operator's first request. Sessions without a
+    request for idle_timeout seconds are dropped, and beyond max_sessions the
+    least recently used ones are, except for the session trading through the
+    crypto_guard, which is only dropped once idle (releasing the guard).
+
+    Parameters:
+    - create (callable): Returns a new RVSession for create(session_id).
+    - max_sessions (int): Most sessions kept.
+    - idle_timeout (float): Seconds without a request after which a session is dropped.
+    - crypto_guard (CryptoHandlerGuard): Guard of the sessions' shared CryptoHandler, if any.
+    """
+
+    def __init__(self, create, max_sessions=RV_SESSIONS_MAX, idle_timeout=RV_SESSION_IDLE_TIMEOUT, crypto_guard=None):
+        self.create = create
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.crypto_guard = crypto_guard
+        # session_id -> (RVSession, time of its last request), least recently used first
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        """The RVSession of session_id, created if it has none (or it was dropped)."""
+        now = time.monotonic()
+        with self._lock:
+            if session_id in self._sessions:
+                rv_session, _ = self._sessions.pop(session_id)
+            else:
+                rv_session = self.create(session_id)
+            self._sessions[session_id] = (rv_session, now)
+            self._expire(now)
+            return rv_session
+
+    def pop(self, session_id):
+        """Drop the RVSession of session_id, returning it (or None)."""
+        with self._lock:
+            rv_session, _ = self._sessions.pop(session_id, (None, None))
+            return rv_session
+
+    def _expire(self, now):
+        """Drop idle sessions, then the least recently used ones over max_sessions; called with the lock held."""
+        while self._sessions:
+            session_id, (rv_session, last_used) = next(iter(self._sessions.items()))
+            if now - last_used < self.idle_timeout:
+                break
+            del self._sessions[session_id]
+            rv_session.release_crypto_handler()
+        trading = self.crypto_guard.owner if self.crypto_guard is not None else None
+        for session_id in list(self._sessions):
+            if len(self._sessions) <= self.max_sessions:
+                break
+            if session_id != trading:
+                del self._sessions[session_id]
+
+    def __len__(self):
+        return len(self._sessions)
@@ -0,0 +1,223 @@
+import json
+
+JSON_OUTPUT_PROMPT = """Please respond in the following exact format: { \"data\": \"YOUR RESPONSE HERE\" }. Do not change the structure, capitalization, or formatting. DO NOT include any for-human-user text or comments, you are communicating with a computer software program via specified format ONLY! If using in with other formatting like lists, dicts,obj, literals, strings, etc. always set it as the value to the "data" key!"""
+
+LIST_OUTPUT_PROMPT = "Provide your response as a comma-separated list. Include the list brackets `[]` surrounding your list! (ex. [`'a`', 2]). Strictly follow the format. "
+
+_WHITESPACE = ' \t\r\n'
+_DATA_KEY = '"data"'
+
+
+def _unquote(text):
+    """Make a list or object written with single quotes and backticks valid JSON."""
+    return text.replace("'", '"').replace("`", "")
+
+
+def _decode(object_text, value_text):
+    """The value of a complete { "data": ... } object, with the quoting quirks of GPT answers fixed."""
+    try:
+        data = json.loads(object_text)['data']
+    except json.JSONDecodeError:
+        # e.g. a bare list with single-quoted items: { "data": ['a', 'b'] }
+        data = json.loads(_unquote(value_text.strip()))
+    # A string representation of a list or object, e.g. "[`'a'`, `'b'`]"
+    if isinstance(data, str) and (data.startswith('[') and data.endswith(']') or
+                                  data.startswith('{') and data.endswith('}')):
+        return json.loads(_unquote(data))
+    return data
+
+
+class ParsedResponse(str):
+    """A response text whose { "data": ... } object was parsed while it streamed in; data is its value."""
+
+    def __new__(cls, text, data):
+        response = super().__new__(cls, text)
+        response.data = data
+        return response
+
+
+class DataObjectParser:
+    """
+    Incremental parser of the first { "data": ... } object of a streamed GPT response.
+
+    feed() takes the response chunk by chunk and returns True as soon as a
+    complete object whose value parses has arrived, so the caller can close
+    the stream instead of reading the chatter after it. Only the new
+    characters of each chunk are scanned: the open brackets and string state
+    carry over from one chunk to the next, and the chunks are kept in a list,
+    so a long response is not copied once per chunk. An object that does not
+    parse or has unbalanced brackets is skipped, and the scan resumes after
+    its opening brace.
+
+    The value is decoded with the quirks extract_data_from_json_response has
+    always handled: a string holding a list or object (e.g. "[`'a'`, `'b'`]") is
+    parsed after turning single quotes into double quotes and dropping
+    backticks, and a bare value that is not valid JSON gets the same treatment.
+
+    Attributes:
+    - text (str): The response received so far; once done, up to the end of the object.
+    - done (bool): Whether a complete object was parsed.
+    - data: The value of "data", once done.
+    - error (Exception): Why the last complete object did not parse, if one did not.
+    """
+
+    def __init__(self):
+        self.done = False
+        self.data = None
+        self.error = None
+        # The chunks received, joined when text is read
+        self._chunks = []
+        self._length = 0
+        # 'seek' (looking for '{'), 'key' (matching "data" and ':') or 'value'
+        self._state = 'seek'
+        self._matched = 0
+        # Position of the current object's '{' in the response, and the parts of
+        # it received in earlier chunks
+        self._start = 0
+        self._window = []
+        self._window_length = 0
+        # Where the current object begins in the text being scanned
+        self._piece = 0
+        # Bounds of the value within the object
+        self._value_start = 0
+        self._value_end = None
+        # Closing brackets expected by the open objects and lists, innermost last
+        self._closers = []
+        self._in_string = False
+        self._escape = False
+
+    @property
+    def text(self):
+        if len(self._chunks) > 1:
+            self._chunks = [''.join(self._chunks)]
+        return self._chunks[0] if self._chunks else ''
+
+    def feed(self, chunk):
+        """
+        Add the next chunk of the response.
+
+        Returns:
+        - bool: Whether a complete { "data": ... } object has arrived (data is then set).
+        """
+        if self.done:
+            return True
+        base = self._length
+        self._chunks.append(chunk)
+        self._length += len(chunk)
+        return self._scan(chunk, base)
+
+    def _scan(self, text, base):
+        """Scan text, the part of the response from position base on."""
+        pos = 0
+        self._piece = 0
+        while True:
+            if self._state == 'seek':
+                start = text.find('{', pos)
+                if start == -1:
+                    return False
+                self._start = base + start
+                self._window = []
+                self._window_length = 0
+                self._piece = start
+                self._state = 'key'
+                self._matched = 0
+                pos = start + 1
+            if self._state == 'key':
+                pos = self._scan_key(text, pos)
+            if self._state == 'value':
+                pos, closed = self._scan_value(text, pos)
+                if closed and self._finish(text, pos):
+                    return True
+            if pos is None or self._state == 'seek':
+                # Skipped: rescan the object from after its opening brace
+                text = ''.join(self._window) + text[self._piece:]
+                base, pos, self._piece = self._start, 1, 0
+                self._state = 'seek'
+            elif pos >= len(text):
+                # Keep the part of the object in this chunk for when it closes
+                self._window.append(text[self._piece:])
+                self._window_length += len(text) - self._piece
+                return False
+
+    def _offset(self, pos):
+        """Position in the current object of text[pos]."""
+        return self._window_length + pos - self._piece
+
+    def _scan_key(self, text, pos):
+        """Match whitespace, "data", whitespace and ':' after the opening brace; None if they do not follow."""
+        while pos < len(text):
+            char = text[pos]
+            if self._matched < len(_DATA_KEY):
+                if char == _DATA_KEY[self._matched]:
+                    self._matched += 1
+                elif self._matched > 0 or char not in _WHITESPACE:
+                    return None
+            elif char == ':':
+                self._state = 'value'
+                self._value_start = self._offset(pos + 1)
+                self._value_end = None
+                self._closers = ['}']
+                self._in_string = False
+                self._escape = False
+                return pos + 1
+            elif char not in _WHITESPACE:
+                return None
+            pos += 1
+        return pos
+
+    def _scan_value(self, text, pos):
+        """Scan up to the brace closing the object: (position, whether it closed), position None if unbalanced."""
+        while pos < len(text):
+            char = text[pos]
+            pos += 1
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == '\\':
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char == '[':
+                self._closers.append(']')
+            elif char == '{':
+                self._closers.append('}')
+            elif char in ']}':
+                if char != self._closers.pop():
+                    self.error = ValueError(f"Unbalanced '{char}' in the data object")
+                    return None, False
+                if not self._closers:
+                    return pos, True
+            elif char == ',' and len(self._closers) == 1 and self._value_end is None:
+                # Further keys follow the value
+                self._value_end = self._offset(pos - 1)
+        return pos, False
+
+    def _finish(self, text, pos):
+        """Decode the object that closed before text[pos]; False (and skip it) if it does not parse."""
+        object_text = ''.join(self._window) + text[self._piece:pos]
+        value_end = self._value_end if self._value_end is not None else len(object_text) - 1
+        try:
+            self.data = _decode(object_text, object_text[self._value_start:value_end])
+        except json.JSONDecodeError as e:
+            self.error = e
+            self._state = 'seek'
+            return False
+        self.done = True
+        self._chunks = [self.text[:self._start + len(object_text)]]
+        return True
+
+
+def extract_data_from_json_response(response_text):
+    # Responses parsed while they streamed in carry their data
+    if isinstance(response_text, ParsedResponse):
+        return response_text.data
+    # Parse the first complete { "data": ... } object of the response
+    parser = DataObjectParser()
+    if not parser.feed(response_text):
+        if parser.error is not None:
+            raise ValueError(
+                f"Error parsing extracted data in: {response_text}. Error: {parser.error}")
+        raise ValueError(f"'data' object not found in: {response_text}")
+    return parser.data
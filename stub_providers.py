@@ -0,0 +1,53 @@
+import time
+
+
+class StubProvider:
+    """
+    Local stand-in for a g4f provider, for testing GPTHandler without network access.
+
+    g4f.ChatCompletion.create calls create_completion, which streams response in
+    chunks of chunk_size characters after latency seconds (chunk_delay seconds
+    apart), or raises error. calls counts the requests, cancelled the streams
+    that were closed before their end.
+
+    Parameters:
+    - name (str): Provider name, as g4f provider classes are named.
+    - response (str or callable): The text to stream, or a function of the prompt returning it.
+    - latency (float): Seconds before the first chunk.
+    - error (Exception): Raised instead of answering.
+    """
+    working = True
+    supports_stream = True
+    supports_gpt_4 = True
+    needs_auth = False
+
+    def __init__(self, name, response='{"data": []}', latency=0.0, chunk_delay=0.0, chunk_size=8, error=None):
+        self.__name__ = name
+        self.response = response
+        self.latency = latency
+        self.chunk_delay = chunk_delay
+        self.chunk_size = chunk_size
+        self.error = error
+        self.calls = 0
+        self.cancelled = 0
+
+    def create_completion(self, model, messages, stream, **kwargs):
+        self.calls += 1
+        time.sleep(self.latency)
+        if self.error is not None:
+            raise self.error
+        response = self.response(messages[-1]['content']) if callable(
+            self.response) else self.response
+        finished = False
+        try:
+            for start in range(0, len(response), self.chunk_size):
+                if start and self.chunk_delay:
+                    time.sleep(self.chunk_delay)
+                yield response[start:start + self.chunk_size]
+            finished = True
+        finally:
+            if not finished:
+                self.cancelled += 1
+
+    def __repr__(self):
+        return f'StubProvider({self.__name__})'
@@ -0,0 +1,83 @@
+import json
+import os
+import random
+import sys
+import types
+
+import cv2
+import numpy as np
+import pytest
+
+# The modules live at the top level of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+
+def _install_stand_ins():
+    """
+    Register minimal g4f and quantum_random modules when they are not installed,
+    and a bare crypto_handler when pandas is not.
+
+    They only make the modules importable: the tests never reach a real provider
+    (they replace g4f.ChatCompletion.create or GPTHandler.get_response), the
+    QuantumRandom stand-in draws from the local Mersenne Twister, and no test
+    trades through a CryptoHandler.
+    """
+    try:
+        import g4f  # noqa: F401
+    except ImportError:
+        g4f = types.ModuleType('g4f')
+        g4f.models = types.SimpleNamespace(gpt_4='gpt-4')
+        g4f.Provider = types.SimpleNamespace(**{
+            name: type(name, (), {}) for name in ['Aivvm', 'DeepAi', 'Bing', 'ChatBase', 'Raycast', 'Liaobots']})
+
+        def create(**kwargs):
+            raise RuntimeError("g4f is not installed")
+        g4f.ChatCompletion = types.SimpleNamespace(create=create)
+        sys.modules['g4f'] = g4f
+    try:
+        import quantum_random  # noqa: F401
+    except ImportError:
+        quantum_random = types.ModuleType('quantum_random')
+        quantum_random.QuantumRandom = type('QuantumRandom', (random.Random,), {})
+        sys.modules['quantum_random'] = quantum_random
+    try:
+        import pandas  # noqa: F401
+    except ImportError:
+        crypto_handler = types.ModuleType('crypto_handler')
+        crypto_handler.CryptoHandler = type('CryptoHandler', (), {})
+        sys.modules['crypto_handler'] = crypto_handler
+
+
+_install_stand_ins()
+
+CAPTIONS = [
+    'A dog runs along a sandy beach.',
+    'A plate of pasta on a wooden table.',
+    'A red bus parked on a city street.',
+    'Two people riding horses in a field.',
+    'A cat sleeping on a sofa.',
+    'A train crossing a bridge over a river.',
+    'A bowl of fruit on a kitchen counter.',
+    'A skier going down a snowy slope.',
+]
+
+
+@pytest.fixture
+def coco_dir(tmp_path):
+    """A small COCO val2017 split: caption annotations and JPEGs of colored blocks."""
+    image_dir = tmp_path / 'images' / 'val2017'
+    image_dir.mkdir(parents=True)
+    (tmp_path / 'annotations').mkdir()
+    rng = np.random.default_rng(0)
+    images, annotations = [], []
+    for i, caption in enumerate(CAPTIONS):
+        file_name = f'{i:012d}.jpg'
+        blocks = rng.integers(0, 256, size=(6, 8, 3), dtype=np.uint8)
+        image = cv2.resize(blocks, (128, 96), interpolation=cv2.INTER_NEAREST)
+        cv2.imwrite(str(image_dir / file_name), image)
+        images.append({'id': 100 + i, 'file_name': file_name, 'height': 96, 'width': 128,
+                       'coco_url': f'http://127.0.0.1:1/{file_name}'})
+        annotations.append({'id': 1000 + i, 'image_id': 100 + i, 'caption': caption})
+    with open(tmp_path / 'annotations' / 'captions_val2017.json', 'w') as file:
+        json.dump({'images': images, 'annotations': annotations}, file)
+    return str(tmp_path)
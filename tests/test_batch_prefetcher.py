@@ -0,0 +1,85 @@
+import threading
+import time
+
+import pytest
+
+from candidate_pipeline import BatchPrefetcher
+
+
+class _Producer:
+    """Produces 0, 1, ... up to limit (then None), recording how many it produced."""
+
+    def __init__(self, limit=None, error_at=None):
+        self.limit = limit
+        self.error_at = error_at
+        self.produced = 0
+        self.threads = set()
+
+    def __call__(self):
+        self.threads.add(threading.current_thread().name)
+        if self.produced == self.error_at:
+            raise KeyError('broken batch')
+        if self.limit is not None and self.produced >= self.limit:
+            return None
+        self.produced += 1
+        return self.produced - 1
+
+
+def _wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+@pytest.mark.parametrize('depth', [0, 1, 3])
+def test_yields_every_batch_in_order(depth):
+    with BatchPrefetcher(_Producer(limit=5), depth=depth) as batches:
+        assert list(batches) == [0, 1, 2, 3, 4]
+
+
+def test_inline_without_depth():
+    producer = _Producer(limit=2)
+    with BatchPrefetcher(producer, depth=0) as batches:
+        list(batches)
+
+    assert producer.threads == {threading.current_thread().name}
+
+
+def test_worker_stays_at_most_depth_batches_ahead():
+    producer = _Producer()
+    with BatchPrefetcher(producer, depth=2) as batches:
+        # depth batches queued, plus the one blocked handing over
+        assert _wait_for(lambda: producer.produced == 3)
+        time.sleep(0.2)
+        assert producer.produced == 3
+
+        assert next(batches) == 0
+        assert _wait_for(lambda: producer.produced == 4)
+        time.sleep(0.2)
+        assert producer.produced == 4
+
+
+def test_close_stops_and_joins_the_worker():
+    producer = _Producer()
+    batches = BatchPrefetcher(producer, depth=2)
+    assert next(batches) == 0
+    batches.close()
+
+    assert not batches._thread.is_alive()
+    produced = producer.produced
+    time.sleep(0.2)
+    assert producer.produced == produced
+    with pytest.raises(StopIteration):
+        next(batches)
+
+
+@pytest.mark.parametrize('depth', [0, 2])
+def test_producer_error_reaches_the_consumer(depth):
+    with BatchPrefetcher(_Producer(error_at=2), depth=depth) as batches:
+        assert next(batches) == 0
+        assert next(batches) == 1
+        with pytest.raises(KeyError, match='broken batch'):
+            next(batches)
+        with pytest.raises(StopIteration):
+            next(batches)
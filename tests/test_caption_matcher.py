@@ -0,0 +1,54 @@
+import pytest
+
+from caption_matcher import CaptionMatcher, _stem, tokenize
+from conftest import CAPTIONS
+
+
+@pytest.fixture
+def matcher():
+    return CaptionMatcher({i: (caption,) for i, caption in enumerate(CAPTIONS)})
+
+
+@pytest.mark.parametrize('words', [
+    ['bus', 'buses'],
+    ['campus', 'campuses'],
+    ['house', 'houses'],
+    ['horse', 'horses'],
+    ['glass', 'glasses'],
+    ['dish', 'dishes'],
+    ['pony', 'ponies'],
+    ['run', 'running'],
+    ['sit', 'sitting'],
+    ['park', 'parked'],
+])
+def test_word_forms_share_a_stem(words):
+    assert len({_stem(word) for word in words}) == 1
+
+
+def test_tokenize_drops_stop_words():
+    assert tokenize('The buses are parked on the street') == ['bus', 'park', 'street']
+
+
+def test_rank_puts_the_matching_captions_first(matcher):
+    caption_lists = {'BTC/USDT': [CAPTIONS[0]], 'ETH/USDT': [CAPTIONS[2]], 'SOL/USDT': [CAPTIONS[4]]}
+
+    ranking = matcher.rank('Two red buses waiting in a city street', caption_lists)
+
+    assert ranking[0][0] == 'ETH/USDT'
+    assert ranking[0][1] > ranking[1][1]
+    assert [score for _, score in ranking] == sorted((score for _, score in ranking), reverse=True)
+
+
+def test_rank_matches_synonyms(matcher):
+    caption_lists = {'BTC/USDT': [CAPTIONS[0]], 'ETH/USDT': [CAPTIONS[1]]}
+
+    ranking = matcher.rank('a puppy playing by the sea', caption_lists)
+
+    assert ranking[0][0] == 'BTC/USDT'
+    assert ranking[0][1] > 0
+
+
+def test_rank_scores_unrelated_descriptions_zero(matcher):
+    ranking = matcher.rank('quantum entanglement', {'BTC/USDT': [CAPTIONS[0]], 'ETH/USDT': [CAPTIONS[1]]})
+
+    assert [score for _, score in ranking] == [0.0, 0.0]
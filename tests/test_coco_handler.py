@@ -0,0 +1,84 @@
+from collections import Counter
+
+import pytest
+
+import coco_handler
+from candidate_pipeline import CandidatePipeline
+from coco_handler import CocoHandler
+from config import DIVERSE_SET_CAPTION_CHECK
+from diverse_set_pool import DiverseSetPool
+from gpt_handler import GPTHandler
+
+
+@pytest.fixture
+def handler(coco_dir, monkeypatch):
+    """A CocoHandler of the synthetic split; GPT requests fail the test."""
+    def get_response(self, *args, **kwargs):
+        raise AssertionError("unexpected GPT request")
+    monkeypatch.setattr(GPTHandler, 'get_response', get_response)
+    return CocoHandler(data_dir=coco_dir)
+
+
+@pytest.fixture
+def caption_checks(handler, monkeypatch):
+    """The caption_check of every non_diverse_captions call of handler."""
+    checks = []
+    non_diverse_captions = handler.non_diverse_captions
+
+    def record(captions, caption_check='gpt', **kwargs):
+        checks.append(caption_check)
+        return non_diverse_captions(captions, caption_check=caption_check, **kwargs)
+    monkeypatch.setattr(handler, 'non_diverse_captions', record)
+    return checks
+
+
+def test_inline_and_pooled_sets_use_the_same_caption_check(handler, caption_checks, tmp_path):
+    assert len(handler.get_diverse_image_set(3, debug=False)) == 3
+    inline = list(caption_checks)
+
+    pool = DiverseSetPool(handler, sizes=[2], capacity=1, path=str(tmp_path / 'pool.json')).start()
+    try:
+        assert len(pool.take(2, timeout=30)) == 2
+    finally:
+        pool.stop()
+
+    assert inline and caption_checks[len(inline):]
+    assert set(caption_checks) == {DIVERSE_SET_CAPTION_CHECK}
+
+
+@pytest.mark.parametrize('prefetch_batches', [0, 2])
+def test_each_palette_is_extracted_once_per_set(handler, monkeypatch, prefetch_batches):
+    pipelines, drawn, batches = [], Counter(), []
+
+    class RecordingPipeline(CandidatePipeline):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            pipelines.append(self)
+
+        def candidates(self, img_ids):
+            drawn.update(img_ids)
+            return super().candidates(img_ids)
+
+        def similar_pairs(self, candidates, *args, **kwargs):
+            batches.append(candidates)
+            if len(batches) == 1:
+                # Reject all but one image of the first batch, so they are drawn again
+                return [(0, j) for j in range(1, len(candidates))]
+            return super().similar_pairs(candidates, *args, **kwargs)
+    monkeypatch.setattr(coco_handler, 'CandidatePipeline', RecordingPipeline)
+
+    extracted = Counter()
+    palettes_of_images = handler.diversity_handler.palettes_of_images
+
+    def count(imgs, **kwargs):
+        extracted.update(img['id'] for img in imgs)
+        return palettes_of_images(imgs, **kwargs)
+    monkeypatch.setattr(handler.diversity_handler, 'palettes_of_images', count)
+
+    images = handler.get_diverse_image_set(
+        3, batch_size=6, debug=False, prefetch_batches=prefetch_batches)
+
+    assert len(images) == 3
+    assert max(drawn.values()) > 1
+    assert pipelines[0].max_extractions() == 1
+    assert set(extracted.values()) == {1}
@@ -0,0 +1,44 @@
+import pytest
+
+from coco_snapshot import CocoSnapshot, snapshot_dir
+
+
+@pytest.fixture
+def snapshot(coco_dir):
+    return CocoSnapshot.load_or_build(f'{coco_dir}/annotations/captions_val2017.json',
+                                      snapshot_dir(coco_dir, 'val2017'))
+
+
+def _captions(snapshot, img_id):
+    return tuple(ann['caption'] for ann in snapshot.loadAnns(snapshot.getAnnIds(img_id)))
+
+
+def test_caption_index_decodes_an_image_on_first_lookup(snapshot):
+    index = snapshot.caption_index()
+    img_id = snapshot.getImgIds()[3]
+
+    assert index._cache == {}
+    assert index[img_id] == _captions(snapshot, img_id)
+    assert list(index._cache) == [img_id]
+    assert index[img_id] is index[img_id]
+
+
+def test_caption_index_streams_every_image_without_caching(snapshot):
+    index = snapshot.caption_index()
+    cached = index[snapshot.getImgIds()[0]]
+
+    items = list(index.items())
+
+    assert [img_id for img_id, _ in items] == snapshot.getImgIds() == list(index)
+    assert [captions for _, captions in items] == [_captions(snapshot, img_id) for img_id in index]
+    assert items[0][1] is cached
+    assert len(index._cache) == 1
+    assert len(index) == len(items)
+
+
+def test_caption_index_unknown_image(snapshot):
+    index = snapshot.caption_index()
+
+    assert -1 not in index
+    with pytest.raises(KeyError):
+        index[-1]
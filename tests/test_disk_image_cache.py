@@ -0,0 +1,53 @@
+import os
+
+from disk_image_cache import DiskImageCache
+
+
+class _Fetcher:
+    """Serves 100 bytes per URL and counts the downloads."""
+
+    def __init__(self):
+        self.fetched = []
+
+    def fetch_many(self, urls):
+        self.fetched.extend(urls)
+        return [url.encode('utf-8').ljust(100, b'.') for url in urls]
+
+
+def test_least_recently_used_files_are_evicted(tmp_path):
+    fetcher = _Fetcher()
+    cache = DiskImageCache(cache_dir=str(tmp_path), max_bytes=300, fetcher=fetcher)
+    cache.get_many_bytes(['a', 'b', 'c'])
+    cache.get_bytes('a')
+    cache.get_bytes('d')
+
+    assert not os.path.exists(cache.path('b'))
+    assert all(os.path.exists(cache.path(url)) for url in 'acd')
+    assert cache.stats()['bytes'] == 300
+    assert cache.stats()['evictions'] == 1
+
+
+def test_writes_do_not_rescan_the_directory(tmp_path, monkeypatch):
+    cache = DiskImageCache(cache_dir=str(tmp_path), max_bytes=200, fetcher=_Fetcher())
+
+    def scandir(path):
+        raise AssertionError('scandir on write')
+    monkeypatch.setattr(os, 'scandir', scandir)
+    cache.get_many_bytes([str(i) for i in range(20)])
+
+    assert len(os.listdir(tmp_path)) == 2
+    assert cache.stats()['evictions'] == 18
+
+
+def test_reopened_cache_keeps_the_recency_order(tmp_path):
+    cache = DiskImageCache(cache_dir=str(tmp_path), max_bytes=1000, fetcher=_Fetcher())
+    cache.get_many_bytes(['a', 'b'])
+    os.utime(cache.path('a'), (1, 1))
+    os.utime(cache.path('b'), (2, 2))
+
+    reopened = DiskImageCache(cache_dir=str(tmp_path), max_bytes=200, fetcher=_Fetcher())
+    assert reopened.current_bytes == 200
+    reopened.get_bytes('c')
+
+    assert not os.path.exists(cache.path('a'))
+    assert os.path.exists(cache.path('b'))
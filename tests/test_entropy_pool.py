@@ -0,0 +1,91 @@
+import random
+
+import pytest
+
+from entropy_pool import EntropyPool, LocalEntropySource, rng_byte_source
+
+
+class _RandomOnly(random.Random):
+    """A generator overriding only random(), like QuantumRandom."""
+
+    def __init__(self):
+        super().__init__(0)
+        self.calls = 0
+
+    def random(self):
+        self.calls += 1
+        return 0.5
+
+
+class _Bits:
+    """A generator that is not a random.Random, with its own getrandbits."""
+
+    def getrandbits(self, k):
+        return (1 << k) - 1
+
+
+def test_random_only_generator_is_drawn_from_random():
+    rng = _RandomOnly()
+    data = rng_byte_source(rng)(8)
+
+    assert rng.calls == 2
+    assert data == (1 << 31).to_bytes(4, 'little') * 2
+
+
+def test_own_getrandbits_is_used():
+    assert rng_byte_source(_Bits())(3) == b'\xff\xff\xff'
+
+
+def test_draws_are_served_from_the_buffer():
+    source = LocalEntropySource(seed=1)
+    pool = EntropyPool(source, block_size=256, low_water=64, fallback_timeout=None)
+    try:
+        draws = [pool.random() for _ in range(100)]
+    finally:
+        pool.close()
+
+    assert all(0.0 <= draw < 1.0 for draw in draws)
+    assert source.requests >= 3
+    stats = pool.stats()
+    assert stats['fallback'] == 0
+    assert stats['draws'] == 100
+
+
+def test_same_seed_gives_the_same_draws():
+    pools = [EntropyPool(LocalEntropySource(seed=7), fallback_timeout=None) for _ in range(2)]
+    try:
+        first, second = ([pool.getrandbits(64) for _ in range(10)] for pool in pools)
+    finally:
+        for pool in pools:
+            pool.close()
+
+    assert first == second
+
+
+def test_slow_source_falls_back_to_urandom():
+    pool = EntropyPool(LocalEntropySource(delay=1.0), fallback_timeout=0.05)
+    try:
+        pool.getrandbits(32)
+    finally:
+        pool.close()
+
+    assert pool.stats()['fallback'] == 1
+
+
+def test_closed_pool_serves_the_fallback():
+    pool = EntropyPool(LocalEntropySource(seed=0), block_size=16, low_water=0, fallback_timeout=None)
+    pool.close()
+    pool._thread.join(timeout=1.0)
+    for _ in range(10):
+        pool.getrandbits(32)
+
+    assert pool.stats()['fallback'] == 10
+
+
+def test_state_cannot_be_saved_or_restored():
+    pool = EntropyPool(LocalEntropySource(seed=0))
+    pool.close()
+    with pytest.raises(NotImplementedError):
+        pool.getstate()
+    with pytest.raises(NotImplementedError):
+        pool.setstate(None)
@@ -0,0 +1,170 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import g4f
+import pytest
+
+import gpt_handler
+from gpt_handler import GPTHandler
+from provider_health import ProviderHealth
+from stub_providers import StubProvider
+
+ANSWER = '{"data": ["btc/usdt"]}'
+
+
+@pytest.fixture(autouse=True)
+def stub_g4f(monkeypatch):
+    """Route g4f requests to the StubProvider they are sent to."""
+    def create(model, provider, messages, stream, **kwargs):
+        return provider.create_completion(model, messages, stream, **kwargs)
+    monkeypatch.setattr(g4f.ChatCompletion, 'create', create)
+
+
+def _handler(providers, call_timeout=5.0):
+    return GPTHandler(response_cache=None, race_providers=len(providers), providers=providers,
+                      health=ProviderHealth(), call_timeout=call_timeout)
+
+
+def _wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_first_parseable_response_wins_and_losers_are_cancelled():
+    fast = StubProvider('Fast', response=ANSWER, latency=0.05)
+    slow = StubProvider('Slow', response='{"data": ["eth/usdt"]}' + ' chatter' * 20,
+                        latency=0.1, chunk_delay=0.05)
+    handler = _handler([slow, fast])
+
+    response = handler._race('prompt', [slow, fast])
+
+    assert response == ANSWER
+    assert response.data == ['btc/usdt']
+    assert _wait_for(lambda: slow.cancelled == 1)
+    assert handler.health.stats(fast)['calls'] == 1
+    assert handler.health.stats(slow)['calls'] == 0
+
+
+def test_unparseable_winner_falls_through_to_the_next_answer():
+    chatty = StubProvider('Chatty', response='I cannot answer that.')
+    good = StubProvider('Good', response=ANSWER, latency=0.1)
+    handler = _handler([chatty, good])
+
+    assert handler._race('prompt', [chatty, good]) == ANSWER
+    assert handler.health.stats(chatty)['error_rate'] == 1.0
+    assert handler.health.stats(good)['error_rate'] == 0.0
+
+
+def test_unparseable_answer_is_returned_when_nothing_parses():
+    chatty = StubProvider('Chatty', response='I cannot answer that.')
+    broken = StubProvider('Broken', error=ConnectionError('down'), latency=0.05)
+    handler = _handler([chatty, broken])
+
+    assert handler._race('prompt', [chatty, broken]) == 'I cannot answer that.'
+
+
+def test_all_providers_failing_raises_the_last_error():
+    first = StubProvider('First', error=ConnectionError('first down'))
+    second = StubProvider('Second', error=ConnectionError('second down'), latency=0.05)
+    handler = _handler([first, second])
+
+    with pytest.raises(ConnectionError, match='second down'):
+        handler._race('prompt', [first, second])
+    assert handler.health.stats(first)['consecutive_failures'] == 1
+    assert handler.health.stats(second)['consecutive_failures'] == 1
+
+
+def test_deadline_abandons_providers_that_have_not_answered():
+    hung = StubProvider('Hung', response=ANSWER, latency=0.2, chunk_delay=0.2)
+    handler = _handler([hung], call_timeout=0.1)
+
+    start = time.perf_counter()
+    with pytest.raises(TimeoutError):
+        handler._race('prompt', [hung])
+
+    assert time.perf_counter() - start < 0.2
+    assert handler.health.stats(hung)['error_rate'] == 1.0
+    assert _wait_for(lambda: hung.cancelled == 1)
+
+
+@pytest.fixture
+def one_thread(monkeypatch):
+    """Replace the shared request pool by a single thread, held busy until the returned event is set."""
+    executor = ThreadPoolExecutor(max_workers=1)
+    monkeypatch.setattr(gpt_handler, 'shared_request_executor', executor)
+    release = threading.Event()
+    executor.submit(release.wait)
+    yield release
+    release.set()
+    executor.shutdown(wait=True)
+
+
+def _half_open(health, provider):
+    health.record_failure(provider, ConnectionError('down'))
+    assert health.stats(provider)['state'] == 'open'
+
+
+def test_queued_trial_dropped_at_the_deadline_is_released(one_thread):
+    provider = StubProvider('Trial', response=ANSWER)
+    handler = GPTHandler(response_cache=None, race_providers=1, provider=provider, providers=[provider],
+                         health=ProviderHealth(failures=1, cooldown=0), call_timeout=0.1)
+    _half_open(handler.health, provider)
+
+    with pytest.raises(TimeoutError):
+        handler.get_response('prompt')
+
+    assert provider.calls == 0
+    assert handler.health.stats(provider)['calls'] == 1
+    assert handler.health.select([provider], 1) == [provider]
+
+
+def test_queued_loser_is_released_when_the_race_is_won(monkeypatch):
+    winner = StubProvider('Winner', response=ANSWER)
+    queued = StubProvider('Queued', response=ANSWER)
+    executor = ThreadPoolExecutor(max_workers=1)
+
+    class Executor:
+        """Runs the winner's request; the loser's stays queued until cancelled."""
+
+        def submit(self, fn, prompt, provider, *args):
+            return executor.submit(fn, prompt, provider, *args) if provider is winner else Future()
+    monkeypatch.setattr(gpt_handler, 'shared_request_executor', Executor())
+    health = ProviderHealth(failures=1, cooldown=0)
+    _half_open(health, queued)
+    handler = GPTHandler(response_cache=None, race_providers=2, providers=[winner, queued],
+                         health=health, call_timeout=5.0)
+
+    assert handler._providers_for_call() == [winner, queued]
+    assert handler._race('prompt', [winner, queued]) == ANSWER
+    executor.shutdown(wait=True)
+
+    assert queued.calls == 0
+    assert health.select([queued], 1) == [queued]
+
+
+def test_lost_races_stay_out_of_the_latency_percentiles():
+    health = ProviderHealth()
+    fast, loser = StubProvider('Fast'), StubProvider('Loser')
+    health.record_success(fast, 2.0)
+    health.record_success(loser, 1.0)
+    for _ in range(3):
+        health.record_lower_bound(loser, 10.0)
+
+    stats = health.stats(loser)
+    assert stats['p50'] == stats['p99'] == 1.0
+    assert stats['lost_races'] == 3
+    assert stats['calls'] == 1
+    # Ranked by what it is known to take at least
+    assert health.select([loser, fast], 2) == [fast, loser]
+
+
+def test_provider_test_drops_requests_still_queued_at_the_deadline(one_thread, tmp_path):
+    provider = StubProvider('Queued', response=ANSWER)
+    handler = _handler([provider], call_timeout=0.1)
+
+    assert handler.test_providers(rounds=2, leaderboard_path=str(tmp_path / 'leaderboard.json')) == []
+    assert provider.calls == 0
+    assert handler.health.stats(provider)['calls'] == 0
@@ -0,0 +1,97 @@
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from image_fetcher import ImageFetcher
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    """
+    Local stand-in for the COCO image server.
+
+    - /ok/<name>: 200 with body <name>.
+    - /flaky: 503 on the first request, 200 afterwards.
+    - /down: always 503.
+    - /slow: 200 after a second.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests[self.path] += 1
+            server.client_ports.add(self.client_address[1])
+            count = server.requests[self.path]
+        if self.path == '/down' or self.path == '/flaky' and count == 1:
+            return self._reply(503, b'unavailable')
+        if self.path == '/slow':
+            time.sleep(1.0)
+        self._reply(200, self.path.rsplit('/', 1)[-1].encode())
+
+    def _reply(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _StandInHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.requests = Counter()
+    server.client_ports = set()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.url = f'http://127.0.0.1:{server.server_address[1]}'
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_retries_server_errors(server):
+    fetcher = ImageFetcher(timeout=2, retries=2, max_workers=2, backoff_factor=0)
+    assert fetcher.fetch(f'{server.url}/flaky') == b'flaky'
+    assert server.requests['/flaky'] == 2
+
+
+def test_gives_up_after_retries(server):
+    fetcher = ImageFetcher(timeout=2, retries=2, max_workers=2, backoff_factor=0)
+    with pytest.raises(requests.RequestException):
+        fetcher.fetch(f'{server.url}/down')
+    # The first request and two retries
+    assert server.requests['/down'] == 3
+
+
+def test_times_out_slow_responses(server):
+    fetcher = ImageFetcher(timeout=0.2, retries=1, max_workers=2, backoff_factor=0)
+    start = time.perf_counter()
+    with pytest.raises(requests.RequestException):
+        fetcher.fetch(f'{server.url}/slow')
+    # Two attempts of 0.2 s each, rather than waiting for the 1 s response
+    assert time.perf_counter() - start < 0.9
+    assert server.requests['/slow'] == 2
+
+
+def test_fetch_many_reuses_pooled_connections(server):
+    fetcher = ImageFetcher(timeout=2, retries=0, max_workers=4)
+    urls = [f'{server.url}/ok/{i}' for i in range(40)]
+    assert fetcher.fetch_many(urls) == [str(i).encode() for i in range(40)]
+    # Keep-alive connections are reused: at most one per worker
+    assert len(server.client_ports) <= 4
+
+
+def test_fetch_many_downloads_concurrently(server):
+    fetcher = ImageFetcher(timeout=2, retries=0, max_workers=4)
+    start = time.perf_counter()
+    assert fetcher.fetch_many([f'{server.url}/slow'] * 4) == [b'slow'] * 4
+    # Four 1 s responses in parallel, not one after another
+    assert time.perf_counter() - start < 2.0
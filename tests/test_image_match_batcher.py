@@ -0,0 +1,101 @@
+import json
+import threading
+import time
+
+from image_match_batcher import ImageMatchBatcher
+
+CAPTION_MAP = {'BTC/USDT': ['A dog runs on a beach.'],
+               'ETH/USDT': ['A plate of food on a table.']}
+
+
+class _FakeGPT:
+    """
+    Stand-in for GPTHandler: names each session's first crypto in a batched prompt.
+
+    A prompt of 'hold' is kept in flight until release is set, and batched
+    prompts get batch_response instead of an answer when it is given.
+    """
+
+    def __init__(self, batch_response=None):
+        self.batch_response = batch_response
+        self.prompts = []
+        self.holding = threading.Event()
+        self.release = threading.Event()
+
+    def get_response(self, prompt):
+        self.prompts.append(prompt)
+        if prompt == 'hold':
+            self.holding.set()
+            self.release.wait(timeout=5)
+            return '{"data": ["btc/usdt"]}'
+        if 'sessions: ' not in prompt:
+            return '{"data": ["eth/usdt"]}'
+        if self.batch_response is not None:
+            return self.batch_response
+        sessions, _ = json.JSONDecoder().raw_decode(prompt.split('sessions: ', 1)[1])
+        return json.dumps({"data": {session_id: [list(session["image_captions"])[0].lower()]
+                                    for session_id, session in sessions.items()}})
+
+    def batched_prompts(self):
+        return [prompt for prompt in self.prompts if 'sessions: ' in prompt]
+
+
+def _single(gpt, prompt):
+    """The fallback of a session: one GPT call for it alone, like RVSession._gpt_image_match."""
+    return json.loads(gpt.get_response(prompt))['data'][0].upper()
+
+
+def _match_concurrently(batcher, gpt, session_ids):
+    """Match session_ids at once while another call of the batcher is in flight."""
+    held = threading.Thread(target=batcher.match, args=('held', 'd', CAPTION_MAP),
+                            kwargs={'fallback': lambda: _single(gpt, 'hold')})
+    held.start()
+    assert gpt.holding.wait(timeout=5)
+    results = {}
+
+    def match(session_id):
+        results[session_id] = batcher.match(session_id, 'description', CAPTION_MAP,
+                                            fallback=lambda: _single(gpt, f'single {session_id}'))
+
+    threads = [threading.Thread(target=match, args=(session_id,)) for session_id in session_ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=5)
+    gpt.release.set()
+    held.join(timeout=5)
+    return results
+
+
+def test_concurrent_sessions_share_one_round_trip():
+    gpt = _FakeGPT()
+    batcher = ImageMatchBatcher(gpt, window=0.5)
+    results = _match_concurrently(batcher, gpt, ['a1', 'b2'])
+
+    assert results == {'a1': 'BTC/USDT', 'b2': 'BTC/USDT'}
+    assert len(gpt.batched_prompts()) == 1
+    assert '"a1"' in gpt.batched_prompts()[0] and '"b2"' in gpt.batched_prompts()[0]
+    # The held single call and the shared batch
+    assert batcher.stats()['round_trips'] == 2
+
+
+def test_failed_batch_falls_back_to_single_calls():
+    gpt = _FakeGPT(batch_response='no json here')
+    batcher = ImageMatchBatcher(gpt, window=0.5)
+    results = _match_concurrently(batcher, gpt, ['a1', 'b2'])
+
+    assert results == {'a1': 'ETH/USDT', 'b2': 'ETH/USDT'}
+    assert 'single a1' in gpt.prompts and 'single b2' in gpt.prompts
+    # The held call and the two sessions matched on their own
+    assert batcher.stats()['fallbacks'] == 3
+
+
+def test_lone_session_is_sent_without_waiting():
+    gpt = _FakeGPT()
+    batcher = ImageMatchBatcher(gpt, window=2.0)
+    start = time.perf_counter()
+    assert batcher.match('a1', 'description', CAPTION_MAP,
+                         fallback=lambda: _single(gpt, 'single a1')) == 'ETH/USDT'
+    assert time.perf_counter() - start < 1.0
+    assert batcher.stats()['fallbacks'] == 1
+    assert batcher.stats()['round_trips'] == 1
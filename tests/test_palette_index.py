@@ -0,0 +1,27 @@
+from coco_snapshot import CocoSnapshot, snapshot_dir
+from diversity_handler import DiversityHandler
+from image_cache import ImageCache
+from palette_index import DEFAULT_PALETTE_PARAMS, PaletteIndex
+
+
+def _images(coco_dir):
+    coco = CocoSnapshot.load_or_build(f'{coco_dir}/annotations/captions_val2017.json',
+                                      snapshot_dir(coco_dir, 'val2017'))
+    return coco.loadImgs(coco.getImgIds())
+
+
+def test_index_serves_the_palettes_of_live_extraction(coco_dir):
+    index = PaletteIndex.build(coco_dir, processes=1, verbose=False, decode_reduction=2)
+    handler = DiversityHandler(image_cache=ImageCache(), decode_reduction=2,
+                               image_dir=f'{coco_dir}/images/val2017')
+
+    assert index.meta['decode_reduction'] == 2
+    for img in _images(coco_dir):
+        assert index.palette(img['id']) == handler.extract_palette(img, **DEFAULT_PALETTE_PARAMS)
+
+
+def test_index_is_not_used_at_another_decode_reduction(coco_dir):
+    index = PaletteIndex.build(coco_dir, processes=1, verbose=False, decode_reduction=1)
+
+    assert index.matches(**DEFAULT_PALETTE_PARAMS, decode_reduction=1)
+    assert not index.matches(**DEFAULT_PALETTE_PARAMS, decode_reduction=2)
@@ -0,0 +1,197 @@
+import time
+import types
+
+import pytest
+
+from caption_matcher import CaptionMatcher
+from conftest import CAPTIONS
+from image_match_batcher import ImageMatchBatcher
+from rv_session import CryptoHandlerGuard, RVSession, RVSessions, SessionBusy
+
+
+class _FakeGPT:
+    """Answers every prompt with response (or raises it), counting the prompts."""
+
+    def __init__(self, response='{"data": ["eth/usdt"]}'):
+        self.response = response
+        self.prompts = []
+
+    def get_response(self, prompt):
+        self.prompts.append(prompt)
+        if isinstance(self.response, Exception):
+            raise self.response
+        return self.response
+
+
+def _session(caption_lists, gpt):
+    matcher = CaptionMatcher({i: (caption,) for i, caption in enumerate(CAPTIONS)})
+    session = RVSession([], types.SimpleNamespace(caption_matcher=lambda: matcher), None, gpt)
+    session.crypto_image_map = {crypto: {'url': None, 'caption_list': captions, 'dominant_colors': []}
+                                for crypto, captions in caption_lists.items()}
+    return session
+
+
+# A dog on a beach and a bus in a street, which a description tells apart clearly
+DISTINCT = {'BTC/USDT': [CAPTIONS[0]], 'ETH/USDT': [CAPTIONS[2]]}
+# Two beach scenes, equally close to a beach description
+CLOSE = {'BTC/USDT': ['A dog on a sandy beach.'], 'ETH/USDT': ['A cat on a sandy beach.']}
+
+
+def _match(session, description, **kwargs):
+    session.record_rv_session(description)
+    return session.image_match(debug=False, **kwargs)
+
+
+def test_clear_local_match_does_not_ask_gpt():
+    gpt = _FakeGPT()
+    session = _session(DISTINCT, gpt)
+
+    assert _match(session, 'a dog running on the beach') == 'BTC/USDT'
+    assert gpt.prompts == []
+
+
+def test_close_scores_ask_gpt():
+    gpt = _FakeGPT('{"data": ["eth/usdt"]}')
+    session = _session(CLOSE, gpt)
+
+    assert _match(session, 'a sandy beach') == 'ETH/USDT'
+    assert len(gpt.prompts) == 1
+
+
+def test_margin_decides_what_is_close():
+    gpt = _FakeGPT('{"data": ["eth/usdt"]}')
+    session = _session(DISTINCT, gpt)
+
+    assert _match(session, 'a dog running on the beach', gpt_margin=1.01) == 'ETH/USDT'
+    assert len(gpt.prompts) == 1
+    assert _match(_session(CLOSE, gpt), 'a sandy beach', gpt_margin=0.0) in CLOSE
+    assert len(gpt.prompts) == 1
+
+
+def test_zero_scores_ask_gpt():
+    gpt = _FakeGPT('{"data": ["eth/usdt"]}')
+    session = _session(DISTINCT, gpt)
+
+    assert _match(session, 'quantum entanglement') == 'ETH/USDT'
+    assert len(gpt.prompts) == 1
+
+
+@pytest.mark.parametrize('response', [ConnectionError('down'), '{"data": ["doge/usdt"]}', 'no json'])
+def test_failed_gpt_match_falls_back_to_the_local_match(response):
+    gpt = _FakeGPT(response)
+    session = _session(CLOSE, gpt)
+    local = session.coco_handler.caption_matcher().rank('a sandy beach', CLOSE)[0][0]
+
+    assert _match(session, 'a sandy beach') == local
+    assert len(gpt.prompts) == 1
+
+
+def test_lone_batched_match_is_asked_on_its_own():
+    gpt = _FakeGPT('{"data": ["eth/usdt"]}')
+    session = _session(CLOSE, gpt)
+    session.image_match_batcher = ImageMatchBatcher(gpt)
+
+    assert _match(session, 'a sandy beach') == 'ETH/USDT'
+    assert session.image_match_batcher.stats()['fallbacks'] == 1
+    assert len(gpt.prompts) == 1
+
+
+class _FakeCryptoHandler:
+    """Records the pairs each start_session asked Freqtrade for."""
+
+    def __init__(self):
+        self.started = []
+
+    def start_session(self, crypto_pairs):
+        self.started.append(crypto_pairs)
+
+    def reset_session(self):
+        pass
+
+
+class _FakeCoco:
+    """Hands out the same two-image set for every session."""
+
+    def get_diverse_image_set(self, n):
+        return [{'id': i, 'coco_url': f'url{i}', 'color_palette': []} for i in range(n)]
+
+    def captions_many(self, img_ids):
+        return [(CAPTIONS[img_id],) for img_id in img_ids]
+
+
+def _trading_session(session_id, crypto_handler, guard):
+    return RVSession(['BTC/USDT', 'ETH/USDT', 'SOL/USDT'], _FakeCoco(), crypto_handler, None,
+                     session_id=session_id, crypto_guard=guard)
+
+
+def test_one_session_trades_at_a_time():
+    crypto_handler, guard = _FakeCryptoHandler(), CryptoHandlerGuard()
+    first = _trading_session('first', crypto_handler, guard)
+    second = _trading_session('second', crypto_handler, guard)
+
+    first.start_session(2)
+    with pytest.raises(SessionBusy):
+        second.start_session(2)
+    assert crypto_handler.started == [first.sampled_cryptos]
+    assert guard.owner == 'first'
+
+    first.release_crypto_handler()
+    second.start_session(2)
+    assert guard.owner == 'second'
+    second.reset_session()
+    assert guard.owner is None
+
+
+def test_failed_start_releases_the_guard():
+    guard = CryptoHandlerGuard()
+    session = _trading_session('failing', _FakeCryptoHandler(), guard)
+
+    with pytest.raises(ValueError):
+        session.start_session(5)
+    assert guard.owner is None
+
+
+def _sessions(guard=None, **kwargs):
+    return RVSessions(lambda session_id: _trading_session(session_id, _FakeCryptoHandler(), guard),
+                      crypto_guard=guard, **kwargs)
+
+
+def test_sessions_are_kept_per_operator_up_to_the_cap():
+    sessions = _sessions(max_sessions=2)
+    first = sessions.get('a')
+
+    assert sessions.get('a') is first
+    sessions.get('b')
+    sessions.get('a')
+    sessions.get('c')
+
+    assert len(sessions) == 2
+    assert sessions.get('a') is first
+    assert sessions.pop('c') is not None
+    assert sessions.pop('b') is None
+
+
+def test_the_trading_session_is_not_evicted_by_the_cap():
+    guard = CryptoHandlerGuard()
+    sessions = _sessions(guard, max_sessions=1)
+    trading = sessions.get('trader')
+    trading.start_session(2)
+
+    sessions.get('other')
+    sessions.get('third')
+
+    assert sessions.get('trader') is trading
+    assert guard.owner == 'trader'
+
+
+def test_idle_sessions_are_dropped_and_release_the_guard():
+    guard = CryptoHandlerGuard()
+    sessions = _sessions(guard, idle_timeout=0.05)
+    trading = sessions.get('trader')
+    trading.start_session(2)
+    time.sleep(0.1)
+
+    sessions.get('other').start_session(2)
+
+    assert guard.owner == 'other'
+    assert sessions.get('trader') is not trading
@@ -0,0 +1,76 @@
+import random
+
+import pytest
+
+from stream_parser import DataObjectParser
+
+CASES = [
+    # (response, data, text up to the end of the object if the response goes on after it)
+    ('{"data": ["btc/usdt", "eth/usdt"]}', ['btc/usdt', 'eth/usdt'], None),
+    ('{"data": "say \\"hi\\" } ] {"}', 'say "hi" } ] {', None),
+    ("{ \"data\": ['btc/usdt', 'eth/usdt'] }", ['btc/usdt', 'eth/usdt'], None),
+    ('{"data": "[`\'btc/usdt\'`, `\'eth/usdt\'`]"}', ['btc/usdt', 'eth/usdt'], None),
+    ('{"data": [1, 2} then {"data": nope} and {"data": [3]}', [3], None),
+    ('{"data": {"data": [1, {"a": "]"}]}, "extra": 1}', {'data': [1, {'a': ']'}]}, None),
+    ('Sure! Here it is: {"data": ["sol/usdt"]} Hope this helps. {"data": ["no"]}', ['sol/usdt'],
+     'Sure! Here it is: {"data": ["sol/usdt"]}'),
+    ('{"answer": 1} {"data" :\n true}', True, None),
+]
+
+
+def _chunks(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)] or ['']
+
+
+def _parse(chunks):
+    parser = DataObjectParser()
+    for i, chunk in enumerate(chunks):
+        if parser.feed(chunk):
+            return parser, chunks[i + 1:]
+    return parser, []
+
+
+@pytest.mark.parametrize('response, data, text', CASES)
+@pytest.mark.parametrize('size', [1, 2, 3, 7, 1000])
+def test_parses_at_any_chunk_boundary(response, data, text, size):
+    parser, _ = _parse(_chunks(response, size))
+
+    assert parser.done
+    assert parser.data == data
+    assert parser.text == (text or response)
+
+
+@pytest.mark.parametrize('response, data, text', CASES)
+def test_parses_at_random_chunk_boundaries(response, data, text):
+    rng = random.Random(response)
+    for _ in range(20):
+        cuts = sorted(rng.sample(range(1, len(response)), rng.randint(1, len(response) // 3)))
+        chunks = [response[i:j] for i, j in zip([0] + cuts, cuts + [len(response)])]
+
+        parser, _ = _parse(chunks)
+
+        assert parser.data == data
+
+
+def test_stops_reading_after_the_object():
+    chunks = _chunks('{"data": [1]}' + ' chatter' * 10, 4)
+
+    parser, unread = _parse(chunks)
+
+    assert parser.text == '{"data": [1]}'
+    assert len(unread) == 20
+    assert parser.feed('more') is True
+
+
+@pytest.mark.parametrize('response, error', [
+    ('no object here', None),
+    ('{"data": [1, 2', None),
+    ('{"data": [1, 2}', ValueError),
+    ('{"data": nope}', ValueError),
+])
+def test_incomplete_or_invalid_objects(response, error):
+    parser, _ = _parse(_chunks(response, 1))
+
+    assert not parser.done
+    assert parser.text == response
+    assert parser.error is None if error is None else isinstance(parser.error, error)